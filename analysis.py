@@ -0,0 +1,329 @@
+import os
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from openai import OpenAI
+
+from file_registry import find_policy_file, register_policy_file
+from pdf_upload import upload_policy_pdf
+from pdf_slim import slim_pdf
+from analysis_cache import get_cached_analysis, store_cached_analysis, hash_prompt
+from analysis_result import ANALYSIS_TEXT_FORMAT, ANALYSIS_RESULT_SCHEMA, parse_analysis_result, load_analysis_result
+from json_stream import IncrementalJSONObjectParser
+from policy_text import select_scenario_context, SECTION_MAP_HASH
+from policy_rules import evaluate_scenario
+from openai_scheduler import openai_request, estimate_request_tokens, PRIORITY_INTERACTIVE
+from policy_profile import PROFILE_PROMPT_HASH
+
+logger = logging.getLogger(__name__)
+
+# Concurrent OpenAI calls used by "Analyze All Scenarios" (one per scenario by default)
+ANALYSIS_MAX_WORKERS = int(os.getenv("ANALYSIS_MAX_WORKERS", 9))
+
+# Stream single-scenario analyses so results render field by field
+ANALYSIS_STREAMING = os.getenv("ANALYSIS_STREAMING", "1") == "1"
+
+# "sections" sends only the policy text relevant to each scenario when it can be
+# extracted locally; "file" always sends the whole PDF
+POLICY_CONTEXT_MODE = os.getenv("POLICY_CONTEXT_MODE", "sections")
+POLICY_CONTEXT_MAX_CHARS = int(os.getenv("POLICY_CONTEXT_MAX_CHARS", 80000))
+
+# Point at another OpenAI-compatible endpoint, e.g. mock_openai_server.py for load tests
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")
+
+
+def get_openai_client():
+    # Try environment variable first (works on Railway, Replit, local)
+    api_key = os.environ.get("OPENAI_API_KEY")
+    
+    # Fallback to st.secrets if available (Replit)
+    if not api_key:
+        try:
+            import streamlit as st
+            api_key = st.secrets.get("OPENAI_API_KEY")
+        except Exception:
+            pass
+    if not api_key:
+        return None
+    # Retries are handled by openai_scheduler so they share its backoff and rate limits
+    return OpenAI(api_key=api_key, base_url=OPENAI_BASE_URL or None, max_retries=0)
+
+# Identical PDFs (by content hash) reuse the OpenAI file uploaded by any earlier session.
+# spooled is a pdf_upload.SpooledPDF; on_progress(bytes_sent, total_bytes) reports a new upload.
+# on_slimmed(report) receives pdf_slim's before/after sizes when a new upload is needed
+def get_or_upload_pdf(client, spooled, on_wait=None, on_progress=None, on_slimmed=None):
+    content_hash = spooled.content_hash
+    file_id = find_policy_file(content_hash)
+    if file_id:
+        logger.info(f"Reusing uploaded policy {file_id} for content hash {content_hash[:12]}")
+        return file_id, True, None
+    
+    with slim_pdf(spooled) as (upload, report):
+        if on_slimmed and report:
+            on_slimmed(report)
+        file_id, error = upload_policy_pdf(client, upload, on_wait, on_progress)
+    if error:
+        # Another session may have finished uploading the same document meanwhile
+        file_id = find_policy_file(content_hash)
+        if file_id:
+            return file_id, True, None
+        return None, False, error
+    return register_policy_file(client, content_hash, file_id, upload.size), False, None
+
+ANALYSIS_MODEL = "gpt-4o"
+
+ANALYSIS_SYSTEM_PROMPT = """You are an expert homeowners insurance policy analyzer for PoliSee Clarity.
+Analyze ONLY the uploaded policy PDF for the given scenario.
+Be conservative and reference typical policy language (sudden/accidental discharge, surface water exclusion, wear & tear, etc.).
+
+Output ONLY valid JSON with these exact keys, in this order:
+- plain_summary: short plain-language explanation (2-4 sentences)
+- gap_alerts: array of strings (e.g. "Flood not covered", "Mold from long-term seepage excluded")
+- covered_items: array of objects [{item: string, est_replacement_cost: number, depreciation_pct: number, acv_payout: number}]
+- not_covered_items: array of strings describing what is not covered
+- deductible: number (the policy deductible amount)
+- total_out_of_pocket: number or null (estimated total out of pocket after coverage)
+- recommendations: array of strings with actionable advice
+
+Be thorough but conservative in your analysis. If something is unclear in the policy, note it as a potential gap."""
+
+ANALYSIS_USER_PROMPT = """Analyze the homeowners insurance policy above for the following scenario: {scenario}
+
+Please provide a detailed breakdown of what would be covered, what would not be covered, estimated costs, and any gaps in coverage the homeowner should be aware of."""
+
+ANALYSIS_EXCERPT_PROMPT = """The uploaded policy is provided below as the excerpts relevant to the scenario that follows (cover pages, declarations and the applicable coverage, peril, exclusion and endorsement wording). Treat them as the policy document.
+
+{policy_context}"""
+
+ANALYSIS_REPAIR_PROMPT = """The analysis below, for the scenario "{scenario}", could not be used: {error}
+
+Return the corrected analysis. Keep every value that is already valid and change only what the problem above requires.
+
+{output_text}"""
+
+# Part of the analysis cache key: editing either prompt invalidates cached results.
+# Excerpt-based analyses also depend on how sections are selected.
+ANALYSIS_SCHEMA_JSON = json.dumps(ANALYSIS_RESULT_SCHEMA, sort_keys=True)
+ANALYSIS_PROMPT_HASH = hash_prompt(ANALYSIS_SYSTEM_PROMPT, ANALYSIS_USER_PROMPT, ANALYSIS_SCHEMA_JSON)
+ANALYSIS_EXCERPT_PROMPT_HASH = hash_prompt(
+    ANALYSIS_SYSTEM_PROMPT, ANALYSIS_USER_PROMPT, ANALYSIS_SCHEMA_JSON, ANALYSIS_EXCERPT_PROMPT, SECTION_MAP_HASH
+)
+
+def analysis_prompt_hash(policy_context=None):
+    return ANALYSIS_EXCERPT_PROMPT_HASH if policy_context else ANALYSIS_PROMPT_HASH
+
+# Stored with each saved result (PolicyAnalysisResult.prompt_version)
+def analysis_prompt_version(policy_context=None):
+    return f"{ANALYSIS_MODEL}:{analysis_prompt_hash(policy_context)[:16]}"
+
+PROFILE_RESULT_VERSION = f"rules:{PROFILE_PROMPT_HASH[:16]}"
+
+def prompt_cache_key(content_hash):
+    return f"policy-{content_hash[:32]}" if content_hash else None
+
+def build_analysis_request(file_id, scenario, policy_context=None, content_hash=None):
+    user_prompt = ANALYSIS_USER_PROMPT.format(scenario=scenario)
+    if policy_context:
+        policy_input = {"type": "input_text", "text": ANALYSIS_EXCERPT_PROMPT.format(policy_context=policy_context)}
+    else:
+        policy_input = {"type": "input_file", "file_id": file_id}
+    # the newest OpenAI model is "gpt-5" which was released August 7, 2025.
+    # Using responses API with file input for PDF analysis.
+    # Invariant parts come first (system prompt, then the policy) and the
+    # scenario last, so every scenario run on one policy shares a prefix the
+    # provider can serve from its prompt cache. Excerpts start with the cover
+    # pages and declarations, which are the same for every scenario.
+    request = {
+        "model": ANALYSIS_MODEL,
+        "input": [
+            {"role": "system", "content": ANALYSIS_SYSTEM_PROMPT},
+            {
+                "role": "user",
+                "content": [
+                    policy_input,
+                    {"type": "input_text", "text": user_prompt}
+                ]
+            }
+        ],
+        "text": ANALYSIS_TEXT_FORMAT
+    }
+    if content_hash:
+        # Routes requests for the same policy to the same cache
+        request["prompt_cache_key"] = prompt_cache_key(content_hash)
+    return request
+
+def analysis_call_log(operation, content_hash, scenario):
+    return {
+        "operation": operation,
+        "model": ANALYSIS_MODEL,
+        "content_hash": content_hash,
+        "scenario": scenario,
+        "prompt_cache_key": prompt_cache_key(content_hash),
+    }
+
+def get_policy_context(policy_sections, scenario):
+    if POLICY_CONTEXT_MODE != "sections" or not policy_sections:
+        return None
+    return select_scenario_context(policy_sections, scenario, POLICY_CONTEXT_MAX_CHARS)
+
+# Returns (AnalysisResult, error)
+def parse_analysis_output(output_text):
+    try:
+        data = json.loads(output_text)
+    except json.JSONDecodeError as e:
+        return None, f"Failed to parse AI response: {str(e)}"
+    result, error = parse_analysis_result(data)
+    if error:
+        return None, f"Invalid AI response: {error}"
+    return result, None
+
+# A response that does not validate (cut off at the token limit, or a refusal)
+# is sent back on its own with the problem, instead of re-running the whole
+# analysis with the policy attached
+def repair_analysis(client, scenario, output_text, error, priority=PRIORITY_INTERACTIVE, on_wait=None,
+                    content_hash=None):
+    logger.warning(f"Repairing {scenario} analysis: {error}")
+    request_body = {
+        "model": ANALYSIS_MODEL,
+        "input": [
+            {"role": "system", "content": ANALYSIS_SYSTEM_PROMPT},
+            {"role": "user", "content": ANALYSIS_REPAIR_PROMPT.format(
+                scenario=scenario, error=error, output_text=output_text or "(empty response)"
+            )}
+        ],
+        "text": ANALYSIS_TEXT_FORMAT
+    }
+    try:
+        with openai_request(priority, estimate_request_tokens(request_body["input"]), on_wait,
+                            analysis_call_log("analysis_repair", content_hash, scenario)) as request:
+            response = request.call(client.responses.create, **request_body)
+    except Exception as e:
+        return None, str(e)
+    return parse_analysis_output(response.output_text)
+
+def analyze_policy(client, file_id, scenario, policy_context=None, priority=PRIORITY_INTERACTIVE, on_wait=None,
+                   content_hash=None):
+    request_body = build_analysis_request(file_id, scenario, policy_context, content_hash)
+    try:
+        with openai_request(priority, estimate_request_tokens(request_body["input"]), on_wait,
+                            analysis_call_log("analysis", content_hash, scenario)) as request:
+            response = request.call(client.responses.create, **request_body)
+    except Exception as e:
+        return None, str(e)
+    
+    result, error = parse_analysis_output(response.output_text)
+    if error:
+        return repair_analysis(client, scenario, response.output_text, error, priority, on_wait, content_hash)
+    return result, None
+
+# Same result as analyze_policy, but calls on_field(key, value) for each top-level
+# JSON field as soon as it has fully streamed in
+def analyze_policy_stream(client, file_id, scenario, on_field, policy_context=None,
+                          priority=PRIORITY_INTERACTIVE, on_wait=None, content_hash=None):
+    parser = IncrementalJSONObjectParser()
+    text_parts = []
+    request_body = build_analysis_request(file_id, scenario, policy_context, content_hash)
+    try:
+        with openai_request(priority, estimate_request_tokens(request_body["input"]), on_wait,
+                            analysis_call_log("analysis_stream", content_hash, scenario)) as request:
+            stream = request.call(client.responses.create, **request_body, stream=True)
+            for event in stream:
+                if event.type == "response.output_text.delta":
+                    text_parts.append(event.delta)
+                    if parser is None:
+                        continue
+                    try:
+                        completed_fields = parser.feed(event.delta)
+                    except ValueError as e:
+                        # Stop previewing but keep collecting; the final parse reports the real error
+                        logger.warning(f"Incremental JSON parse stopped: {e}")
+                        parser = None
+                        continue
+                    for key, value in completed_fields:
+                        on_field(key, value)
+                elif event.type == "response.completed" and event.response.usage:
+                    request.record_usage(event.response.usage)
+                elif event.type == "error":
+                    return None, event.message
+                elif event.type == "response.failed":
+                    error = event.response.error
+                    return None, error.message if error else "Analysis failed"
+    except Exception as e:
+        return None, str(e)
+    
+    output_text = "".join(text_parts)
+    result, error = parse_analysis_output(output_text)
+    if error:
+        return repair_analysis(client, scenario, output_text, error, priority, on_wait, content_hash)
+    return result, None
+
+def lookup_cached_analysis(content_hash, scenario, policy_context=None):
+    cached = get_cached_analysis(content_hash, scenario, ANALYSIS_MODEL, analysis_prompt_hash(policy_context))
+    return load_analysis_result(cached) if cached is not None else None
+
+# policy_context, when given, is an excerpt already selected by get_policy_context
+# (background jobs store it because the worker never sees the PDF bytes)
+# on_wait(position, seconds) is called while the request waits for the OpenAI scheduler
+def analyze_policy_cached(client, file_id, content_hash, scenario, on_field=None, policy_sections=None,
+                          policy_context=None, priority=PRIORITY_INTERACTIVE, on_wait=None):
+    if policy_context is None:
+        policy_context = get_policy_context(policy_sections, scenario)
+    prompt_hash = analysis_prompt_hash(policy_context)
+    
+    cached = lookup_cached_analysis(content_hash, scenario, policy_context)
+    if cached is not None:
+        logger.info(f"Analysis cache hit for {content_hash[:12]} / {scenario}")
+        return cached, True, None
+    
+    if policy_context:
+        logger.info(f"Analyzing {scenario} from {len(policy_context)} chars of policy excerpts")
+    if on_field and ANALYSIS_STREAMING:
+        result, error = analyze_policy_stream(client, file_id, scenario, on_field, policy_context, priority, on_wait,
+                                              content_hash)
+    else:
+        result, error = analyze_policy(client, file_id, scenario, policy_context, priority, on_wait, content_hash)
+    if error:
+        return None, False, error
+    store_cached_analysis(content_hash, scenario, ANALYSIS_MODEL, prompt_hash, result.to_dict())
+    return result, False, None
+
+# Returns the rules-engine result, or None when the scenario needs the model
+def evaluate_with_profile(profile, scenario):
+    if not profile:
+        return None
+    result, review_reasons = evaluate_scenario(profile, scenario)
+    if review_reasons:
+        logger.info(f"Policy profile cannot settle {scenario}: {'; '.join(review_reasons)}")
+        return None
+    return result
+
+# Yields (scenario, result, source, error) in completion order, not submission order.
+# Scenarios the policy profile settles locally come first; the rest fan out to the model.
+def analyze_all_scenarios(client, file_id, content_hash, scenarios, policy_sections=None, profile=None):
+    remaining = []
+    for scenario in scenarios:
+        result = evaluate_with_profile(profile, scenario)
+        if result is None:
+            remaining.append(scenario)
+        else:
+            yield scenario, result, "profile", None
+    if not remaining:
+        return
+    
+    max_workers = max(1, min(ANALYSIS_MAX_WORKERS, len(remaining)))
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="analysis") as executor:
+        futures = {
+            executor.submit(
+                analyze_policy_cached, client, file_id, content_hash, scenario,
+                policy_sections=policy_sections
+            ): scenario
+            for scenario in remaining
+        }
+        for future in as_completed(futures):
+            scenario = futures[future]
+            try:
+                result, _, error = future.result()
+            except Exception as e:
+                result, error = None, str(e)
+            yield scenario, result, "ai", error
@@ -0,0 +1,155 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import IntegrityError
+
+from models import SessionLocal, AnalysisCacheEntry
+
+logger = logging.getLogger(__name__)
+
+# Entries older than the TTL are ignored and evicted; the table is trimmed to
+# CACHE_MAX_ENTRIES by least-recent access. The LRU is per process.
+CACHE_TTL = timedelta(hours=int(os.getenv("ANALYSIS_CACHE_TTL_HOURS", 24 * 7)))
+CACHE_MAX_ENTRIES = int(os.getenv("ANALYSIS_CACHE_MAX_ENTRIES", 5000))
+CACHE_LRU_SIZE = int(os.getenv("ANALYSIS_CACHE_LRU_SIZE", 256))
+# Seconds between evictions in one process; stores in between skip it
+CACHE_EVICT_INTERVAL_SECONDS = float(os.getenv("ANALYSIS_CACHE_EVICT_SECONDS", 300))
+
+
+class LRUCache:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            created_at, value = item
+            if datetime.utcnow() - created_at > CACHE_TTL:
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return value
+    
+    def put(self, key, value, created_at=None):
+        with self._lock:
+            self._items[key] = (created_at or datetime.utcnow(), value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+
+_lru = LRUCache(CACHE_LRU_SIZE)
+_eviction_lock = threading.Lock()
+_eviction = {"next": 0.0}
+
+
+def hash_prompt(*prompt_parts):
+    return hashlib.sha256("\x1f".join(prompt_parts).encode("utf-8")).hexdigest()
+
+
+def make_cache_key(content_hash, scenario, model, prompt_hash):
+    raw = "|".join([content_hash, scenario, model, prompt_hash])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def get_cached_analysis(content_hash, scenario, model, prompt_hash):
+    cache_key = make_cache_key(content_hash, scenario, model, prompt_hash)
+    
+    # Values are stored as JSON text so callers always get a fresh dict
+    cached_json = _lru.get(cache_key)
+    if cached_json is not None:
+        return json.loads(cached_json)
+    
+    db = SessionLocal()
+    try:
+        entry = db.query(AnalysisCacheEntry).filter(
+            AnalysisCacheEntry.cache_key == cache_key,
+            AnalysisCacheEntry.created_at >= datetime.utcnow() - CACHE_TTL
+        ).first()
+        if not entry:
+            return None
+        entry.hit_count = AnalysisCacheEntry.hit_count + 1
+        entry.last_accessed_at = datetime.utcnow()
+        response_json, created_at = entry.response_json, entry.created_at
+        db.commit()
+        _lru.put(cache_key, response_json, created_at)
+        return json.loads(response_json)
+    except Exception as e:
+        db.rollback()
+        logger.warning(f"Analysis cache lookup failed: {e}")
+        return None
+    finally:
+        db.close()
+
+
+def store_cached_analysis(content_hash, scenario, model, prompt_hash, result):
+    cache_key = make_cache_key(content_hash, scenario, model, prompt_hash)
+    response_json = json.dumps(result)
+    _lru.put(cache_key, response_json)
+    
+    db = SessionLocal()
+    try:
+        entry = db.query(AnalysisCacheEntry).filter(AnalysisCacheEntry.cache_key == cache_key).first()
+        if entry:
+            # Expired entry for the same key; refresh it in place
+            entry.response_json = response_json
+            entry.created_at = datetime.utcnow()
+            entry.last_accessed_at = datetime.utcnow()
+        else:
+            db.add(AnalysisCacheEntry(
+                cache_key=cache_key,
+                content_hash=content_hash,
+                scenario=scenario,
+                model=model,
+                prompt_hash=prompt_hash,
+                response_json=response_json
+            ))
+        db.commit()
+        if _eviction_due():
+            evict_expired_entries(db)
+    except IntegrityError:
+        # A concurrent session cached the same analysis first
+        db.rollback()
+    except Exception as e:
+        db.rollback()
+        logger.warning(f"Failed to store cached analysis: {e}")
+    finally:
+        db.close()
+
+
+def _eviction_due():
+    with _eviction_lock:
+        now = time.monotonic()
+        if now < _eviction["next"]:
+            return False
+        _eviction["next"] = now + CACHE_EVICT_INTERVAL_SECONDS
+        return True
+
+
+def evict_expired_entries(db):
+    deleted = db.query(AnalysisCacheEntry).filter(
+        AnalysisCacheEntry.created_at < datetime.utcnow() - CACHE_TTL
+    ).delete(synchronize_session=False)
+    
+    # Everything past the CACHE_MAX_ENTRIES most recently used, in one
+    # statement that walks the last_accessed_at index instead of counting the table
+    overflow_ids = db.query(AnalysisCacheEntry.id).order_by(
+        AnalysisCacheEntry.last_accessed_at.desc()
+    ).offset(CACHE_MAX_ENTRIES).subquery()
+    deleted += db.query(AnalysisCacheEntry).filter(
+        AnalysisCacheEntry.id.in_(overflow_ids.select())
+    ).delete(synchronize_session=False)
+    
+    db.commit()
+    if deleted:
+        logger.info(f"Evicted {deleted} analysis cache entries")
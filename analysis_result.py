@@ -0,0 +1,189 @@
+import json
+from dataclasses import dataclass, asdict
+
+# The scenario analysis as one typed object. Model output is checked once in
+# parse_analysis_result; everything downstream (rendering, cost math, saving,
+# history) reads attributes instead of re-checking dict values.
+
+_NUMBER = {"type": "number"}
+_NULLABLE_NUMBER = {"type": ["number", "null"]}
+_STRINGS = {"type": "array", "items": {"type": "string"}}
+
+# Strict structured-output schema sent with every analysis request. Property
+# order matches the system prompt, so fields stream in the order the UI shows them.
+ANALYSIS_RESULT_SCHEMA = {
+    "type": "object",
+    "additionalProperties": False,
+    "required": ["plain_summary", "gap_alerts", "covered_items", "not_covered_items", "deductible",
+                 "total_out_of_pocket", "recommendations"],
+    "properties": {
+        "plain_summary": {"type": "string"},
+        "gap_alerts": _STRINGS,
+        "covered_items": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "additionalProperties": False,
+                "required": ["item", "est_replacement_cost", "depreciation_pct", "acv_payout"],
+                "properties": {
+                    "item": {"type": "string"},
+                    "est_replacement_cost": _NUMBER,
+                    "depreciation_pct": _NUMBER,
+                    "acv_payout": _NUMBER,
+                },
+            },
+        },
+        "not_covered_items": _STRINGS,
+        "deductible": _NULLABLE_NUMBER,
+        "total_out_of_pocket": _NULLABLE_NUMBER,
+        "recommendations": _STRINGS,
+    },
+}
+
+ANALYSIS_TEXT_FORMAT = {
+    "format": {"type": "json_schema", "name": "policy_analysis", "schema": ANALYSIS_RESULT_SCHEMA, "strict": True}
+}
+
+
+@dataclass(slots=True)
+class CoveredItem:
+    item: str
+    est_replacement_cost: float
+    depreciation_pct: float
+    acv_payout: float
+
+
+@dataclass(slots=True)
+class AnalysisResult:
+    plain_summary: str
+    gap_alerts: list
+    covered_items: list
+    not_covered_items: list
+    deductible: float | None
+    total_out_of_pocket: float | None
+    recommendations: list
+
+    def to_dict(self):
+        return asdict(self)
+
+    def to_json(self):
+        return json.dumps(self.to_dict())
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _check_strings(data, key, errors):
+    value = data.get(key)
+    if not isinstance(value, list):
+        errors.append(f"{key}: expected a list of strings")
+        return []
+    for index, entry in enumerate(value):
+        if not isinstance(entry, str):
+            errors.append(f"{key}[{index}]: expected a string")
+    return value
+
+
+def _check_number(data, key, errors, nullable=False, label=None):
+    value = data.get(key)
+    if value is None and nullable:
+        return None
+    if not _is_number(value):
+        errors.append(f"{label or key}: expected a number")
+        return None
+    return float(value)
+
+
+# Returns (AnalysisResult, error). Every problem is listed in the error, so a
+# repair request can fix them all at once.
+def parse_analysis_result(data):
+    if not isinstance(data, dict):
+        return None, "expected a JSON object"
+    errors = []
+    missing = [key for key in ANALYSIS_RESULT_SCHEMA["required"] if key not in data]
+    if missing:
+        errors.append(f"missing fields: {', '.join(missing)}")
+    plain_summary = data.get("plain_summary")
+    if not isinstance(plain_summary, str) or not plain_summary.strip():
+        errors.append("plain_summary: expected a non-empty string")
+
+    covered_items = []
+    raw_items = data.get("covered_items")
+    if not isinstance(raw_items, list):
+        errors.append("covered_items: expected a list of objects")
+        raw_items = []
+    for index, entry in enumerate(raw_items):
+        if not isinstance(entry, dict):
+            errors.append(f"covered_items[{index}]: expected an object")
+            continue
+        if not isinstance(entry.get("item"), str):
+            errors.append(f"covered_items[{index}].item: expected a string")
+        numbers = [_check_number(entry, key, errors, label=f"covered_items[{index}].{key}")
+                   for key in ("est_replacement_cost", "depreciation_pct", "acv_payout")]
+        covered_items.append(CoveredItem(entry.get("item"), *numbers))
+
+    result = AnalysisResult(
+        plain_summary=plain_summary,
+        gap_alerts=_check_strings(data, "gap_alerts", errors),
+        covered_items=covered_items,
+        not_covered_items=_check_strings(data, "not_covered_items", errors),
+        deductible=_check_number(data, "deductible", errors, nullable=True),
+        total_out_of_pocket=_check_number(data, "total_out_of_pocket", errors, nullable=True),
+        recommendations=_check_strings(data, "recommendations", errors),
+    )
+    if errors:
+        return None, "; ".join(errors)
+    return result, None
+
+
+def _number_or_none(value):
+    return float(value) if _is_number(value) else None
+
+
+def _strings(values):
+    strings = []
+    for value in values if isinstance(values, list) else []:
+        # Older responses sometimes listed not-covered items as objects
+        if isinstance(value, dict):
+            value = value.get("item", value)
+        strings.append(str(value))
+    return strings
+
+
+def load_covered_items(values):
+    items = []
+    for entry in values if isinstance(values, list) else []:
+        if isinstance(entry, dict):
+            items.append(CoveredItem(
+                str(entry.get("item") or "N/A"),
+                _number_or_none(entry.get("est_replacement_cost")) or 0.0,
+                _number_or_none(entry.get("depreciation_pct")) or 0.0,
+                # None (no payout limit) for results saved without it
+                _number_or_none(entry.get("acv_payout")),
+            ))
+    return items
+
+
+# Lenient counterpart of parse_analysis_result for stored JSON (history rows,
+# cache entries, job results), including results saved before the schema
+# was enforced. Never fails; unusable values are dropped.
+def load_analysis_result(data):
+    if isinstance(data, (str, bytes)):
+        try:
+            data = json.loads(data)
+        except ValueError:
+            # Truncated or corrupt text loads as an empty result
+            data = {}
+    if not isinstance(data, dict):
+        data = {}
+    return AnalysisResult(
+        plain_summary=data.get("plain_summary") if isinstance(data.get("plain_summary"), str)
+        else "No summary available.",
+        gap_alerts=_strings(data.get("gap_alerts")),
+        covered_items=load_covered_items(data.get("covered_items")),
+        not_covered_items=_strings(data.get("not_covered_items")),
+        deductible=_number_or_none(data.get("deductible")),
+        total_out_of_pocket=_number_or_none(data.get("total_out_of_pocket")),
+        recommendations=_strings(data.get("recommendations")),
+    )
@@ -0,0 +1,333 @@
+import os
+import json
+import time
+import queue
+import atexit
+import logging
+import argparse
+import tempfile
+import threading
+from datetime import datetime
+
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError, OperationalError, InterfaceError, TimeoutError as PoolTimeoutError
+
+from models import init_db, engine
+from storage import analysis_columns, insert_analyses, save_analysis
+from rollups import record_analyses
+
+# Write-behind persistence for finished analyses. The app hands each result to
+# queue_analysis and shows it right away; a background thread per process
+# writes queued rows to policy_analysis_results and their compressed payloads,
+# everything queued since the last write in one multi-row INSERT per table.
+# Connection errors are retried with backoff; when Postgres stays unreachable
+# (or the queue is full) rows are fsynced to files in ANALYSIS_SPILL_DIR and
+# replayed once it is back, by this process or the next one to start. Rows
+# Postgres rejects outright (a deleted user) are set aside there as
+# rejected-*.jsonl instead of blocking the rest.
+#
+#   python analysis_writer.py            # replay spilled rows now
+#   python analysis_writer.py --status
+
+logger = logging.getLogger(__name__)
+
+# Set to 0 to save each analysis synchronously on the request path
+ANALYSIS_WRITE_BEHIND = os.getenv("ANALYSIS_WRITE_BEHIND", "1") == "1"
+ANALYSIS_WRITE_BATCH_SIZE = int(os.getenv("ANALYSIS_WRITE_BATCH_SIZE", 500))
+# Rows waiting beyond this go straight to the spill directory
+ANALYSIS_WRITE_QUEUE_SIZE = int(os.getenv("ANALYSIS_WRITE_QUEUE_SIZE", 10000))
+# Attempts after the first before a batch is spilled; backoff doubles from
+# 0.5s up to ANALYSIS_WRITE_BACKOFF_MAX seconds
+ANALYSIS_WRITE_RETRIES = int(os.getenv("ANALYSIS_WRITE_RETRIES", 5))
+ANALYSIS_WRITE_BACKOFF_MAX = float(os.getenv("ANALYSIS_WRITE_BACKOFF_MAX", 8))
+# Must survive a restart of the process to be useful; point it at a persistent
+# volume where the default temp directory is wiped on deploy
+ANALYSIS_SPILL_DIR = os.getenv("ANALYSIS_SPILL_DIR") or os.path.join(tempfile.gettempdir(), "polisee-analysis-spill")
+# Seconds between checks for spilled rows to replay
+ANALYSIS_SPILL_REPLAY_SECONDS = float(os.getenv("ANALYSIS_SPILL_REPLAY_SECONDS", 30))
+
+# pg_try_advisory_xact_lock key: one replay at a time, so a spill file is inserted once
+REPLAY_LOCK_KEY = 7340213
+
+
+def _is_transient(error):
+    # Errors worth retrying: the database or the network, not the rows
+    if isinstance(error, (OperationalError, InterfaceError, PoolTimeoutError)):
+        return True
+    return isinstance(error, DBAPIError) and error.connection_invalidated
+
+
+def _insert_rows(rows):
+    # Inserts rows, and adds them to the analytics rollups, in one transaction
+    # and returns those Postgres rejected; raises on connection errors,
+    # leaving nothing committed
+    with engine.begin() as conn:
+        try:
+            with conn.begin_nested():
+                insert_analyses(conn, rows)
+                record_analyses(conn, rows)
+            return []
+        except DBAPIError as e:
+            if _is_transient(e):
+                raise
+            logger.warning(f"Batch of {len(rows)} analyses rejected, inserting one at a time: {e.orig}")
+        rejected = []
+        for row in rows:
+            try:
+                with conn.begin_nested():
+                    insert_analyses(conn, [row])
+            except DBAPIError as e:
+                if _is_transient(e):
+                    raise
+                logger.error(f"Analysis for user {row['user_id']} ({row['scenario']}) rejected: {e.orig}")
+                rejected.append(row)
+        accepted = [row for row in rows if not any(row is other for other in rejected)]
+        try:
+            # The analyses are kept even if their rollups cannot be updated
+            with conn.begin_nested():
+                record_analyses(conn, accepted)
+        except DBAPIError as e:
+            if _is_transient(e):
+                raise
+            logger.error(f"Rollups not updated for {len(accepted)} analyses, run `python rollups.py --rebuild`: {e.orig}")
+        return rejected
+
+
+class AnalysisWriter:
+    def __init__(self, spill_dir=ANALYSIS_SPILL_DIR):
+        self.spill_dir = spill_dir
+        self.queue = queue.Queue(maxsize=ANALYSIS_WRITE_QUEUE_SIZE)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.counts = {"queued": 0, "written": 0, "batches": 0, "retries": 0,
+                       "spilled": 0, "replayed": 0, "rejected": 0, "lost": 0}
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counts[name] += amount
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="analysis-writer", daemon=True)
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self, timeout=15):
+        # Writes what is still queued; whatever cannot be written is spilled
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def submit(self, row):
+        # Returns an error message, or None once the row is queued or spilled
+        self.start()
+        try:
+            self.queue.put_nowait(row)
+        except queue.Full:
+            logger.warning(f"Analysis write queue full ({ANALYSIS_WRITE_QUEUE_SIZE}), spilling")
+            return self._spill([row])
+        self.count("queued")
+        return None
+
+    def flush(self, timeout=30):
+        # Waits until every queued row is written or spilled; returns False on timeout
+        deadline = time.monotonic() + timeout
+        while self.queue.unfinished_tasks:
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def _next_batch(self):
+        # Blocks briefly for one row, then takes whatever else is already
+        # waiting: a lone analysis is written at once, a burst in few statements
+        try:
+            batch = [self.queue.get(timeout=0.5)]
+        except queue.Empty:
+            return []
+        while len(batch) < ANALYSIS_WRITE_BATCH_SIZE:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        next_replay = 0.0
+        while True:
+            batch = self._next_batch()
+            if batch:
+                try:
+                    self._write(batch)
+                finally:
+                    for _ in batch:
+                        self.queue.task_done()
+            elif self._stop.is_set():
+                return
+            if not self._stop.is_set() and time.monotonic() >= next_replay:
+                next_replay = time.monotonic() + ANALYSIS_SPILL_REPLAY_SECONDS
+                self.replay_spilled()
+
+    def _write(self, rows):
+        for attempt in range(ANALYSIS_WRITE_RETRIES + 1):
+            try:
+                rejected = _insert_rows(rows)
+            except Exception as e:
+                if not _is_transient(e) or attempt == ANALYSIS_WRITE_RETRIES or self._stop.is_set():
+                    logger.error(f"Could not write {len(rows)} analyses, spilling to {self.spill_dir}: {e}")
+                    self._spill(rows)
+                    return
+                delay = min(ANALYSIS_WRITE_BACKOFF_MAX, 0.5 * 2 ** attempt)
+                logger.warning(f"Writing {len(rows)} analyses failed, retrying in {delay:.1f}s: {e}")
+                self.count("retries")
+                self._stop.wait(delay)
+                continue
+            if rejected:
+                self._spill(rejected, "rejected")
+            self.count("written", len(rows) - len(rejected))
+            self.count("batches")
+            return
+
+    def _spill(self, rows, kind="spill"):
+        # Each batch is its own file, renamed into place once it is on disk, so
+        # a replay never reads a partial write
+        try:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=self.spill_dir)
+            with os.fdopen(fd, "w") as f:
+                for row in rows:
+                    f.write(json.dumps(row, default=str) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, os.path.join(self.spill_dir, f"{kind}-{time.time_ns()}-{os.getpid()}.jsonl"))
+        except OSError as e:
+            self.count("lost", len(rows))
+            logger.error(f"Failed to spill {len(rows)} analyses to {self.spill_dir}: {e}")
+            return f"Failed to save analysis: {e}"
+        self.count("rejected" if kind == "rejected" else "spilled", len(rows))
+        return None
+
+    def spill_files(self, kind="spill"):
+        try:
+            names = os.listdir(self.spill_dir)
+        except FileNotFoundError:
+            return []
+        return sorted(os.path.join(self.spill_dir, name) for name in names
+                      if name.startswith(f"{kind}-") and name.endswith(".jsonl"))
+
+    def replay_spilled(self):
+        # Returns the rows replayed, or None when another process is replaying
+        # or the database is still unreachable
+        paths = self.spill_files()
+        if not paths:
+            return 0
+        replayed = 0
+        try:
+            # Held until this transaction ends, so the lock and its release are
+            # on one server connection, also behind PgBouncer's transaction pooling
+            with engine.begin() as lock_conn:
+                if not lock_conn.execute(text("SELECT pg_try_advisory_xact_lock(:key)"), {"key": REPLAY_LOCK_KEY}).scalar():
+                    return None
+                for path in paths:
+                    if not os.path.exists(path):
+                        continue
+                    with open(path) as f:
+                        rows = [json.loads(line) for line in f if line.strip()]
+                    rejected = _insert_rows(rows) if rows else []
+                    if rejected:
+                        self._spill(rejected, "rejected")
+                    os.unlink(path)
+                    replayed += len(rows) - len(rejected)
+        except Exception as e:
+            logger.warning(f"Spilled analyses not replayed yet: {e}")
+            return None
+        finally:
+            if replayed:
+                self.count("replayed", replayed)
+                logger.info(f"Replayed {replayed} spilled analyses")
+        return replayed
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counts)
+        stats.update({
+            "pending": self.queue.unfinished_tasks,
+            "spill_files": len(self.spill_files()),
+            "rejected_files": len(self.spill_files("rejected")),
+        })
+        return stats
+
+
+_writer = AnalysisWriter()
+
+
+def queue_analysis(user_id, scenario, file_id, result, prompt_version=None):
+    # Returns an error message, or None once the analysis will be saved
+    if not ANALYSIS_WRITE_BEHIND:
+        _, error = save_analysis(user_id, scenario, file_id, result, prompt_version)
+        return error
+    return _writer.submit({
+        "user_id": user_id,
+        "scenario": scenario,
+        "file_id": file_id,
+        "prompt_version": prompt_version,
+        # When the analysis finished, not when the row reaches the database
+        "upload_timestamp": datetime.utcnow(),
+        **analysis_columns(result)
+    })
+
+
+def start_analysis_writer():
+    # Starts this process's writer thread, which also replays rows spilled
+    # before a restart; queue_analysis starts it on first use otherwise
+    if ANALYSIS_WRITE_BEHIND:
+        _writer.start()
+
+
+def flush_analyses(timeout=30):
+    return _writer.flush(timeout)
+
+
+def writer_stats():
+    return _writer.stats()
+
+
+def format_writer_stats(stats):
+    line = (f"{stats['pending']} pending, {stats['written']:,} written in {stats['batches']:,} batches, "
+            f"{stats['retries']} retries")
+    if stats["spilled"] or stats["spill_files"]:
+        line += f"; {stats['spilled']} spilled, {stats['replayed']} replayed, {stats['spill_files']} spill files waiting"
+    if stats["rejected"] or stats["rejected_files"]:
+        line += f"; {stats['rejected']} rejected ({stats['rejected_files']} files)"
+    if stats["lost"]:
+        line += f"; {stats['lost']} lost"
+    return line
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay analyses spilled while the database was unreachable")
+    parser.add_argument("--status", action="store_true", help="list spill files without replaying them")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    if args.status:
+        for kind in ("spill", "rejected"):
+            for path in _writer.spill_files(kind):
+                with open(path) as f:
+                    print(f"{kind:<9} {sum(1 for line in f if line.strip()):>6} rows  {path}")
+        return
+    init_db()
+    replayed = _writer.replay_spilled()
+    if replayed is None:
+        raise SystemExit("Database unreachable or another process is replaying")
+    print(f"Replayed {replayed} analyses from {ANALYSIS_SPILL_DIR}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,34 @@
 import streamlit as st
 import os
-import json
-import re
-import bcrypt
+import html
+import tempfile
 import logging
-from datetime import datetime
-from openai import OpenAI
+from datetime import datetime, timedelta
 import pandas as pd
 
-from models import init_db, SessionLocal, User, PolicyAnalysisResult
+from models import engine
+from bootstrap import bootstrap, format_startup
+from storage import (validate_email, register_user, authenticate_user, get_user_analyses,
+                     get_analysis, page_cursor, write_analyses_csv)
+from analysis_writer import queue_analysis, start_analysis_writer, writer_stats, format_writer_stats
+from analysis import (
+    get_openai_client, get_or_upload_pdf, analyze_policy_cached,
+    analyze_all_scenarios, evaluate_with_profile, get_policy_context, lookup_cached_analysis,
+    analysis_prompt_version, PROFILE_RESULT_VERSION
+)
+from jobs import enqueue_analysis_job, get_job, get_queue_position, get_undelivered_jobs, mark_job_delivered
+from policy_text import ingest_policy_pdf, full_policy_text
+from policy_profile import get_or_extract_policy_profile
+from usage_log import prompt_cache_summary, format_cache_summary
+from rollups import scenario_summary, overall_percentiles, daily_counts, gap_alert_counts
+from file_registry import start_file_sweeper
+from pdf_upload import spool_pdf, MB, UPLOAD_SPOOL_DIR
+from db_pool import pool_stats, format_pool_stats
+from analysis_result import load_covered_items, load_analysis_result
+from cost_calculator import (
+    covered_items_frame, calculate_costs, baseline_costs, scenario_cost_matrix,
+    property_coverage_limit, health_scores
+)
 
 # Configure logging for Railway/production compatibility
 logging.basicConfig(
@@ -22,7 +42,17 @@ PORT = int(os.getenv("PORT", 5000))
 IS_RAILWAY = os.getenv("RAILWAY_ENVIRONMENT") is not None
 IS_REPLIT = os.getenv("REPL_ID") is not None
 
-logger.info(f"Starting PoliSee Clarity - Port: {PORT}, Railway: {IS_RAILWAY}, Replit: {IS_REPLIT}")
+# Answer scenarios from a one-time policy profile and local rules, consulting
+# the model only when the profile leaves the scenario ambiguous
+POLICY_PROFILE_ENABLED = os.getenv("POLICY_PROFILE_ENABLED", "1") == "1"
+
+# Hand single-scenario AI analyses to worker.py instead of running them in the
+# Streamlit session; requires at least one worker process
+ANALYSIS_JOB_QUEUE = os.getenv("ANALYSIS_JOB_QUEUE", "0") == "1"
+JOB_POLL_SECONDS = int(os.getenv("JOB_POLL_SECONDS", 2))
+
+# Comma-separated emails that see the analytics page
+ADMIN_EMAILS = {email.strip().lower() for email in os.getenv("ADMIN_EMAILS", "").split(",") if email.strip()}
 
 st.set_page_config(
     page_title="PoliSee Clarity",
@@ -1339,9 +1369,22 @@ CUSTOM_CSS = """
 </style>
 """
 
+# Styles are page elements, so every run has to emit them again
 st.markdown(CUSTOM_CSS, unsafe_allow_html=True)
 
-init_db()
+# Everything above and below re-runs on each interaction; migrations, the
+# OpenAI client and background threads are set up once per server process
+@st.cache_resource
+def bootstrap_app():
+    logger.info(f"Starting PoliSee Clarity - Port: {PORT}, Railway: {IS_RAILWAY}, Replit: {IS_REPLIT}")
+    return bootstrap()
+
+startup_timings, startup_error = bootstrap_app()
+if startup_error:
+    # Not kept: the next run checks the schema again
+    bootstrap_app.clear()
+    st.error(startup_error)
+    st.stop()
 
 SCENARIOS = [
     "Select a scenario...",
@@ -1356,159 +1399,294 @@ SCENARIOS = [
     "Theft"
 ]
 
-def validate_email(email):
-    pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    return re.match(pattern, email) is not None
+# One sweeper thread per server process; replicas and workers take turns
+# through a database lock
+@st.cache_resource
+def get_shared_openai_client():
+    return get_openai_client()
 
-def hash_password(password):
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+@st.cache_resource
+def start_background_file_sweeper(_client):
+    return start_file_sweeper(_client)
 
-def verify_password(password, password_hash):
-    return bcrypt.checkpw(password.encode('utf-8'), password_hash.encode('utf-8'))
+# One writer thread per server process; also replays analyses spilled before a restart
+@st.cache_resource
+def start_background_analysis_writer():
+    start_analysis_writer()
 
-def register_user(email, password):
-    db = SessionLocal()
-    try:
-        existing_user = db.query(User).filter(User.email == email).first()
-        if existing_user:
-            return None, "An account with this email already exists."
-        
-        new_user = User(
-            email=email,
-            password_hash=hash_password(password)
-        )
-        db.add(new_user)
-        db.commit()
-        db.refresh(new_user)
-        return new_user, None
-    except Exception as e:
-        db.rollback()
-        return None, f"Registration failed: {str(e)}"
-    finally:
-        db.close()
+def get_session_policy_profile(client):
+    if not POLICY_PROFILE_ENABLED:
+        return None
+    content_hash = st.session_state.file_hash
+    if st.session_state.get('policy_profile_hash') != content_hash:
+        with st.spinner("Reading your policy's deductibles and limits (one time)..."):
+            profile, error = get_or_extract_policy_profile(
+                client, content_hash, st.session_state.file_id, full_policy_text(get_policy_sections())
+            )
+        if error:
+            logger.warning(f"Policy profile unavailable, using full AI analysis: {error}")
+        st.session_state.policy_profile = profile
+        st.session_state.policy_profile_hash = content_hash
+    return st.session_state.policy_profile
 
-def authenticate_user(email, password):
-    db = SessionLocal()
-    try:
-        user = db.query(User).filter(User.email == email).first()
-        if user and verify_password(password, user.password_hash):
-            return user, None
-        return None, "Invalid email or password."
-    finally:
-        db.close()
+def get_policy_sections():
+    policy_text = st.session_state.get('policy_text')
+    return policy_text['sections'] if policy_text else None
 
-def save_analysis(user_id, scenario, file_id, response_json, out_of_pocket, gap_alerts):
-    db = SessionLocal()
-    try:
-        analysis = PolicyAnalysisResult(
-            user_id=user_id,
-            scenario=scenario,
-            file_id=file_id,
-            openai_response_json=response_json,
-            out_of_pocket_estimate=out_of_pocket,
-            gap_alerts=json.dumps(gap_alerts) if gap_alerts else None
-        )
-        db.add(analysis)
-        db.commit()
-        return True
-    except Exception as e:
-        db.rollback()
-        st.error(f"Failed to save analysis: {str(e)}")
-        return False
-    finally:
-        db.close()
+# on_wait callback for openai_scheduler: position in this server's queue, or a
+# rate-limit/retry delay in seconds
+def show_wait_status(slot):
+    def on_wait(position, seconds):
+        if position:
+            slot.info(f"High demand right now - you're #{position} in line for the analysis engine...")
+        elif seconds:
+            slot.info(f"The analysis engine is busy; continuing in about {seconds:.0f}s...")
+    return on_wait
 
-def get_recent_analyses(limit=10):
-    db = SessionLocal()
-    try:
-        analyses = db.query(PolicyAnalysisResult).order_by(
-            PolicyAnalysisResult.upload_timestamp.desc()
-        ).limit(limit).all()
-        return analyses
-    finally:
-        db.close()
+def format_slim_report(report):
+    pages = ""
+    if report["original_pages"] is not None:
+        pages = f", {report['original_pages']} -> {report['slimmed_pages']} pages"
+    line = (f"PDF Slimming: {report['original_bytes'] / MB:.2f} MB -> {report['slimmed_bytes'] / MB:.2f} MB"
+            f"{pages} in {report['seconds']:.1f}s")
+    if report.get("images_resized") or report.get("images_removed"):
+        line += f"\nImages: {report['images_resized']} downsampled, {report['images_removed']} removed"
+    if report.get("scanned"):
+        line += "\nNo text layer (scanned document): all pages and images kept"
+    if report["error"]:
+        line += f"\nSlimming failed, original uploaded: {report['error']}"
+    elif not report["slimmed"]:
+        line += "\nOriginal uploaded (slimming did not reduce the size)"
+    return line
 
-def get_user_analyses(user_id, limit=10):
-    db = SessionLocal()
-    try:
-        analyses = db.query(PolicyAnalysisResult).filter(
-            PolicyAnalysisResult.user_id == user_id
-        ).order_by(PolicyAnalysisResult.upload_timestamp.desc()).limit(limit).all()
-        return analyses
-    finally:
-        db.close()
+def show_upload_progress(progress_bar):
+    def on_progress(sent, total):
+        progress_bar.progress(min(1.0, sent / total) if total else 1.0,
+                              text=f"Uploading policy to secure analysis engine... {sent / MB:.1f} of {total / MB:.1f} MB")
+    return on_progress
 
-def get_openai_client():
-    # Try environment variable first (works on Railway, Replit, local)
-    api_key = os.environ.get("OPENAI_API_KEY")
-    
-    # Fallback to st.secrets if available (Replit)
-    if not api_key:
-        try:
-            api_key = st.secrets.get("OPENAI_API_KEY")
-        except Exception:
-            pass
-    if not api_key:
-        return None
-    return OpenAI(api_key=api_key)
+def deliver_job(job):
+    mark_job_delivered(job['id'])
+    st.session_state.pop('active_job_id', None)
+    if job['status'] == "done":
+        st.session_state.analysis_result = job['result']
+        st.session_state.analyzed_scenario = job['scenario']
+        st.session_state.analysis_source = "ai"
+    else:
+        st.session_state.job_error = f"{job['scenario']}: {job['error']}"
 
-def upload_pdf_to_openai(client, pdf_file):
-    try:
-        response = client.files.create(
-            file=pdf_file,
-            purpose='assistants'
-        )
-        return response.id, None
-    except Exception as e:
-        return None, str(e)
+# Reopens a saved analysis from the history list without calling the model
+def open_saved_analysis(analysis_id, uploaded_at=None):
+    analysis = get_analysis(st.session_state.user_id, analysis_id, uploaded_at)
+    if analysis is None:
+        st.warning("That analysis is no longer available.")
+        return
+    st.session_state.analysis_result = load_analysis_result(analysis.openai_response_json)
+    st.session_state.analyzed_scenario = analysis.scenario
+    st.session_state.analysis_source = "history"
+    st.session_state.history_file_id = analysis.file_id
+    st.session_state.history_saved_at = analysis.upload_timestamp
+    st.rerun()
 
-def analyze_policy(client, file_id, scenario):
-    system_prompt = """You are an expert homeowners insurance policy analyzer for PoliSee Clarity.
-Analyze ONLY the uploaded policy PDF for the given scenario.
-Be conservative and reference typical policy language (sudden/accidental discharge, surface water exclusion, wear & tear, etc.).
+HISTORY_PAGE_SIZE = 10
 
-Output ONLY valid JSON with these exact keys:
-- covered_items: array of objects [{item: string, est_replacement_cost: number, depreciation_pct: number, acv_payout: number}]
-- not_covered_items: array of strings describing what is not covered
-- deductible: number (the policy deductible amount)
-- total_out_of_pocket: number or null (estimated total out of pocket after coverage)
-- gap_alerts: array of strings (e.g. "Flood not covered", "Mold from long-term seepage excluded")
-- recommendations: array of strings with actionable advice
-- plain_summary: short plain-language explanation (2-4 sentences)
+def history_filters(scenario, dates):
+    filters = {"scenario": None if scenario == "All scenarios" else scenario, "since": None, "until": None}
+    if len(dates) >= 1:
+        filters["since"] = datetime.combine(dates[0], datetime.min.time())
+    if len(dates) == 2:
+        filters["until"] = datetime.combine(dates[1], datetime.min.time()) + timedelta(days=1)
+    return filters
 
-Be thorough but conservative in your analysis. If something is unclear in the policy, note it as a potential gap."""
+# The first page is read on every run (one index range scan). Pages added with
+# "Load more" continue from its last row and are kept until a new analysis
+# or different filters change the first page.
+def get_history_rows(filters):
+    page = get_user_analyses(st.session_state.user_id, HISTORY_PAGE_SIZE + 1, **filters)
+    key = (filters["scenario"], filters["since"], filters["until"], page[0].id if page else None)
+    if st.session_state.get('history_key') != key:
+        st.session_state.history_key = key
+        st.session_state.history_version = st.session_state.get('history_version', 0) + 1
+        st.session_state.history_more = []
+        st.session_state.history_has_more = len(page) > HISTORY_PAGE_SIZE
+    return page[:HISTORY_PAGE_SIZE] + st.session_state.history_more
 
-    user_prompt = f"""Analyze this homeowners insurance policy for the following scenario: {scenario}
+def load_more_history(rows, filters):
+    page = get_user_analyses(st.session_state.user_id, HISTORY_PAGE_SIZE + 1, before=page_cursor(rows), **filters)
+    st.session_state.history_more = st.session_state.history_more + page[:HISTORY_PAGE_SIZE]
+    st.session_state.history_has_more = len(page) > HISTORY_PAGE_SIZE
 
-Please provide a detailed breakdown of what would be covered, what would not be covered, estimated costs, and any gaps in coverage the homeowner should be aware of."""
+# Runs when the download is clicked. Rows stream from a server-side cursor
+# into a temporary file in UPLOAD_SPOOL_DIR, a chunk at a time; Streamlit
+# then reads the finished file once into its media storage, so the export is
+# held in memory as a single bytes object rather than built up as a string
+def export_history_csv(user_id, filters):
+    def build():
+        with tempfile.NamedTemporaryFile("w", newline="", encoding="utf-8", prefix="history-", suffix=".csv",
+                                         dir=UPLOAD_SPOOL_DIR, delete=False) as out:
+            path = out.name
+            try:
+                write_analyses_csv(out, user_id, **filters)
+            except Exception:
+                os.unlink(path)
+                raise
+        # Still readable once unlinked; nothing is left on disk
+        csv_file = open(path, "rb")
+        os.unlink(path)
+        return csv_file
+    return build
 
-    try:
-        # the newest OpenAI model is "gpt-5" which was released August 7, 2025.
-        # Using responses API with file input for PDF analysis
-        response = client.responses.create(
-            model="gpt-4o",
-            input=[
-                {"role": "system", "content": system_prompt},
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "input_text", "text": user_prompt},
-                        {
-                            "type": "input_file",
-                            "file_id": file_id
-                        }
-                    ]
-                }
-            ],
-            text={"format": {"type": "json_object"}}
+# Queued analyses outlive the browser session; pick up the latest one on reconnect
+def restore_pending_jobs():
+    if st.session_state.get('jobs_restored'):
+        return
+    st.session_state.jobs_restored = True
+    jobs = get_undelivered_jobs(st.session_state.user_id)
+    if not jobs:
+        return
+    latest, older = jobs[0], jobs[1:]
+    for job in older:
+        # Already in the analysis history; only the latest is shown again
+        if job['status'] in ("done", "failed"):
+            mark_job_delivered(job['id'])
+    if latest['status'] in ("queued", "running"):
+        st.session_state.active_job_id = latest['id']
+    else:
+        deliver_job(latest)
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def show_job_progress(scenario_icons):
+    job = get_job(st.session_state.active_job_id)
+    if job is None:
+        st.session_state.pop('active_job_id', None)
+        st.rerun()
+    if job['status'] in ("queued", "running"):
+        icon = scenario_icons.get(job['scenario'], "🔍")
+        if job['status'] == "queued":
+            position = get_queue_position(job)
+            status = f"#{position} in line for an analysis worker..." if not job['attempts'] else f"Retrying (attempt {job['attempts'] + 1})..."
+        else:
+            status = "Decoding your policy... This may take a moment."
+        st.info(f"{job['scenario']}: {status} You can leave this page; the result will be here when you return.", icon=icon)
+        return
+    deliver_job(job)
+    st.rerun()
+
+def result_prompt_version(source, scenario):
+    if source == "profile":
+        return PROFILE_RESULT_VERSION
+    return analysis_prompt_version(get_policy_context(get_policy_sections(), scenario))
+
+def render_gap_alerts(gaps):
+    for gap in gaps:
+        st.markdown(f"""
+            <div class="gap-alert">
+                <span class="gap-alert-icon">🚨</span>
+                <span class="gap-alert-text">{gap}</span>
+            </div>
+        """, unsafe_allow_html=True)
+
+# covered is a list of CoveredItem
+def build_covered_items_frame(covered, costs=None):
+    items = costs["items"] if costs else calculate_costs(covered_items_frame(covered), 0)["items"]
+    if items.empty:
+        return None
+    return pd.DataFrame({
+        "Item": items["item"],
+        "Est. Replacement": items["est_replacement_cost"].map("${:,.0f}".format),
+        "Depreciation": items["depreciation_pct"].map("{:g}%".format),
+        "ACV Payout": items["acv_payout"].map("${:,.0f}".format)
+    })
+
+# Limits come from the current upload's profile; a saved analysis of another
+# document (file_id) is shown without them
+def get_coverage_limit(file_id=None):
+    if file_id and file_id != st.session_state.get('file_id'):
+        return None
+    return property_coverage_limit(st.session_state.get('policy_profile'))
+
+# Out-of-pocket is None when neither the covered items nor the analysis give a figure
+def summarize_result_metrics(result, file_id=None):
+    costs = baseline_costs(result, get_coverage_limit(file_id))
+    has_estimate = costs["total_loss"] > 0 or result.total_out_of_pocket is not None
+    return {
+        "out_of_pocket": costs["out_of_pocket"] if has_estimate else None,
+        "gap_count": len(result.gap_alerts),
+        "deductible": result.deductible,
+        "health_score": health_scores(len(result.gap_alerts), costs["out_of_pocket"], costs["total_loss"]),
+        "stated_out_of_pocket": costs["stated_out_of_pocket"],
+        "discrepancy": costs["discrepancy"]
+    }
+
+def render_scenario_card(container, scenario, icon, result=None, error=None):
+    if error:
+        detail = f'<div class="metric-delta">Analysis failed: {html.escape(str(error))}</div>'
+    elif result is None:
+        detail = '<div class="metric-delta">Analyzing...</div>'
+    else:
+        metrics = summarize_result_metrics(result)
+        out_of_pocket = f"${metrics['out_of_pocket']:,.0f}" if metrics['out_of_pocket'] is not None else "Unknown"
+        deductible = f"${metrics['deductible']:,.0f}" if metrics['deductible'] is not None else "N/A"
+        detail = f"""
+            <div class="metric-delta">Out-of-pocket: <strong>{out_of_pocket}</strong></div>
+            <div class="metric-delta">Gaps: <strong>{metrics['gap_count']}</strong> · Deductible: <strong>{deductible}</strong></div>
+        """
+    container.markdown(f"""
+        <div class="scenario-card">
+            <div class="scenario-icon">{icon}</div>
+            <div class="scenario-name">{scenario}</div>
+            {detail}
+        </div>
+    """, unsafe_allow_html=True)
+
+def build_scenario_matrix(results_by_scenario):
+    matrix = scenario_cost_matrix(results_by_scenario, get_coverage_limit())
+    if matrix.empty:
+        return pd.DataFrame()
+    return pd.DataFrame({
+        "Scenario": matrix.index,
+        "Out-of-Pocket": matrix["out_of_pocket"].map(lambda v: f"${v:,.0f}" if pd.notna(v) else "Unknown").values,
+        "Gap Count": matrix["gap_count"].values,
+        "Deductible": matrix["deductible"].map(lambda v: f"${v:,.0f}" if pd.notna(v) else "N/A").values,
+        "Health Score": matrix["health_score"].values,
+        "Analysis Difference": matrix["discrepancy"].map(lambda v: f"${v:+,.0f}" if abs(v) >= 1 else "").values
+    })
+
+# Recomputed locally on every rerun, so moving a slider never calls OpenAI
+def show_what_if(result, scenario, file_id=None):
+    baseline = baseline_costs(result, get_coverage_limit(file_id))
+    items = covered_items_frame(result.covered_items)
+    if items.empty:
+        return
+    
+    with st.expander("What If? Adjust the Numbers"):
+        base_deductible = int(baseline["deductible"])
+        deductible = st.slider(
+            "Deductible", min_value=0, max_value=max(10000, base_deductible * 3),
+            value=base_deductible, step=100, format="$%d", key=f"what_if_deductible_{scenario}"
+        )
+        weights = items["est_replacement_cost"]
+        base_depreciation = int(round((items["depreciation_pct"] * weights).sum() / weights.sum())) if weights.sum() > 0 else 0
+        depreciation = st.slider(
+            "Depreciation (applied to every item)", min_value=0, max_value=90,
+            value=base_depreciation, step=1, format="%d%%", key=f"what_if_depreciation_{scenario}"
+        )
+        multiplier = st.slider(
+            "Repair cost multiplier", min_value=0.5, max_value=2.0, value=1.0, step=0.05,
+            format="%.2fx", key=f"what_if_multiplier_{scenario}"
         )
         
-        result = json.loads(response.output_text)
-        return result, None
-    except json.JSONDecodeError as e:
-        return None, f"Failed to parse AI response: {str(e)}"
-    except Exception as e:
-        return None, str(e)
+        costs = calculate_costs(
+            items, deductible, get_coverage_limit(file_id),
+            depreciation_pct=None if depreciation == base_depreciation else depreciation,
+            cost_multiplier=multiplier
+        )
+        col1, col2, col3 = st.columns(3)
+        col1.metric("Out-of-Pocket", f"${costs['out_of_pocket']:,.0f}",
+                    delta=f"${costs['out_of_pocket'] - baseline['out_of_pocket']:+,.0f}", delta_color="inverse")
+        col2.metric("Insurance Pays", f"${costs['insurer_payout']:,.0f}")
+        col3.metric("Total Loss", f"${costs['total_loss']:,.0f}")
+        st.dataframe(build_covered_items_frame(None, costs), use_container_width=True, hide_index=True)
 
 def show_auth_page():
     import base64
@@ -1620,6 +1798,72 @@ def show_auth_page():
         </div>
     """, unsafe_allow_html=True)
 
+ANALYTICS_PERIODS = {"Last 7 days": 7, "Last 30 days": 30, "Last 90 days": 90, "Last 365 days": 365}
+
+def format_dollars(value):
+    return f"${value:,.0f}" if value is not None else "N/A"
+
+# Reads only the per-day rollups (rollups.py), never the stored analyses
+@st.cache_data(ttl=60, show_spinner=False)
+def load_analytics(days):
+    until = datetime.utcnow().date()
+    since = until - timedelta(days=days - 1)
+    return (scenario_summary(since, until), daily_counts(since, until), gap_alert_counts(since, until))
+
+def show_analytics_page():
+    st.markdown("""
+        <div class="section-header">
+            <span class="section-icon">📊</span>
+            <span class="section-title">Analytics</span>
+        </div>
+    """, unsafe_allow_html=True)
+    period = st.selectbox("Period", list(ANALYTICS_PERIODS), index=1, key="analytics_period")
+    summary, daily, gaps = load_analytics(ANALYTICS_PERIODS[period])
+    if not summary:
+        st.info("No analyses in this period.")
+    else:
+        total = sum(row["analyses"] for row in summary)
+        oop_count = sum(row["oop_count"] for row in summary)
+        oop_sum = sum(row["oop_mean"] * row["oop_count"] for row in summary if row["oop_count"])
+        p50, p90 = overall_percentiles(summary)
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("Analyses", f"{total:,}")
+        col2.metric("Mean Out-of-Pocket", format_dollars(oop_sum / oop_count if oop_count else None))
+        col3.metric("Median (p50)", format_dollars(p50))
+        col4.metric("p90", format_dollars(p90))
+        
+        st.markdown("**By scenario**")
+        st.dataframe(pd.DataFrame([{
+            "Scenario": row["scenario"],
+            "Analyses": row["analyses"],
+            "Mean": format_dollars(row["oop_mean"]),
+            "p50": format_dollars(row["oop_p50"]),
+            "p90": format_dollars(row["oop_p90"]),
+            "Max": format_dollars(row["oop_max"]),
+        } for row in summary]), use_container_width=True, hide_index=True)
+        
+        st.markdown("**Analyses per day**")
+        daily_frame = pd.DataFrame(daily, columns=["Day", "Scenario", "Analyses"])
+        st.bar_chart(daily_frame.pivot_table(index="Day", columns="Scenario", values="Analyses",
+                                             aggfunc="sum", fill_value=0))
+        
+        st.markdown("**Coverage gaps raised**")
+        if gaps:
+            analyses = {row["scenario"]: row["analyses"] for row in summary}
+            gap_frame = pd.DataFrame(gaps, columns=["Scenario", "Code", "Gap", "Analyses"])
+            gap_frame["Analyses"] = gap_frame["Analyses"].astype(int)
+            gap_frame["Share"] = [f"{count / analyses[scenario]:.0%}" if analyses.get(scenario) else "-"
+                                  for scenario, count in zip(gap_frame["Scenario"], gap_frame["Analyses"])]
+            gap_frame = gap_frame.sort_values(["Analyses", "Scenario"], ascending=[False, True])
+            st.dataframe(gap_frame[["Gap", "Scenario", "Analyses", "Share"]], use_container_width=True, hide_index=True)
+        else:
+            st.info("No coverage gaps raised in this period.")
+        st.caption("Percentiles are estimated from out-of-pocket histograms; "
+                   "days are UTC and refresh within a minute.")
+    if st.button("Back", key="close_analytics_btn"):
+        st.session_state.show_analytics = False
+        st.rerun()
+
 def show_main_app():
     user_email = st.session_state.user_email
     user_name = user_email.split('@')[0].title()
@@ -1629,6 +1873,8 @@ def show_main_app():
     if 'show_about' not in st.session_state:
         st.session_state.show_about = False
     
+    is_admin = user_email.lower() in ADMIN_EMAILS
+    
     avatar_url = f"https://ui-avatars.com/api/?name={user_name}&background=0ea5e9&color=fff&rounded=true&size=128"
     
     header_col1, header_col2 = st.columns([4, 1])
@@ -1666,6 +1912,9 @@ def show_main_app():
             if st.button("ℹ️ About PoliSee", key="about_btn", use_container_width=True):
                 st.session_state.show_about = True
             
+            if is_admin and st.button("📊 Analytics", key="analytics_btn", use_container_width=True):
+                st.session_state.show_analytics = True
+            
             st.markdown("""<div class="popover-divider"></div>""", unsafe_allow_html=True)
             
             if st.button("🚪 Logout", key="logout_btn", use_container_width=True):
@@ -1673,6 +1922,10 @@ def show_main_app():
                     del st.session_state[key]
                 st.rerun()
     
+    if is_admin and st.session_state.get('show_analytics', False):
+        show_analytics_page()
+        return
+    
     if st.session_state.get('show_about', False):
         st.markdown("""
             <div class="about-section">
@@ -1690,10 +1943,15 @@ def show_main_app():
             st.session_state.show_about = False
             st.rerun()
     
-    client = get_openai_client()
+    client = get_shared_openai_client()
     if not client:
         st.error("OpenAI API key not configured. Please add OPENAI_API_KEY to your secrets.")
         st.stop()
+    start_background_file_sweeper(client)
+    start_background_analysis_writer()
+    
+    if ANALYSIS_JOB_QUEUE:
+        restore_pending_jobs()
     
     with st.container(border=True):
         st.markdown("""
@@ -1715,13 +1973,29 @@ def show_main_app():
             st.error("File too large. Please upload a PDF under 20MB.")
             st.stop()
         
-        if 'file_id' not in st.session_state or st.session_state.get('uploaded_filename') != uploaded_file.name:
-            with st.spinner("Uploading policy to secure analysis engine..."):
-                file_id, error = upload_pdf_to_openai(client, uploaded_file)
+        upload_key = getattr(uploaded_file, 'file_id', None) or f"{uploaded_file.name}:{uploaded_file.size}"
+        if 'file_id' not in st.session_state or st.session_state.get('upload_key') != upload_key:
+            # Text extraction and the upload read the spooled copy, not more in-memory copies
+            with spool_pdf(uploaded_file, uploaded_file.name) as spooled:
+                with st.spinner("Reading your policy..."):
+                    st.session_state.policy_text = ingest_policy_pdf(spooled.path)
+                wait_slot = st.empty()
+                progress_bar = st.progress(0.0, text="Preparing policy for upload...")
+                st.session_state.slim_report = None
+                file_id, reused, error = get_or_upload_pdf(
+                    client, spooled, on_wait=show_wait_status(wait_slot),
+                    on_progress=show_upload_progress(progress_bar),
+                    on_slimmed=lambda report: st.session_state.update(slim_report=report)
+                )
+                wait_slot.empty()
+                progress_bar.empty()
                 if error:
                     st.error(f"Upload failed: {error}")
                     st.stop()
                 st.session_state.file_id = file_id
+                st.session_state.file_hash = spooled.content_hash
+                st.session_state.file_reused = reused
+                st.session_state.upload_key = upload_key
                 st.session_state.uploaded_filename = uploaded_file.name
         
         st.success(f"Policy uploaded successfully: {uploaded_file.name}")
@@ -1730,6 +2004,21 @@ def show_main_app():
             st.markdown('<div class="debug-card">', unsafe_allow_html=True)
             st.code(f"File ID: {st.session_state.file_id}")
             st.code(f"File Size: {file_size_mb:.2f} MB")
+            st.code(f"Content SHA-256: {st.session_state.file_hash}")
+            st.code(f"Upload: {'reused existing file' if st.session_state.file_reused else 'new upload'}")
+            slim_report = st.session_state.get('slim_report')
+            if slim_report:
+                st.code(format_slim_report(slim_report))
+            policy_text = st.session_state.get('policy_text')
+            if policy_text:
+                st.code(f"Extracted Text: {policy_text['text_chars']:,} chars from {policy_text['page_count']} pages\n"
+                        f"Sections: {', '.join(sorted(policy_text['sections']))}")
+            else:
+                st.code("Extracted Text: none (full PDF is sent for analysis)")
+            st.code(f"Prompt Cache: {format_cache_summary(prompt_cache_summary(content_hashes=[st.session_state.file_hash]))}")
+            st.code(f"Startup (this process): {format_startup(startup_timings)}")
+            st.code(f"DB Pool (this process): {format_pool_stats(pool_stats(engine))}")
+            st.code(f"Analysis Writes (this process): {format_writer_stats(writer_stats())}")
             st.markdown('</div>', unsafe_allow_html=True)
     
     scenario_icons = {
@@ -1772,32 +2061,162 @@ def show_main_app():
     if scenario and 'file_id' in st.session_state:
         icon = scenario_icons.get(scenario, "🔍")
         st.markdown(f"<div style='text-align: center; color: #0ea5e9; margin: 1rem 0;'>Selected: <strong>{icon} {scenario}</strong></div>", unsafe_allow_html=True)
-        if st.button(f"Analyze My Coverage", key="analyze_btn", use_container_width=True):
-            with st.spinner("Decoding your policy... This may take a moment."):
-                result, error = analyze_policy(client, st.session_state.file_id, scenario)
+        if st.button(f"Analyze My Coverage", key="analyze_btn", use_container_width=True,
+                     disabled=bool(st.session_state.get('active_job_id'))):
+            preview = st.empty()
+            with preview.container():
+                wait_slot = st.empty()
+                summary_slot = st.empty()
+                gaps_slot = st.empty()
+                covered_slot = st.empty()
+            
+            def show_streamed_field(key, value):
+                wait_slot.empty()
+                if key == 'plain_summary':
+                    summary_slot.info(value)
+                elif key == 'gap_alerts' and value:
+                    with gaps_slot.container():
+                        st.markdown("**Coverage Gaps Detected**")
+                        render_gap_alerts(value)
+                elif key == 'covered_items':
+                    # Preview only; the complete response is validated once it has arrived
+                    covered_df = build_covered_items_frame(load_covered_items(value))
+                    if covered_df is not None:
+                        covered_slot.dataframe(covered_df, use_container_width=True, hide_index=True)
+            
+            result = evaluate_with_profile(get_session_policy_profile(client), scenario)
+            cached, error, job_id = False, None, None
+            analysis_source = "profile" if result else "ai"
+            if result is None and ANALYSIS_JOB_QUEUE:
+                # The worker saves the analysis itself; this session only polls for it
+                policy_context = get_policy_context(get_policy_sections(), scenario)
+                result = lookup_cached_analysis(st.session_state.file_hash, scenario, policy_context)
+                cached = result is not None
+                if result is None:
+                    job_id, error = enqueue_analysis_job(
+                        st.session_state.user_id, st.session_state.file_id, st.session_state.file_hash,
+                        scenario, policy_context
+                    )
+            elif result is None:
+                with st.spinner("Decoding your policy... This may take a moment."):
+                    result, cached, error = analyze_policy_cached(
+                        client, st.session_state.file_id, st.session_state.file_hash, scenario,
+                        on_field=show_streamed_field, policy_sections=get_policy_sections(),
+                        on_wait=show_wait_status(wait_slot)
+                    )
+            preview.empty()
+            
+            if job_id:
+                st.session_state.active_job_id = job_id
+                st.session_state.pop('analysis_result', None)
+                st.rerun()
+            
+            if error:
+                st.error(f"Analysis failed: {error}")
+            else:
+                if cached:
+                    st.toast("Loaded a saved analysis of this policy.")
+                st.session_state.analysis_result = result
+                st.session_state.analyzed_scenario = scenario
+                st.session_state.analysis_source = analysis_source
                 
-                if error:
-                    st.error(f"Analysis failed: {error}")
-                else:
-                    st.session_state.analysis_result = result
-                    st.session_state.analyzed_scenario = scenario
-                    
-                    out_of_pocket = result.get('total_out_of_pocket')
-                    gap_alerts = result.get('gap_alerts', [])
-                    
-                    save_analysis(
+                # Saved in the background; the result is shown now either way
+                save_error = queue_analysis(
+                    user_id=st.session_state.user_id,
+                    scenario=scenario,
+                    file_id=st.session_state.file_id,
+                    result=result,
+                    prompt_version=result_prompt_version(analysis_source, scenario)
+                )
+                if save_error:
+                    st.error(save_error)
+    
+    if st.session_state.get('active_job_id'):
+        show_job_progress(scenario_icons)
+    if 'job_error' in st.session_state:
+        st.error(f"Analysis failed: {st.session_state.pop('job_error')}")
+    
+    if 'file_id' in st.session_state:
+        if st.button("Analyze All Scenarios", key="analyze_all_btn", use_container_width=True):
+            scenario_list = [s for s in SCENARIOS if s != "Select a scenario..."]
+            st.session_state.all_scenario_results = {}
+            st.session_state.all_scenario_errors = {}
+            st.session_state.all_scenario_sources = {}
+            st.session_state.all_scenario_save_errors = []
+            
+            with st.container(border=True):
+                st.markdown("""
+                    <div class="section-header results-section">
+                        <span class="section-icon">🧭</span>
+                        <span class="section-title">All Scenarios</span>
+                    </div>
+                """, unsafe_allow_html=True)
+                cols = st.columns(3)
+                placeholders = {}
+                for idx, scenario_name in enumerate(scenario_list):
+                    placeholders[scenario_name] = cols[idx % 3].empty()
+                    render_scenario_card(placeholders[scenario_name], scenario_name,
+                                         scenario_icons.get(scenario_name, "🔍"))
+                
+                # Cards fill in as each concurrent analysis finishes
+                for scenario_name, result, source, error in analyze_all_scenarios(
+                    client, st.session_state.file_id, st.session_state.file_hash, scenario_list,
+                    policy_sections=get_policy_sections(), profile=get_session_policy_profile(client)
+                ):
+                    render_scenario_card(placeholders[scenario_name], scenario_name,
+                                         scenario_icons.get(scenario_name, "🔍"), result, error)
+                    if error:
+                        st.session_state.all_scenario_errors[scenario_name] = error
+                        continue
+                    st.session_state.all_scenario_results[scenario_name] = result
+                    st.session_state.all_scenario_sources[scenario_name] = source
+                    save_error = queue_analysis(
                         user_id=st.session_state.user_id,
-                        scenario=scenario,
+                        scenario=scenario_name,
                         file_id=st.session_state.file_id,
-                        response_json=json.dumps(result),
-                        out_of_pocket=out_of_pocket,
-                        gap_alerts=gap_alerts
+                        result=result,
+                        prompt_version=result_prompt_version(source, scenario_name)
                     )
+                    if save_error:
+                        # Shown after the rerun below, which clears this run's output
+                        st.session_state.all_scenario_save_errors.append(save_error)
+            st.rerun()
+    
+    if st.session_state.get('all_scenario_results') or st.session_state.get('all_scenario_errors'):
+        all_results = st.session_state.get('all_scenario_results', {})
+        with st.container(border=True):
+            st.markdown("""
+                <div class="section-header results-section">
+                    <span class="section-icon">🧭</span>
+                    <span class="section-title">All Scenarios</span>
+                </div>
+            """, unsafe_allow_html=True)
+            ordered = {s: all_results[s] for s in SCENARIOS if s in all_results}
+            cols = st.columns(3)
+            for idx, (scenario_name, result) in enumerate(ordered.items()):
+                with cols[idx % 3]:
+                    render_scenario_card(st, scenario_name, scenario_icons.get(scenario_name, "🔍"), result)
+                    if st.button("View details", key=f"all_view_{idx}", use_container_width=True):
+                        st.session_state.analysis_result = result
+                        st.session_state.analyzed_scenario = scenario_name
+                        st.session_state.analysis_source = st.session_state.all_scenario_sources.get(scenario_name, "ai")
+                        st.rerun()
+            
+            for scenario_name, error in st.session_state.get('all_scenario_errors', {}).items():
+                st.warning(f"{scenario_name}: analysis failed ({error})")
+            for save_error in st.session_state.get('all_scenario_save_errors', []):
+                st.error(save_error)
+            
+            if ordered:
+                st.markdown("**Scenario Comparison**")
+                st.dataframe(build_scenario_matrix(ordered), use_container_width=True, hide_index=True)
     
     if 'analysis_result' in st.session_state:
         result = st.session_state.analysis_result
         scenario_name = st.session_state.analyzed_scenario
         scenario_icon = scenario_icons.get(scenario_name, "📊")
+        from_history = st.session_state.get('analysis_source') == "history"
+        result_file_id = st.session_state.get('history_file_id') if from_history else None
         
         with st.container(border=True):
             st.markdown(f"""
@@ -1806,35 +2225,43 @@ def show_main_app():
                     <span class="section-title">Analysis Results: {scenario_name}</span>
                 </div>
             """, unsafe_allow_html=True)
+            if st.session_state.get('analysis_source') == "profile":
+                st.caption("Instant estimate from your policy's deductibles, limits and exclusions, applied to a typical loss for this scenario.")
+            elif from_history:
+                st.caption(f"Saved analysis from {st.session_state.history_saved_at.strftime('%Y-%m-%d %H:%M')}.")
             
+            gaps = result.gap_alerts
+            metrics = summarize_result_metrics(result, result_file_id)
             col1, col2, col3 = st.columns(3)
             
             with col1:
-                out_of_pocket = result.get('total_out_of_pocket', 'N/A')
-                if isinstance(out_of_pocket, (int, float)):
+                if metrics['out_of_pocket'] is not None:
                     st.metric(
                         label="Estimated Out-of-Pocket",
-                        value=f"${out_of_pocket:,.0f}"
+                        value=f"${metrics['out_of_pocket']:,.0f}"
                     )
                 else:
                     st.metric(label="Estimated Out-of-Pocket", value="Unknown")
+                # The analysis' own total is not folded in; a mismatch with the
+                # covered items is shown instead
+                if abs(metrics['discrepancy']) >= 1:
+                    st.caption(f"The analysis estimated ${metrics['stated_out_of_pocket']:,.0f}, "
+                               f"${abs(metrics['discrepancy']):,.0f} {'more' if metrics['discrepancy'] > 0 else 'less'} "
+                               f"than the covered items add up to.")
             
             with col2:
-                gaps = result.get('gap_alerts', [])
-                health_score = max(0, 100 - (len(gaps) * 20))
                 st.metric(
                     label="Policy Health Score",
-                    value=f"{health_score}/100",
+                    value=f"{metrics['health_score']}/100",
                     delta=f"{len(gaps)} gaps" if gaps else "No gaps!",
                     delta_color="off" if gaps else "normal"
                 )
             
             with col3:
-                deductible = result.get('deductible', 'N/A')
-                if isinstance(deductible, (int, float)):
+                if metrics['deductible'] is not None:
                     st.metric(
                         label="Policy Deductible",
-                        value=f"${deductible:,.0f}"
+                        value=f"${metrics['deductible']:,.0f}"
                     )
                 else:
                     st.metric(label="Policy Deductible", value="N/A")
@@ -1847,54 +2274,37 @@ def show_main_app():
                         <span class="section-title">Coverage Gaps Detected</span>
                     </div>
                 """, unsafe_allow_html=True)
-                for gap in gaps:
-                    st.markdown(f"""
-                        <div class="gap-alert">
-                            <span class="gap-alert-icon">🚨</span>
-                            <span class="gap-alert-text">{gap}</span>
-                        </div>
-                    """, unsafe_allow_html=True)
+                render_gap_alerts(gaps)
         else:
             st.success("No major coverage gaps detected for this scenario!")
         
         with st.expander("Covered Items", expanded=True):
-            covered = result.get('covered_items', [])
+            covered = result.covered_items
             if covered:
-                df_data = []
-                for item in covered:
-                    if isinstance(item, dict):
-                        df_data.append({
-                            "Item": item.get('item', 'N/A'),
-                            "Est. Replacement": f"${item.get('est_replacement_cost', 0):,.0f}",
-                            "Depreciation": f"{item.get('depreciation_pct', 0)}%",
-                            "ACV Payout": f"${item.get('acv_payout', 0):,.0f}"
-                        })
-                if df_data:
-                    st.dataframe(pd.DataFrame(df_data), use_container_width=True, hide_index=True)
+                covered_df = build_covered_items_frame(covered)
+                if covered_df is not None:
+                    st.dataframe(covered_df, use_container_width=True, hide_index=True)
                 else:
                     st.info("No specific covered items identified.")
             else:
                 st.info("No covered items identified for this scenario.")
         
+        show_what_if(result, scenario_name, result_file_id)
+        
         with st.expander("Not Covered", expanded=True):
-            not_covered = result.get('not_covered_items', [])
-            if not_covered:
-                for item in not_covered:
-                    if isinstance(item, str):
-                        st.error(f"• {item}")
-                    elif isinstance(item, dict):
-                        st.error(f"• {item.get('item', item)}")
+            if result.not_covered_items:
+                for item in result.not_covered_items:
+                    st.error(f"• {item}")
             else:
                 st.success("All typical items appear to be covered!")
         
         with st.expander("Summary & Recommendations"):
             st.markdown("**Plain Language Summary**")
-            st.info(result.get('plain_summary', 'No summary available.'))
+            st.info(result.plain_summary)
             
             st.markdown("**Recommendations**")
-            recommendations = result.get('recommendations', [])
-            if recommendations:
-                for rec in recommendations:
+            if result.recommendations:
+                for rec in result.recommendations:
                     st.markdown(f"• {rec}")
             else:
                 st.info("No specific recommendations at this time.")
@@ -1907,7 +2317,14 @@ def show_main_app():
             </div>
         """, unsafe_allow_html=True)
         
-        user_analyses = get_user_analyses(st.session_state.user_id)
+        col_scenario, col_dates = st.columns(2)
+        history_scenario = col_scenario.selectbox(
+            "Scenario", ["All scenarios"] + [s for s in SCENARIOS if s != "Select a scenario..."],
+            key="history_scenario"
+        )
+        history_dates = col_dates.date_input("Date range", value=(), key="history_dates")
+        filters = history_filters(history_scenario, history_dates)
+        user_analyses = get_history_rows(filters)
         if user_analyses:
             history_data = []
             for analysis in user_analyses:
@@ -1916,7 +2333,30 @@ def show_main_app():
                     "Scenario": analysis.scenario,
                     "Out-of-Pocket": f"${float(analysis.out_of_pocket_estimate):,.0f}" if analysis.out_of_pocket_estimate else "N/A"
                 })
-            st.dataframe(pd.DataFrame(history_data), use_container_width=True, hide_index=True)
+            # A new first page gets a new table, so a selection never points at a shifted row
+            history_event = st.dataframe(
+                pd.DataFrame(history_data), use_container_width=True, hide_index=True,
+                on_select="rerun", selection_mode="single-row", key=f"history_table_{st.session_state.history_version}"
+            )
+            selected_rows = history_event.selection.rows
+            selected = user_analyses[selected_rows[0]] if selected_rows else None
+            selected_id = selected.id if selected else None
+            if selected_id != st.session_state.get('history_selected_id'):
+                st.session_state.history_selected_id = selected_id
+                if selected is not None:
+                    open_saved_analysis(selected.id, selected.upload_timestamp)
+            st.caption("Select a row to reopen that analysis.")
+            col_more, col_export = st.columns(2)
+            if st.session_state.history_has_more:
+                col_more.button("Load more", key="history_load_more", use_container_width=True,
+                                on_click=load_more_history, args=(user_analyses, filters))
+            col_export.download_button(
+                "Export CSV", data=export_history_csv(st.session_state.user_id, filters),
+                file_name="polisee-analysis-history.csv", mime="text/csv",
+                key="history_export", use_container_width=True
+            )
+        elif filters["scenario"] or filters["since"]:
+            st.info("No analyses match these filters.")
         else:
             st.info("No analysis history yet. Upload a policy to get started!")
     
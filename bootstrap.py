@@ -0,0 +1,77 @@
+import os
+import time
+import logging
+import argparse
+
+from models import engine, Base
+from migrations import apply_migrations, pending_migrations
+from partitions import ensure_partitions
+
+# Once-per-process startup work, kept out of the script Streamlit re-executes
+# on every interaction: app.py runs bootstrap() through st.cache_resource, so
+# a rerun no longer takes the migration lock or inspects the schema. Deploys
+# that migrate in a separate step set STARTUP_MIGRATIONS=0; the app then only
+# checks that no migration is pending.
+#
+#   python bootstrap.py            # pre-deploy: apply migrations, create partitions
+#   python bootstrap.py --check    # exit non-zero while migrations are pending
+
+logger = logging.getLogger(__name__)
+
+# Set to 0 when migrations run as a pre-deploy command instead of at app startup
+STARTUP_MIGRATIONS = os.getenv("STARTUP_MIGRATIONS", "1") == "1"
+
+
+def bootstrap(migrate=STARTUP_MIGRATIONS):
+    # Returns ([(step, seconds)], error); error when migrations are pending
+    # and left to the deploy step
+    timings = []
+    started = time.monotonic()
+
+    def step(name):
+        nonlocal started
+        now = time.monotonic()
+        timings.append((name, now - started))
+        started = now
+
+    if migrate:
+        apply_migrations(engine, Base.metadata)
+        step("migrations")
+    else:
+        pending = pending_migrations(engine)
+        step("schema check")
+        if pending:
+            return timings, (f"Database schema is out of date: migration(s) {', '.join(map(str, pending))} pending. "
+                             f"Run `python bootstrap.py` before starting the app.")
+    ensure_partitions(engine)
+    step("partitions")
+    logger.info(f"Startup finished: {format_startup(timings)}")
+    return timings, None
+
+
+def format_startup(timings):
+    steps = ", ".join(f"{name} {seconds * 1000:.0f} ms" for name, seconds in timings)
+    return f"{steps}; {sum(seconds for _, seconds in timings) * 1000:.0f} ms total"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply migrations and create partitions before the app starts")
+    parser.add_argument("--check", action="store_true", help="only check that no migration is pending")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    if args.check:
+        pending = pending_migrations(engine)
+        if pending:
+            raise SystemExit(f"Pending migration(s): {', '.join(map(str, pending))}")
+        print("Schema is up to date")
+        return
+    timings, _ = bootstrap(migrate=True)
+    print(f"Bootstrap complete: {format_startup(timings)}")
+
+
+if __name__ == "__main__":
+    main()
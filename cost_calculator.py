@@ -0,0 +1,132 @@
+import numpy as np
+import pandas as pd
+
+ITEM_COLUMNS = ["item", "est_replacement_cost", "depreciation_pct"]
+
+# Coverage A-D limits together bound what a single property loss can pay
+PROPERTY_LIMIT_KEYS = ["a_dwelling", "b_other_structures", "c_personal_property", "d_loss_of_use"]
+
+
+# covered_items are analysis_result.CoveredItem; acv_payout is None in results
+# stored without it
+def covered_items_frame(covered_items):
+    rows = [(item.item, item.est_replacement_cost, item.depreciation_pct, item.acv_payout)
+            for item in covered_items or []]
+    items = pd.DataFrame(rows, columns=ITEM_COLUMNS + ["stated_acv"]).astype(
+        {"est_replacement_cost": float, "depreciation_pct": float, "stated_acv": float}
+    )
+    items["est_replacement_cost"] = items["est_replacement_cost"].clip(lower=0)
+    items["depreciation_pct"] = items["depreciation_pct"].clip(0, 100)
+    # A stated payout below replacement cost less depreciation is a special
+    # limit or sublimit (jewelry, cash, ...), which recomputed payouts keep
+    stated_acv = items.pop("stated_acv").clip(lower=0)
+    own_acv = items["est_replacement_cost"] * (1.0 - items["depreciation_pct"] / 100.0)
+    items["payout_limit"] = stated_acv.where(stated_acv < own_acv)
+    return items
+
+
+def property_coverage_limit(profile):
+    limits = (profile or {}).get("coverage_limits") or {}
+    values = [limits.get(key) for key in PROPERTY_LIMIT_KEYS]
+    values = [value for value in values if isinstance(value, (int, float))]
+    return float(sum(values)) if values else None
+
+
+def calculate_costs(items, deductible, coverage_limit=None, depreciation_pct=None,
+                    cost_multiplier=1.0, other_costs=0.0):
+    # other_costs are losses the homeowner pays outside the covered items (the
+    # analysis' whole estimate when it lists none); they scale with repair
+    # costs, are never paid and are not part of total_loss, the itemized loss
+    replacement = items["est_replacement_cost"].to_numpy(dtype=float) * cost_multiplier
+    if depreciation_pct is None:
+        depreciation = items["depreciation_pct"].to_numpy(dtype=float)
+    else:
+        depreciation = np.full(len(items), float(depreciation_pct))
+    acv = replacement * (1.0 - np.clip(depreciation, 0, 100) / 100.0)
+    acv = np.fmin(acv, items["payout_limit"].to_numpy(dtype=float) * cost_multiplier)
+
+    covered_value = acv.sum()
+    if coverage_limit is not None:
+        covered_value = min(covered_value, coverage_limit)
+    insurer_payout = max(0.0, covered_value - max(0.0, deductible or 0.0))
+    other = max(0.0, other_costs) * cost_multiplier
+    total_loss = replacement.sum()
+
+    return {
+        "items": items.assign(est_replacement_cost=replacement, depreciation_pct=depreciation, acv_payout=acv),
+        "total_replacement": float(replacement.sum()),
+        "total_acv": float(acv.sum()),
+        "insurer_payout": float(insurer_payout),
+        "other_costs": float(other),
+        "total_loss": float(total_loss),
+        "out_of_pocket": float(total_loss - insurer_payout + other),
+    }
+
+
+def baseline_costs(result, coverage_limit=None):
+    # Recomputes the covered items deterministically, so arithmetic slips in
+    # the model's totals never reach the user. The analysis' own
+    # total_out_of_pocket is kept apart: it is the out-of-pocket only when there
+    # are no covered items to recompute, and otherwise any difference from the
+    # computed figure is reported as a discrepancy rather than added to it.
+    items = covered_items_frame(result.covered_items)
+    deductible = result.deductible or 0.0
+    stated_out_of_pocket = result.total_out_of_pocket
+    if items.empty and stated_out_of_pocket is not None:
+        costs = calculate_costs(items, deductible, coverage_limit, other_costs=stated_out_of_pocket)
+    else:
+        costs = calculate_costs(items, deductible, coverage_limit)
+
+    costs["deductible"] = deductible
+    costs["stated_out_of_pocket"] = stated_out_of_pocket
+    # Positive when the analysis stated more than the covered items add up to
+    costs["discrepancy"] = (float(stated_out_of_pocket - costs["out_of_pocket"])
+                            if stated_out_of_pocket is not None and not items.empty else 0.0)
+    return costs
+
+
+def scenario_cost_matrix(results_by_scenario, coverage_limit=None):
+    # Same arithmetic as baseline_costs, run for every scenario at once
+    frames = []
+    for scenario, result in results_by_scenario.items():
+        frames.append(covered_items_frame(result.covered_items).assign(scenario=scenario))
+    scenarios = pd.DataFrame({
+        "scenario": list(results_by_scenario),
+        "deductible": [r.deductible for r in results_by_scenario.values()],
+        "stated_out_of_pocket": [r.total_out_of_pocket for r in results_by_scenario.values()],
+        "gap_count": [len(r.gap_alerts) for r in results_by_scenario.values()],
+    }, columns=["scenario", "deductible", "stated_out_of_pocket", "gap_count"]).astype(
+        {"deductible": float, "stated_out_of_pocket": float}
+    ).set_index("scenario")
+    if scenarios.empty:
+        return scenarios
+
+    items = pd.concat(frames, ignore_index=True) if frames else covered_items_frame([]).assign(scenario=[])
+    items["acv_payout"] = np.fmin(items["est_replacement_cost"] * (1.0 - items["depreciation_pct"] / 100.0),
+                                  items["payout_limit"])
+    totals = items.groupby("scenario")[["est_replacement_cost", "acv_payout"]].sum()
+    totals["item_count"] = items.groupby("scenario").size()
+    scenarios = scenarios.join(totals).fillna({"est_replacement_cost": 0.0, "acv_payout": 0.0, "item_count": 0})
+
+    covered_value = scenarios["acv_payout"]
+    if coverage_limit is not None:
+        covered_value = covered_value.clip(upper=coverage_limit)
+    insurer_payout = (covered_value - scenarios["deductible"].fillna(0.0).clip(lower=0)).clip(lower=0)
+    covered_out_of_pocket = scenarios["est_replacement_cost"] - insurer_payout
+    has_items = scenarios.pop("item_count") > 0
+    scenarios["out_of_pocket"] = covered_out_of_pocket.where(has_items, scenarios["stated_out_of_pocket"])
+    scenarios["discrepancy"] = (scenarios["stated_out_of_pocket"] - covered_out_of_pocket).where(has_items, 0.0).fillna(0.0)
+    scenarios["total_loss"] = scenarios["est_replacement_cost"]
+    scenarios["health_score"] = health_scores(scenarios["gap_count"], scenarios["out_of_pocket"], scenarios["total_loss"])
+    return scenarios
+
+
+def health_scores(gap_count, out_of_pocket, total_loss):
+    # 20 points per coverage gap, plus up to 30 points for the share of the
+    # loss the homeowner pays; works on scalars or Series
+    gap_count = np.asarray(gap_count, dtype=float)
+    out_of_pocket = np.asarray(out_of_pocket, dtype=float)
+    total_loss = np.asarray(total_loss, dtype=float)
+    share = np.divide(out_of_pocket, total_loss, out=np.zeros_like(out_of_pocket), where=total_loss > 0)
+    scores = np.clip(np.round(100 - 20 * gap_count - 30 * np.clip(share, 0, 1)), 0, 100).astype(int)
+    return scores if scores.ndim else int(scores)
@@ -0,0 +1,235 @@
+import os
+import time
+import logging
+import argparse
+import threading
+from collections import deque
+
+from sqlalchemy import event, exc, text
+from sqlalchemy.pool import QueuePool, NullPool
+
+# Connection pool settings for the shared engine in models.py, and per-process
+# pool metrics (checkout wait, connections in use, overflow, timeouts) for the
+# debug panel and load tests. Every app replica and worker has its own pool
+# against the same Postgres, so size DB_POOL_SIZE + DB_MAX_OVERFLOW times the
+# process count below max_connections:
+#
+#   python db_pool.py --replicas 4 --workers 2
+#
+# Behind PgBouncer in transaction pooling mode set DB_POOL_MODE=pgbouncer:
+# PgBouncer does the pooling, each checkout opens a fresh client connection,
+# and the statement timeout is set per transaction.
+
+logger = logging.getLogger(__name__)
+
+# queue: SQLAlchemy QueuePool; pgbouncer: NullPool for transaction pooling
+DB_POOL_MODE = os.getenv("DB_POOL_MODE", "queue")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+# Seconds a checkout waits for a free connection before failing
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+# Connections older than this are replaced on checkout; -1 keeps them forever
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+# always: ping on every checkout; idle: only connections idle longer than
+# DB_POOL_PING_IDLE_SECONDS; never: rely on DB_POOL_RECYCLE
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "idle")
+DB_POOL_PING_IDLE_SECONDS = float(os.getenv("DB_POOL_PING_IDLE_SECONDS", 60))
+# Server-side limit per statement; 0 disables it
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", 0))
+
+WAIT_WINDOW = 1000
+
+
+class PoolMetrics:
+    # Counters since process start; waits are the most recent WAIT_WINDOW checkouts
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.waits = deque(maxlen=WAIT_WINDOW)
+        self.checkouts = 0
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.overflow_events = 0
+        self.timeouts = 0
+        self.connects = 0
+        self.pings = 0
+        self.stale = 0
+
+    def record_wait(self, seconds, overflowed):
+        with self._lock:
+            self.waits.append(seconds)
+            self.checkouts += 1
+            if overflowed:
+                self.overflow_events += 1
+
+    def record_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def adjust_in_use(self, delta):
+        with self._lock:
+            self.in_use += delta
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+
+    def count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+
+_metrics = PoolMetrics()
+
+
+class _TimedCheckout:
+    # Times _do_get: waiting for a free connection, or opening a new one
+    def _do_get(self):
+        started = time.perf_counter()
+        overflow_before = self._current_overflow()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            _metrics.record_timeout()
+            raise
+        overflow = self._current_overflow()
+        _metrics.record_wait(time.perf_counter() - started, overflow > 0 and overflow > overflow_before)
+        return connection
+
+
+class InstrumentedQueuePool(_TimedCheckout, QueuePool):
+    def _current_overflow(self):
+        return self.overflow()
+
+
+class InstrumentedNullPool(_TimedCheckout, NullPool):
+    def _current_overflow(self):
+        return 0
+
+
+def engine_options():
+    # Keyword arguments for create_engine
+    if DB_POOL_MODE == "pgbouncer":
+        return {"poolclass": InstrumentedNullPool}
+    options = {
+        "poolclass": InstrumentedQueuePool,
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING == "always",
+    }
+    if DB_STATEMENT_TIMEOUT_MS:
+        options["connect_args"] = {"options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"}
+    return options
+
+
+def instrument_engine(engine):
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        _metrics.count("connects")
+
+    @event.listens_for(engine, "checkout")
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        checked_in_at = connection_record.info.get("checked_in_at")
+        if (DB_POOL_PRE_PING == "idle" and DB_POOL_MODE != "pgbouncer" and checked_in_at is not None
+                and time.monotonic() - checked_in_at > DB_POOL_PING_IDLE_SECONDS):
+            _metrics.count("pings")
+            try:
+                cursor = dbapi_connection.cursor()
+                cursor.execute("SELECT 1")
+                cursor.close()
+            except Exception:
+                # The pool discards this connection and checks out another
+                _metrics.count("stale")
+                raise exc.DisconnectionError()
+        _metrics.adjust_in_use(1)
+
+    @event.listens_for(engine, "checkin")
+    def on_checkin(dbapi_connection, connection_record):
+        connection_record.info["checked_in_at"] = time.monotonic()
+        _metrics.adjust_in_use(-1)
+
+    if DB_POOL_MODE == "pgbouncer" and DB_STATEMENT_TIMEOUT_MS:
+        # Session settings do not survive transaction pooling
+        @event.listens_for(engine, "begin")
+        def on_begin(conn):
+            conn.exec_driver_sql(f"SET LOCAL statement_timeout = {DB_STATEMENT_TIMEOUT_MS}")
+
+
+def _percentile_ms(values, share):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))] * 1000
+
+
+def pool_stats(engine):
+    with _metrics._lock:
+        waits = list(_metrics.waits)
+        stats = {
+            "mode": DB_POOL_MODE,
+            "checkouts": _metrics.checkouts,
+            "in_use": _metrics.in_use,
+            "peak_in_use": _metrics.peak_in_use,
+            "overflow_events": _metrics.overflow_events,
+            "timeouts": _metrics.timeouts,
+            "connects": _metrics.connects,
+            "pings": _metrics.pings,
+            "stale": _metrics.stale,
+        }
+    pool = engine.pool
+    stats.update({
+        "pool_size": pool.size() if isinstance(pool, QueuePool) else None,
+        "max_overflow": DB_MAX_OVERFLOW if isinstance(pool, QueuePool) else None,
+        "overflow": max(0, pool.overflow()) if isinstance(pool, QueuePool) else 0,
+        "wait_p50_ms": _percentile_ms(waits, 0.5),
+        "wait_p95_ms": _percentile_ms(waits, 0.95),
+        "wait_max_ms": max(waits) * 1000 if waits else None,
+    })
+    return stats
+
+
+def format_pool_stats(stats):
+    if stats["pool_size"] is None:
+        line = f"{stats['mode']} (no client pool); "
+    else:
+        line = f"size {stats['pool_size']} + overflow {stats['max_overflow']}; "
+    line += f"in use {stats['in_use']} (peak {stats['peak_in_use']}), {stats['checkouts']:,} checkouts"
+    if stats["wait_p50_ms"] is not None:
+        line += (f"; checkout wait p50 {stats['wait_p50_ms']:.1f}ms, p95 {stats['wait_p95_ms']:.1f}ms, "
+                 f"max {stats['wait_max_ms']:.1f}ms")
+    line += (f"; {stats['overflow_events']} overflow connections, {stats['timeouts']} timeouts, "
+             f"{stats['stale']} stale of {stats['pings']} pings")
+    return line
+
+
+def main():
+    from models import engine
+
+    parser = argparse.ArgumentParser(description="Check the pool settings against the server's connection limit")
+    parser.add_argument("--replicas", type=int, default=1, help="app processes at peak autoscale")
+    parser.add_argument("--workers", type=int, default=0, help="worker.py processes")
+    parser.add_argument("--other", type=int, default=5, help="connections for migrations, CLIs and admin")
+    args = parser.parse_args()
+
+    with engine.connect() as conn:
+        max_connections = int(conn.execute(text("SHOW max_connections")).scalar())
+        reserved = int(conn.execute(text("SHOW superuser_reserved_connections")).scalar())
+        active = conn.execute(text("SELECT count(*) FROM pg_stat_activity WHERE backend_type = 'client backend'")).scalar()
+    available = max_connections - reserved
+    print(f"Server: max_connections {max_connections}, {reserved} reserved, {active} client connections open")
+    if DB_POOL_MODE == "pgbouncer":
+        print("DB_POOL_MODE=pgbouncer: the client side holds no pool; size PgBouncer's default_pool_size "
+              f"to at most {available - args.other}")
+        return
+    per_process = DB_POOL_SIZE + DB_MAX_OVERFLOW
+    demand = (args.replicas + args.workers) * per_process + args.other
+    print(f"Per process: {DB_POOL_SIZE} + {DB_MAX_OVERFLOW} overflow = {per_process}")
+    print(f"Peak demand: ({args.replicas} replicas + {args.workers} workers) x {per_process} + {args.other} = {demand}")
+    if demand > available:
+        processes = args.replicas + args.workers
+        print(f"Over the limit by {demand - available}: lower DB_POOL_SIZE/DB_MAX_OVERFLOW to at most "
+              f"{max(1, (available - args.other) // processes)} connections per process, or use PgBouncer")
+        raise SystemExit(1)
+    print(f"OK: {available - demand} connections to spare")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+import os
+import time
+import logging
+import argparse
+import threading
+from datetime import datetime, timedelta
+
+from openai import NotFoundError
+from sqlalchemy import text, exists, and_, or_
+from sqlalchemy.exc import IntegrityError
+
+from models import init_db, engine, SessionLocal, PolicyFile, AnalysisJob, ReanalysisBatch, ReanalysisItem
+from openai_scheduler import openai_request, PRIORITY_BACKGROUND
+from pdf_upload import purge_finished_uploads
+
+# Lifecycle of the files PoliSee keeps at OpenAI. policy_files is the registry
+# of uploaded policy PDFs; the sweeper deletes files nobody has used for
+# FILE_IDLE_DAYS, and reconciles the registry with the provider's file list:
+# registry rows whose file has disappeared stop being reused, and files the
+# registry does not know (failed registrations, old batch input/output) are
+# deleted. Deletes go through openai_scheduler at background priority.
+#
+#   python file_registry.py --dry-run
+
+logger = logging.getLogger(__name__)
+
+FILE_IDLE_DAYS = float(os.getenv("FILE_IDLE_DAYS", 30))
+# Most files deleted per sweep, so a large backlog is worked off gradually
+FILE_SWEEP_BATCH_SIZE = int(os.getenv("FILE_SWEEP_BATCH_SIZE", 200))
+# Seconds between sweeps in the app and worker processes; 0 disables the thread
+FILE_SWEEP_INTERVAL_SECONDS = int(os.getenv("FILE_SWEEP_INTERVAL_SECONDS", 3600))
+# Set to 0 if the OpenAI project is shared with other applications, whose files
+# would otherwise look unreferenced
+FILE_RECONCILE_DELETE_ORPHANS = os.getenv("FILE_RECONCILE_DELETE_ORPHANS", "1") == "1"
+
+FILE_LIST_PAGE_SIZE = 1000
+# Purposes of the files PoliSee creates; anything else is never touched
+MANAGED_PURPOSES = {"assistants", "batch", "batch_output"}
+# Uploads are registered just after they finish, and listings can lag behind;
+# younger files are left for the next sweep
+RECONCILE_GRACE = timedelta(hours=1)
+# pg_try_advisory_xact_lock key: one sweep at a time across every replica and worker
+SWEEP_LOCK_KEY = 7340211
+
+
+def find_policy_file(content_hash):
+    db = SessionLocal()
+    try:
+        policy_file = db.query(PolicyFile).filter(
+            PolicyFile.content_hash == content_hash, PolicyFile.deleted_at.is_(None)
+        ).first()
+        if not policy_file:
+            return None
+        policy_file.last_used_at = datetime.utcnow()
+        db.commit()
+        return policy_file.file_id
+    except Exception as e:
+        db.rollback()
+        logger.warning(f"Policy file lookup failed for {content_hash[:12]}: {e}")
+        return None
+    finally:
+        db.close()
+
+
+def register_policy_file(client, content_hash, file_id, size_bytes):
+    db = SessionLocal()
+    try:
+        db.add(PolicyFile(content_hash=content_hash, file_id=file_id, size_bytes=size_bytes))
+        db.commit()
+        return file_id
+    except IntegrityError:
+        db.rollback()
+        # The document was uploaded before and its file swept; point the row at the new upload
+        now = datetime.utcnow()
+        revived = db.query(PolicyFile).filter(
+            PolicyFile.content_hash == content_hash, PolicyFile.deleted_at.isnot(None)
+        ).update({
+            PolicyFile.file_id: file_id,
+            PolicyFile.size_bytes: size_bytes,
+            PolicyFile.uploaded_at: now,
+            PolicyFile.last_used_at: now,
+            PolicyFile.deleted_at: None,
+        }, synchronize_session=False)
+        db.commit()
+        if revived:
+            return file_id
+        # Another session uploaded the same document first; keep theirs and drop our copy
+        existing_file_id = find_policy_file(content_hash)
+        if existing_file_id and existing_file_id != file_id:
+            error = delete_openai_file(client, file_id)
+            if error:
+                logger.warning(f"Failed to delete duplicate upload {file_id}: {error}")
+            return existing_file_id
+        return file_id
+    except Exception as e:
+        db.rollback()
+        logger.warning(f"Failed to register policy file {file_id}: {e}")
+        return file_id
+    finally:
+        db.close()
+
+
+def delete_openai_file(client, file_id):
+    # Returns an error message, or None once the file is gone
+    try:
+        with openai_request(PRIORITY_BACKGROUND) as request:
+            request.call(client.files.delete, file_id)
+        return None
+    except NotFoundError:
+        return None
+    except Exception as e:
+        return str(e)
+
+
+def list_openai_files(client):
+    files, after = [], None
+    while True:
+        params = {"limit": FILE_LIST_PAGE_SIZE, "order": "asc"}
+        if after:
+            params["after"] = after
+        with openai_request(PRIORITY_BACKGROUND) as request:
+            page = request.call(client.files.list, **params)
+        files.extend(page.data)
+        if not page.has_more or not page.data:
+            return files
+        after = page.data[-1].id
+
+
+def claim_idle_files(limit, dry_run=False):
+    # Marks up to limit idle files deleted and returns their ids. Files a queued
+    # job or an unapplied re-analysis batch still needs are kept. Rows are
+    # claimed before the OpenAI delete, so a session can no longer pick them up;
+    # a delete that then fails leaves an orphan the next reconcile removes.
+    now = datetime.utcnow()
+    in_use = or_(
+        exists().where(and_(AnalysisJob.file_id == PolicyFile.file_id,
+                            AnalysisJob.status.in_(("queued", "running")))),
+        exists().where(and_(ReanalysisItem.file_id == PolicyFile.file_id, ReanalysisItem.status == "pending")),
+    )
+    db = SessionLocal()
+    try:
+        rows = db.query(PolicyFile).filter(
+            PolicyFile.deleted_at.is_(None),
+            PolicyFile.last_used_at < now - timedelta(days=FILE_IDLE_DAYS),
+            ~in_use
+        ).order_by(PolicyFile.last_used_at).limit(limit).with_for_update(skip_locked=True, of=PolicyFile).all()
+        file_ids = [row.file_id for row in rows]
+        if dry_run:
+            db.rollback()
+            return file_ids
+        for row in rows:
+            row.deleted_at = now
+        db.commit()
+        return file_ids
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def reconcile_files(client, max_deletes, claimed=(), dry_run=False):
+    # Returns (registry rows marked lost, orphan file ids to delete); claimed
+    # are files this sweep already deletes
+    listed_at = datetime.utcnow()
+    files = list_openai_files(client)
+    provider_ids = {f.id for f in files}
+    cutoff = listed_at - RECONCILE_GRACE
+
+    db = SessionLocal()
+    try:
+        registry = db.query(PolicyFile).filter(PolicyFile.deleted_at.is_(None)).all()
+        known = {row.file_id for row in registry} | set(claimed)
+        for batch in db.query(ReanalysisBatch).filter(ReanalysisBatch.applied_at.is_(None)):
+            known.update(file_id for file_id in (batch.input_file_id, batch.output_file_id, batch.error_file_id)
+                         if file_id)
+
+        lost = [row for row in registry if row.file_id not in provider_ids and row.uploaded_at < cutoff]
+        for row in lost:
+            logger.warning(f"Policy file {row.file_id} ({row.content_hash[:12]}) is missing at OpenAI")
+            row.deleted_at = listed_at
+        if dry_run:
+            db.rollback()
+        else:
+            db.commit()
+    finally:
+        db.close()
+
+    orphans = []
+    if FILE_RECONCILE_DELETE_ORPHANS:
+        orphans = [f.id for f in files
+                   if f.id not in known and f.purpose in MANAGED_PURPOSES
+                   and datetime.utcfromtimestamp(f.created_at) < cutoff][:max_deletes]
+    return len(lost), orphans
+
+
+def sweep_files(client, max_deletes=FILE_SWEEP_BATCH_SIZE, reconcile=True, dry_run=False):
+    # Returns a stats dict, or None when another process is already sweeping
+    # The lock lasts until this transaction ends, so taking and releasing it
+    # happen on one server connection, also behind PgBouncer's transaction
+    # pooling. The transaction only holds the lock while the sweep runs.
+    with engine.begin() as lock_conn:
+        if not lock_conn.execute(text("SELECT pg_try_advisory_xact_lock(:key)"), {"key": SWEEP_LOCK_KEY}).scalar():
+            return None
+        stats = {"idle": 0, "lost": 0, "orphans": 0, "deleted": 0, "errors": 0, "upload_rows": 0}
+        if not dry_run:
+            stats["upload_rows"] = purge_finished_uploads()
+        to_delete = claim_idle_files(max_deletes, dry_run)
+        stats["idle"] = len(to_delete)
+        if reconcile and len(to_delete) < max_deletes:
+            stats["lost"], orphans = reconcile_files(client, max_deletes - len(to_delete), to_delete, dry_run)
+            stats["orphans"] = len(orphans)
+            to_delete += orphans
+        if dry_run:
+            return stats
+        for file_id in to_delete:
+            error = delete_openai_file(client, file_id)
+            if error:
+                stats["errors"] += 1
+                logger.warning(f"Failed to delete file {file_id}: {error}")
+            else:
+                stats["deleted"] += 1
+        return stats
+
+
+def _sweep_loop(client, interval, stop_event):
+    while not stop_event.wait(interval):
+        started = time.monotonic()
+        try:
+            stats = sweep_files(client)
+        except Exception as e:
+            logger.error(f"File sweep failed: {e}")
+            continue
+        if stats and (stats["deleted"] or stats["lost"] or stats["errors"]):
+            logger.info(f"File sweep in {time.monotonic() - started:.1f}s: {stats}")
+
+
+def start_file_sweeper(client, interval=FILE_SWEEP_INTERVAL_SECONDS, stop_event=None):
+    # Daemon thread that sweeps every interval seconds; returns None when disabled
+    if interval <= 0:
+        return None
+    thread = threading.Thread(target=_sweep_loop, args=(client, interval, stop_event or threading.Event()),
+                              name="file-sweeper", daemon=True)
+    thread.start()
+    return thread
+
+
+def main():
+    from analysis import get_openai_client
+
+    parser = argparse.ArgumentParser(description="Delete idle and unreferenced OpenAI files")
+    parser.add_argument("--max-deletes", type=int, default=FILE_SWEEP_BATCH_SIZE)
+    parser.add_argument("--no-reconcile", action="store_true", help="only sweep idle registry files")
+    parser.add_argument("--dry-run", action="store_true", help="report what would be deleted")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    init_db()
+    client = get_openai_client()
+    if not client:
+        raise SystemExit("OPENAI_API_KEY environment variable is required")
+    stats = sweep_files(client, args.max_deletes, not args.no_reconcile, args.dry_run)
+    if stats is None:
+        raise SystemExit("Another sweep is running")
+    print(stats)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+import os
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import tuple_
+from models import SessionLocal, AnalysisJob
+from analysis_result import load_analysis_result
+from storage import analysis_columns, build_analysis
+from rollups import record_analyses
+
+logger = logging.getLogger(__name__)
+
+# A running job whose worker has not finished it by then is assumed lost
+# (crashed or redeployed worker) and is queued again
+JOB_STALE_AFTER = timedelta(seconds=int(os.getenv("JOB_STALE_SECONDS", 600)))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 3))
+JOB_RETRY_BASE_SECONDS = int(os.getenv("JOB_RETRY_BASE_SECONDS", 10))
+
+# Finished jobs a user has not seen yet are shown again after a reconnect
+# for this long
+JOB_DELIVERY_WINDOW = timedelta(hours=24)
+
+
+def _job_snapshot(job):
+    return {
+        "id": job.id,
+        "user_id": job.user_id,
+        "file_id": job.file_id,
+        "content_hash": job.content_hash,
+        "scenario": job.scenario,
+        "policy_context": job.policy_context,
+        "status": job.status,
+        "attempts": job.attempts,
+        "error": job.error,
+        "result": load_analysis_result(job.result_json) if job.result_json else None,
+        "analysis_id": job.analysis_id,
+        "run_after": job.run_after,
+        "created_at": job.created_at,
+        "started_at": job.started_at,
+        "finished_at": job.finished_at,
+    }
+
+
+def enqueue_analysis_job(user_id, file_id, content_hash, scenario, policy_context=None):
+    db = SessionLocal()
+    try:
+        job = AnalysisJob(
+            user_id=user_id,
+            file_id=file_id,
+            content_hash=content_hash,
+            scenario=scenario,
+            policy_context=policy_context,
+            max_attempts=JOB_MAX_ATTEMPTS
+        )
+        db.add(job)
+        db.commit()
+        logger.info(f"Queued analysis job {job.id} for user {user_id}: {scenario}")
+        return job.id, None
+    except Exception as e:
+        db.rollback()
+        return None, f"Failed to queue analysis: {str(e)}"
+    finally:
+        db.close()
+
+
+def claim_next_job(worker_id):
+    # SKIP LOCKED lets any number of workers poll the same table without
+    # blocking on, or double-claiming, each other's rows
+    db = SessionLocal()
+    try:
+        job = db.query(AnalysisJob).filter(
+            AnalysisJob.status == "queued",
+            AnalysisJob.run_after <= datetime.utcnow()
+        ).order_by(AnalysisJob.run_after, AnalysisJob.id).with_for_update(skip_locked=True).first()
+        if not job:
+            db.rollback()
+            return None
+        job.status = "running"
+        job.attempts += 1
+        job.worker_id = worker_id
+        job.started_at = datetime.utcnow()
+        job.error = None
+        db.commit()
+        return _job_snapshot(job)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def complete_job(job_id, worker_id, result, prompt_version=None):
+    # The history row and the job state are written in one transaction, so a
+    # finished job always has its PolicyAnalysisResult
+    db = SessionLocal()
+    try:
+        job = db.query(AnalysisJob).filter(AnalysisJob.id == job_id).with_for_update().first()
+        if not job or job.status != "running" or job.worker_id != worker_id:
+            # Requeued as stale while this worker was still busy; the newer attempt wins
+            logger.warning(f"Discarding result for job {job_id}: no longer owned by {worker_id}")
+            db.rollback()
+            return False
+        columns = analysis_columns(result)
+        analysis = build_analysis(
+            db.connection(),
+            columns,
+            user_id=job.user_id,
+            scenario=job.scenario,
+            file_id=job.file_id,
+            prompt_version=prompt_version
+        )
+        db.add(analysis)
+        db.flush()
+        record_analyses(db.connection(), [{**columns, "scenario": job.scenario,
+                                           "upload_timestamp": analysis.upload_timestamp}])
+        job.analysis_id = analysis.id
+        job.result_json = columns["openai_response_json"]
+        job.status = "done"
+        job.finished_at = datetime.utcnow()
+        db.commit()
+        return True
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def fail_job(job_id, worker_id, error):
+    db = SessionLocal()
+    try:
+        job = db.query(AnalysisJob).filter(AnalysisJob.id == job_id).with_for_update().first()
+        if not job or job.status != "running" or job.worker_id != worker_id:
+            db.rollback()
+            return
+        job.error = error
+        if job.attempts < job.max_attempts:
+            delay = JOB_RETRY_BASE_SECONDS * (2 ** (job.attempts - 1))
+            job.status = "queued"
+            job.run_after = datetime.utcnow() + timedelta(seconds=delay)
+            logger.warning(f"Job {job_id} attempt {job.attempts} failed, retrying in {delay}s: {error}")
+        else:
+            job.status = "failed"
+            job.finished_at = datetime.utcnow()
+            logger.error(f"Job {job_id} failed after {job.attempts} attempts: {error}")
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def requeue_stale_jobs():
+    db = SessionLocal()
+    try:
+        stale_jobs = db.query(AnalysisJob).filter(
+            AnalysisJob.status == "running",
+            AnalysisJob.started_at < datetime.utcnow() - JOB_STALE_AFTER
+        ).with_for_update(skip_locked=True).all()
+        for job in stale_jobs:
+            job.error = f"Worker {job.worker_id} did not finish within {int(JOB_STALE_AFTER.total_seconds())}s"
+            if job.attempts < job.max_attempts:
+                job.status = "queued"
+                job.run_after = datetime.utcnow()
+            else:
+                job.status = "failed"
+                job.finished_at = datetime.utcnow()
+        db.commit()
+        if stale_jobs:
+            logger.warning(f"Recovered {len(stale_jobs)} stale analysis jobs")
+        return len(stale_jobs)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def get_job(job_id):
+    db = SessionLocal()
+    try:
+        job = db.query(AnalysisJob).filter(AnalysisJob.id == job_id).first()
+        return _job_snapshot(job) if job else None
+    finally:
+        db.close()
+
+
+def get_queue_position(job):
+    # 1 = next to be claimed; None once the job is no longer queued. Counts the
+    # queued jobs claim_next_job takes first, in its (run_after, id) order
+    if job["status"] != "queued":
+        return None
+    db = SessionLocal()
+    try:
+        ahead = db.query(AnalysisJob).filter(
+            AnalysisJob.status == "queued",
+            tuple_(AnalysisJob.run_after, AnalysisJob.id) < tuple_(job["run_after"], job["id"])
+        ).count()
+        return ahead + 1
+    finally:
+        db.close()
+
+
+def get_undelivered_jobs(user_id):
+    db = SessionLocal()
+    try:
+        jobs = db.query(AnalysisJob).filter(
+            AnalysisJob.user_id == user_id,
+            AnalysisJob.delivered_at.is_(None),
+            AnalysisJob.created_at >= datetime.utcnow() - JOB_DELIVERY_WINDOW
+        ).order_by(AnalysisJob.created_at.desc()).all()
+        return [_job_snapshot(job) for job in jobs]
+    finally:
+        db.close()
+
+
+def mark_job_delivered(job_id):
+    db = SessionLocal()
+    try:
+        db.query(AnalysisJob).filter(AnalysisJob.id == job_id).update(
+            {AnalysisJob.delivered_at: datetime.utcnow()}, synchronize_session=False
+        )
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.warning(f"Failed to mark job {job_id} delivered: {e}")
+    finally:
+        db.close()
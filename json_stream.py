@@ -0,0 +1,115 @@
+import json
+
+_WHITESPACE = " \t\r\n"
+
+
+class IncrementalJSONObjectParser:
+    # Parses a single JSON object as it streams in and reports each top-level
+    # field as soon as its value is complete. Nested values are returned whole.
+    
+    def __init__(self):
+        self.buffer = ""
+        self.pos = 0
+        self.state = "start"
+        self.fields = {}
+        self._key = None
+        self._token_start = None
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+    
+    @property
+    def done(self):
+        return self.state == "done"
+    
+    def feed(self, chunk):
+        self.buffer += chunk
+        completed = []
+        
+        while self.pos < len(self.buffer) and self.state != "done":
+            ch = self.buffer[self.pos]
+            state = self.state
+            
+            if state in ("start", "key", "colon", "value_start", "after_value") and ch in _WHITESPACE:
+                self.pos += 1
+                continue
+            
+            if state == "start":
+                if ch != "{":
+                    raise ValueError(f"Expected '{{' at position {self.pos}, got {ch!r}")
+                self.state = "key"
+            elif state == "key":
+                if ch == "}":
+                    self.state = "done"
+                elif ch == '"':
+                    self._token_start = self.pos
+                    self._escaped = False
+                    self.state = "key_string"
+                else:
+                    raise ValueError(f"Expected object key at position {self.pos}, got {ch!r}")
+            elif state == "key_string":
+                if self._string_closed(ch):
+                    self._key = json.loads(self.buffer[self._token_start:self.pos + 1])
+                    self.state = "colon"
+            elif state == "colon":
+                if ch != ":":
+                    raise ValueError(f"Expected ':' at position {self.pos}, got {ch!r}")
+                self.state = "value_start"
+            elif state == "value_start":
+                self._token_start = self.pos
+                self._escaped = False
+                if ch in "{[":
+                    self._depth = 1
+                    self._in_string = False
+                    self.state = "value_container"
+                elif ch == '"':
+                    self.state = "value_string"
+                else:
+                    self.state = "value_scalar"
+            elif state == "value_string":
+                if self._string_closed(ch):
+                    completed.append(self._complete_value(self.pos + 1))
+            elif state == "value_container":
+                if self._in_string:
+                    if self._string_closed(ch):
+                        self._in_string = False
+                elif ch == '"':
+                    self._in_string = True
+                    self._escaped = False
+                elif ch in "{[":
+                    self._depth += 1
+                elif ch in "}]":
+                    self._depth -= 1
+                    if self._depth == 0:
+                        completed.append(self._complete_value(self.pos + 1))
+            elif state == "value_scalar":
+                if ch in ",}" or ch in _WHITESPACE:
+                    # The delimiter belongs to the object, so re-read it as after_value
+                    completed.append(self._complete_value(self.pos))
+                    continue
+            elif state == "after_value":
+                if ch == ",":
+                    self.state = "key"
+                elif ch == "}":
+                    self.state = "done"
+                else:
+                    raise ValueError(f"Expected ',' or '}}' at position {self.pos}, got {ch!r}")
+            
+            self.pos += 1
+        
+        return completed
+    
+    def _string_closed(self, ch):
+        if self._escaped:
+            self._escaped = False
+        elif ch == "\\":
+            self._escaped = True
+        elif ch == '"':
+            return True
+        return False
+    
+    def _complete_value(self, end):
+        value = json.loads(self.buffer[self._token_start:end])
+        self.fields[self._key] = value
+        self.state = "after_value"
+        return self._key, value
@@ -0,0 +1,408 @@
+import os
+import io
+import sys
+import json
+import time
+import uuid
+import random
+import logging
+import argparse
+import threading
+from datetime import datetime
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from db_pool import pool_stats
+
+# Simulates N users going login -> upload -> analyze -> history against the
+# real database and, with --mock, a local mock OpenAI server. Reports per-stage
+# latency percentiles, throughput and database pool saturation.
+#
+#   python load_test.py --mock --users 25 --iterations 2 --json results.json
+
+logger = logging.getLogger("load_test")
+
+STAGES = ["login", "upload", "analyze", "history"]
+
+def blank_pdf():
+    # Smallest well-formed one-page PDF; it has no extractable text, so analyses
+    # take the full-file path like a scanned policy would
+    objects = [
+        b"<</Type/Catalog/Pages 2 0 R>>",
+        b"<</Type/Pages/Kids[3 0 R]/Count 1>>",
+        b"<</Type/Page/Parent 2 0 R/MediaBox[0 0 612 792]>>",
+    ]
+    pdf = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += b"%d 0 obj" % number + body + b"endobj\n"
+    xref_offset = len(pdf)
+    pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        pdf += b"%010d 00000 n \n" % offset
+    pdf += b"trailer<</Size %d/Root 1 0 R>>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref_offset)
+    return bytes(pdf)
+
+
+class PoolSampler:
+    # Samples checked-out connections so pool saturation shows up next to latency
+    def __init__(self, engine, interval=0.1):
+        self.engine = engine
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="pool-sampler", daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            stats = pool_stats(self.engine)
+            self.samples.append((stats["in_use"], stats["overflow"]))
+            self._stop.wait(self.interval)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def summary(self):
+        if not self.samples:
+            return {}
+        checked_out = np.array([sample[0] for sample in self.samples])
+        stats = pool_stats(self.engine)
+        # No client-side capacity with DB_POOL_MODE=pgbouncer
+        capacity = stats["pool_size"] + stats["max_overflow"] if stats["pool_size"] is not None else None
+        return {
+            "mode": stats["mode"],
+            "pool_size": stats["pool_size"],
+            "capacity": capacity,
+            "checked_out_max": int(checked_out.max()),
+            "checked_out_p95": float(np.percentile(checked_out, 95)),
+            "saturated_share": float((checked_out >= capacity).mean()) if capacity else None,
+            "overflow_max": int(max(sample[1] for sample in self.samples)),
+            "overflow_events": stats["overflow_events"],
+            "timeouts": stats["timeouts"],
+            "checkout_wait_p95_ms": stats["wait_p95_ms"],
+            "checkout_wait_max_ms": stats["wait_max_ms"],
+        }
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings = defaultdict(list)
+        self.errors = defaultdict(list)
+        self.completed_sessions = 0
+
+    def record(self, stage, seconds, error=None):
+        with self.lock:
+            if error:
+                self.errors[stage].append(error)
+            else:
+                self.timings[stage].append(seconds)
+
+    def stage_summary(self):
+        summary = {}
+        for stage in STAGES:
+            values = np.array(self.timings.get(stage, []))
+            summary[stage] = {
+                "count": int(values.size),
+                "errors": len(self.errors.get(stage, [])),
+                "p50": float(np.percentile(values, 50)) if values.size else None,
+                "p95": float(np.percentile(values, 95)) if values.size else None,
+                "p99": float(np.percentile(values, 99)) if values.size else None,
+                "max": float(values.max()) if values.size else None,
+            }
+        return summary
+
+
+def timed(recorder, stage, fn, *args, **kwargs):
+    started = time.perf_counter()
+    try:
+        result, error = fn(*args, **kwargs)
+    except Exception as e:
+        result, error = None, f"{type(e).__name__}: {e}"
+    recorder.record(stage, time.perf_counter() - started, error)
+    if error:
+        raise RuntimeError(f"{stage} failed: {error}")
+    return result
+
+
+def run_session(ctx, recorder, user_index, iteration):
+    from storage import register_user, authenticate_user, get_user_analyses
+    from analysis_writer import queue_analysis
+    from analysis import (get_or_upload_pdf, analyze_policy_cached, evaluate_with_profile,
+                          get_policy_context, analysis_prompt_version, PROFILE_RESULT_VERSION)
+    from policy_text import ingest_policy_pdf, full_policy_text
+    from pdf_upload import spool_pdf
+    from policy_profile import get_or_extract_policy_profile
+
+    email = f"loadtest+{ctx['run_id']}-{user_index}@example.com"
+    password = ctx["password"]
+
+    def login():
+        if iteration == 0:
+            _, error = register_user(email, password)
+            if error:
+                return None, error
+        return authenticate_user(email, password)
+
+    def upload():
+        pdf_bytes = ctx["pdf_bytes"]
+        if not ctx["shared_pdf"]:
+            # Unique bytes per session so every upload and analysis misses the caches
+            pdf_bytes += f"%loadtest {uuid.uuid4().hex}\n".encode("ascii")
+        # Same path as the app: spool to disk, extract text and upload from the file
+        with spool_pdf(io.BytesIO(pdf_bytes), "policy.pdf") as spooled:
+            content_hash = spooled.content_hash
+            with ctx["lock"]:
+                ctx["content_hashes"].add(content_hash)
+            policy_text = ingest_policy_pdf(spooled.path)
+            file_id, _, error = get_or_upload_pdf(ctx["client"], spooled)
+        return (file_id, content_hash, policy_text), error
+
+    def analyze(user_id, file_id, content_hash, policy_text):
+        sections = policy_text["sections"] if policy_text else None
+        profile = None
+        if ctx["use_profile"]:
+            profile, error = get_or_extract_policy_profile(ctx["client"], content_hash, file_id, full_policy_text(sections))
+            if error:
+                return None, error
+        for scenario in random.sample(ctx["scenarios"], ctx["scenarios_per_session"]):
+            result = evaluate_with_profile(profile, scenario)
+            prompt_version = PROFILE_RESULT_VERSION
+            if result is None:
+                result, _, error = analyze_policy_cached(ctx["client"], file_id, content_hash, scenario,
+                                                         policy_sections=sections)
+                if error:
+                    return None, error
+                prompt_version = analysis_prompt_version(get_policy_context(sections, scenario))
+            error = queue_analysis(user_id, scenario, file_id, result, prompt_version)
+            if error:
+                return None, error
+        return True, None
+
+    def history(user_id):
+        return get_user_analyses(user_id), None
+
+    try:
+        user = timed(recorder, "login", login)
+        file_id, content_hash, policy_text = timed(recorder, "upload", upload)
+        timed(recorder, "analyze", analyze, user.id, file_id, content_hash, policy_text)
+        timed(recorder, "history", history, user.id)
+        with recorder.lock:
+            recorder.completed_sessions += 1
+    except RuntimeError as e:
+        logger.warning(f"User {user_index} iteration {iteration}: {e}")
+
+
+def run_user(ctx, recorder, user_index):
+    time.sleep(ctx["ramp_seconds"] * user_index / max(1, ctx["users"]))
+    for iteration in range(ctx["iterations"]):
+        run_session(ctx, recorder, user_index, iteration)
+        if ctx["think_seconds"]:
+            time.sleep(random.uniform(0, 2 * ctx["think_seconds"]))
+
+
+def cleanup(ctx):
+    from sqlalchemy import func, tuple_
+    from models import (SessionLocal, User, PolicyAnalysisResult, AnalysisPayload, PolicyFile, PolicyProfile,
+                        AnalysisCacheEntry, AnalysisJob, ApiCallLog, FileUpload)
+    from rollups import rebuild_rollups
+    db = SessionLocal()
+    first_saved = None
+    try:
+        user_ids = [row.id for row in db.query(User.id).filter(User.email.like(f"loadtest+{ctx['run_id']}-%"))]
+        hashes = list(ctx["content_hashes"])
+        if user_ids:
+            first_saved = db.query(func.min(PolicyAnalysisResult.upload_timestamp)).filter(
+                PolicyAnalysisResult.user_id.in_(user_ids)).scalar()
+            db.query(AnalysisJob).filter(AnalysisJob.user_id.in_(user_ids)).delete(synchronize_session=False)
+            analyses = db.query(PolicyAnalysisResult.id, PolicyAnalysisResult.upload_timestamp).filter(
+                PolicyAnalysisResult.user_id.in_(user_ids))
+            db.query(AnalysisPayload).filter(
+                tuple_(AnalysisPayload.analysis_id, AnalysisPayload.upload_timestamp).in_(analyses)
+            ).delete(synchronize_session=False)
+            db.query(PolicyAnalysisResult).filter(PolicyAnalysisResult.user_id.in_(user_ids)).delete(synchronize_session=False)
+            db.query(User).filter(User.id.in_(user_ids)).delete(synchronize_session=False)
+        if hashes and not ctx["shared_pdf"]:
+            db.query(AnalysisCacheEntry).filter(AnalysisCacheEntry.content_hash.in_(hashes)).delete(synchronize_session=False)
+            db.query(PolicyProfile).filter(PolicyProfile.content_hash.in_(hashes)).delete(synchronize_session=False)
+            db.query(PolicyFile).filter(PolicyFile.content_hash.in_(hashes)).delete(synchronize_session=False)
+            db.query(FileUpload).filter(FileUpload.content_hash.in_(hashes)).delete(synchronize_session=False)
+            db.query(ApiCallLog).filter(ApiCallLog.content_hash.in_(hashes)).delete(synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+    # Takes the simulated analyses back out of the analytics rollups
+    if first_saved is not None:
+        rebuild_rollups(first_saved.date())
+
+
+def print_report(report):
+    print()
+    print(f"Users: {report['users']}  Iterations: {report['iterations']}  "
+          f"Sessions: {report['completed_sessions']}/{report['attempted_sessions']}  "
+          f"Elapsed: {report['elapsed_seconds']:.1f}s  "
+          f"Throughput: {report['sessions_per_minute']:.1f} sessions/min")
+    print()
+    print(f"{'stage':<10}{'count':>7}{'errors':>8}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    for stage, stats in report["stages"].items():
+        cells = [f"{stats[key]:>10.3f}" if stats[key] is not None else f"{'-':>10}" for key in ("p50", "p95", "p99", "max")]
+        print(f"{stage:<10}{stats['count']:>7}{stats['errors']:>8}{''.join(cells)}")
+    pool = report["db_pool"]
+    if pool:
+        print()
+        if pool["capacity"] is None:
+            print(f"DB pool: {pool['mode']}, peak checked out {pool['checked_out_max']} "
+                  f"(p95 {pool['checked_out_p95']:.1f})")
+        else:
+            print(f"DB pool: size {pool['pool_size']}, capacity {pool['capacity']}, "
+                  f"peak checked out {pool['checked_out_max']} (p95 {pool['checked_out_p95']:.1f}), "
+                  f"saturated {pool['saturated_share']:.0%} of samples, peak overflow {pool['overflow_max']}")
+        if pool["checkout_wait_p95_ms"] is not None:
+            print(f"DB checkout wait: p95 {pool['checkout_wait_p95_ms']:.1f}ms, "
+                  f"max {pool['checkout_wait_max_ms']:.1f}ms; {pool['overflow_events']} overflow connections, "
+                  f"{pool['timeouts']} timeouts")
+    print(f"Analysis writes: {report['analysis_writes_text']}")
+    print(f"OpenAI admission queue: peak waiting {report['openai_queue_peak_waiting']}")
+    print(f"Prompt cache: {report['prompt_cache_text']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PoliSee load test: login -> upload -> analyze -> history")
+    parser.add_argument("--users", type=int, default=10, help="concurrent simulated users")
+    parser.add_argument("--iterations", type=int, default=1, help="sessions per user")
+    parser.add_argument("--scenarios-per-session", type=int, default=1)
+    parser.add_argument("--ramp-seconds", type=float, default=5.0, help="spread user start times over this long")
+    parser.add_argument("--think-seconds", type=float, default=0.0, help="mean pause between a user's sessions")
+    parser.add_argument("--pdf", help="policy PDF to upload (default: a blank one-page PDF)")
+    parser.add_argument("--shared-pdf", action="store_true",
+                        help="every user uploads identical bytes, exercising file reuse and the analysis cache")
+    parser.add_argument("--no-profile", action="store_true", help="skip policy-profile extraction (AI analysis only)")
+    parser.add_argument("--mock", action="store_true", help="start mock_openai_server.py in-process and use it")
+    parser.add_argument("--mock-port", type=int, default=8765)
+    parser.add_argument("--mock-response-ms", type=int, default=8000, help="mock median analysis latency")
+    parser.add_argument("--mock-upload-ms", type=int, default=600, help="mock median upload latency")
+    parser.add_argument("--mock-error-rate", type=float, default=0.0, help="share of mock calls answered with 429")
+    parser.add_argument("--allow-real-api", action="store_true", help="permit running without a mock/OPENAI_BASE_URL")
+    parser.add_argument("--keep-data", action="store_true", help="leave load-test users and analyses in the database")
+    parser.add_argument("--json", help="write the report to this file for comparison across releases")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.WARNING,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
+    mock_server = None
+    if args.mock:
+        from mock_openai_server import start_mock_server
+        mock_server = start_mock_server(
+            args.mock_port, response_median_ms=args.mock_response_ms,
+            upload_median_ms=args.mock_upload_ms, error_rate=args.mock_error_rate
+        )
+        os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{args.mock_port}/v1"
+        os.environ.setdefault("OPENAI_API_KEY", "mock-key")
+    elif not os.getenv("OPENAI_BASE_URL") and not args.allow_real_api:
+        sys.exit("Refusing to load-test the real OpenAI API; use --mock, set OPENAI_BASE_URL, or pass --allow-real-api")
+
+    # Imported after OPENAI_BASE_URL is set, since analysis.py reads it at import
+    from models import init_db, engine
+    from analysis import get_openai_client
+    from openai_scheduler import admission_stats
+    from usage_log import prompt_cache_summary, format_cache_summary
+    from policy_text import SCENARIO_SECTIONS
+    from analysis_writer import flush_analyses, writer_stats, format_writer_stats
+
+    init_db()
+    client = get_openai_client()
+    if client is None:
+        sys.exit("OPENAI_API_KEY environment variable is required")
+
+    if args.pdf:
+        with open(args.pdf, "rb") as f:
+            pdf_bytes = f.read()
+    else:
+        pdf_bytes = blank_pdf()
+
+    ctx = {
+        "run_id": uuid.uuid4().hex[:8],
+        "password": uuid.uuid4().hex,
+        "client": client,
+        "pdf_bytes": pdf_bytes,
+        "shared_pdf": args.shared_pdf,
+        "use_profile": not args.no_profile,
+        "scenarios": list(SCENARIO_SECTIONS),
+        "scenarios_per_session": max(1, min(args.scenarios_per_session, len(SCENARIO_SECTIONS))),
+        "users": args.users,
+        "iterations": args.iterations,
+        "ramp_seconds": args.ramp_seconds,
+        "think_seconds": args.think_seconds,
+        "content_hashes": set(),
+        "lock": threading.Lock(),
+    }
+    recorder = Recorder()
+    sampler = PoolSampler(engine)
+    peak_waiting = 0
+    stop_queue_sampler = threading.Event()
+
+    def sample_queue():
+        nonlocal peak_waiting
+        while not stop_queue_sampler.is_set():
+            peak_waiting = max(peak_waiting, admission_stats()["waiting"])
+            stop_queue_sampler.wait(0.1)
+
+    queue_sampler = threading.Thread(target=sample_queue, daemon=True)
+    queue_sampler.start()
+    sampler.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.users, thread_name_prefix="user") as executor:
+        for user_index in range(args.users):
+            executor.submit(run_user, ctx, recorder, user_index)
+    elapsed = time.perf_counter() - started
+    # Rows still queued for the write-behind thread belong to this run
+    if not flush_analyses():
+        logger.warning("Analysis writes still pending after 30s")
+    sampler.stop()
+    stop_queue_sampler.set()
+    queue_sampler.join()
+
+    cache_summary = prompt_cache_summary(content_hashes=ctx["content_hashes"])
+    report = {
+        "run_id": ctx["run_id"],
+        "timestamp": datetime.utcnow().isoformat(),
+        "users": args.users,
+        "iterations": args.iterations,
+        "scenarios_per_session": ctx["scenarios_per_session"],
+        "mock": args.mock,
+        "attempted_sessions": args.users * args.iterations,
+        "completed_sessions": recorder.completed_sessions,
+        "elapsed_seconds": elapsed,
+        "sessions_per_minute": recorder.completed_sessions / elapsed * 60 if elapsed else 0.0,
+        "stages": recorder.stage_summary(),
+        "db_pool": sampler.summary(),
+        "analysis_writes": writer_stats(),
+        "analysis_writes_text": format_writer_stats(writer_stats()),
+        "openai_queue_peak_waiting": peak_waiting,
+        "prompt_cache": cache_summary,
+        "prompt_cache_text": format_cache_summary(cache_summary),
+        "sample_errors": {stage: errors[:5] for stage, errors in recorder.errors.items()},
+    }
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if not args.keep_data:
+        cleanup(ctx)
+    if mock_server:
+        mock_server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+import logging
+import argparse
+
+from sqlalchemy import text, inspect
+
+# Versioned schema changes for databases that already exist. A new database
+# gets the current schema from the models (create_all) and is stamped with
+# every version below; an existing one runs the versions it has not applied
+# yet, in order. Everything happens in one transaction under an advisory lock,
+# so app replicas and workers starting together apply each migration once and
+# a failed migration leaves the schema as it was.
+#
+# To change the schema, update the model and append a migration; never edit
+# or renumber one that has shipped.
+#
+#   python migrations.py --status
+
+logger = logging.getLogger(__name__)
+
+# pg_advisory_xact_lock key, held while migrating
+MIGRATION_LOCK_KEY = 7340212
+
+MIGRATIONS = [
+    # The model gained this column before migrations existed; builds from then
+    # until this list was added need it added by hand on an existing database
+    (1, "Add policy_analysis_results.prompt_version", [
+        "ALTER TABLE policy_analysis_results ADD COLUMN IF NOT EXISTS prompt_version VARCHAR(64)",
+    ]),
+    # Same gap as migration 1, from the file sweeper's build onwards
+    (2, "Add policy_files.deleted_at", [
+        "ALTER TABLE policy_files ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP",
+    ]),
+    # The history list reads one user's analyses newest first
+    (3, "Index policy_analysis_results on (user_id, upload_timestamp DESC)", [
+        "CREATE INDEX IF NOT EXISTS ix_policy_analysis_results_user_uploaded "
+        "ON policy_analysis_results (user_id, upload_timestamp DESC)",
+    ]),
+    # Login and registration match email addresses case-insensitively
+    (4, "Index users on lower(email)", [
+        "CREATE INDEX IF NOT EXISTS ix_users_email_lower ON users (lower(email))",
+    ]),
+    # History is paginated by a (upload_timestamp, id) cursor; the id tiebreaker
+    # joins the index so a page never sorts
+    (5, "Add id to the per-user history index", [
+        "CREATE INDEX IF NOT EXISTS ix_policy_analysis_results_user_uploaded_id "
+        "ON policy_analysis_results (user_id, upload_timestamp DESC, id DESC)",
+        "DROP INDEX IF EXISTS ix_policy_analysis_results_user_uploaded",
+    ]),
+    (6, "Index policy_analysis_results on (upload_timestamp DESC, id DESC)", [
+        "CREATE INDEX IF NOT EXISTS ix_policy_analysis_results_uploaded_id "
+        "ON policy_analysis_results (upload_timestamp DESC, id DESC)",
+    ]),
+    # Rebuilds the table range-partitioned by month (partitions.py); Postgres
+    # cannot partition a table in place. The copy holds the table lock for its
+    # whole duration, so run it in a maintenance window on a large table.
+    (7, "Partition policy_analysis_results by month of upload_timestamp", [
+        # Foreign keys to a partitioned table must include the partition key
+        "ALTER TABLE analysis_jobs DROP CONSTRAINT IF EXISTS analysis_jobs_analysis_id_fkey",
+        "ALTER TABLE policy_analysis_results RENAME TO policy_analysis_results_unpartitioned",
+        "ALTER TABLE policy_analysis_results_unpartitioned "
+        "RENAME CONSTRAINT policy_analysis_results_pkey TO policy_analysis_results_unpartitioned_pkey",
+        "DROP INDEX IF EXISTS ix_policy_analysis_results_id",
+        "DROP INDEX IF EXISTS ix_policy_analysis_results_user_uploaded_id",
+        "DROP INDEX IF EXISTS ix_policy_analysis_results_uploaded_id",
+        """
+        CREATE TABLE policy_analysis_results (
+            id INTEGER NOT NULL DEFAULT nextval('policy_analysis_results_id_seq'),
+            user_id INTEGER NOT NULL REFERENCES users (id),
+            upload_timestamp TIMESTAMP NOT NULL,
+            scenario TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            openai_response_json TEXT,
+            out_of_pocket_estimate NUMERIC,
+            gap_alerts TEXT,
+            prompt_version VARCHAR(64),
+            PRIMARY KEY (id, upload_timestamp)
+        ) PARTITION BY RANGE (upload_timestamp)
+        """,
+        "ALTER SEQUENCE policy_analysis_results_id_seq OWNED BY policy_analysis_results.id",
+        "CREATE TABLE policy_analysis_results_default PARTITION OF policy_analysis_results DEFAULT",
+        # One partition per month of existing rows, through the current month
+        """
+        DO $$
+        DECLARE
+            month DATE;
+        BEGIN
+            FOR month IN
+                SELECT generate_series(first_month, last_month, INTERVAL '1 month')::DATE
+                FROM (
+                    SELECT date_trunc('month', coalesce(min(upload_timestamp), now() AT TIME ZONE 'utc')) AS first_month,
+                           date_trunc('month', greatest(max(upload_timestamp), now() AT TIME ZONE 'utc')) AS last_month
+                    FROM policy_analysis_results_unpartitioned
+                ) bounds
+            LOOP
+                EXECUTE format('CREATE TABLE %I PARTITION OF policy_analysis_results FOR VALUES FROM (%L) TO (%L)',
+                               'policy_analysis_results_' || to_char(month, '"y"YYYY"m"MM'),
+                               month, (month + INTERVAL '1 month')::DATE);
+            END LOOP;
+        END $$
+        """,
+        "INSERT INTO policy_analysis_results "
+        "SELECT id, user_id, coalesce(upload_timestamp, now() AT TIME ZONE 'utc'), scenario, file_id, "
+        "openai_response_json, out_of_pocket_estimate, gap_alerts, prompt_version "
+        "FROM policy_analysis_results_unpartitioned",
+        "DROP TABLE policy_analysis_results_unpartitioned",
+        # Indexes are built once the rows are in, and cascade to every partition
+        "CREATE INDEX ix_policy_analysis_results_id ON policy_analysis_results (id)",
+        "CREATE INDEX ix_policy_analysis_results_user_uploaded_id "
+        "ON policy_analysis_results (user_id, upload_timestamp DESC, id DESC)",
+        "CREATE INDEX ix_policy_analysis_results_uploaded_id "
+        "ON policy_analysis_results (upload_timestamp DESC, id DESC)",
+        "ANALYZE policy_analysis_results",
+    ]),
+    # Moves the full responses into analysis_payloads (payloads.py), which
+    # create_all has just created, partitioned like policy_analysis_results.
+    # They are copied uncompressed; `python payloads.py --train --recompress`
+    # compresses them afterwards. The dropped columns' space is reclaimed as
+    # partitions are rewritten (VACUUM FULL) or archived.
+    (8, "Move analysis payloads to analysis_payloads and add gap_count", [
+        """
+        DO $$
+        DECLARE
+            part RECORD;
+        BEGIN
+            FOR part IN
+                SELECT child.relname, pg_get_expr(child.relpartbound, child.oid) AS bound
+                FROM pg_inherits
+                JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+                JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+                WHERE parent.relname = 'policy_analysis_results'
+            LOOP
+                EXECUTE format('CREATE TABLE IF NOT EXISTS %I PARTITION OF analysis_payloads %s',
+                               replace(part.relname, 'policy_analysis_results', 'analysis_payloads'), part.bound);
+            END LOOP;
+        END $$
+        """,
+        "INSERT INTO analysis_payloads (analysis_id, upload_timestamp, codec, size_bytes, data) "
+        "SELECT id, upload_timestamp, 'none', octet_length(openai_response_json), convert_to(openai_response_json, 'UTF8') "
+        "FROM policy_analysis_results WHERE openai_response_json IS NOT NULL",
+        "ALTER TABLE policy_analysis_results ADD COLUMN gap_count INTEGER NOT NULL DEFAULT 0",
+        # gap_alerts was whatever the model returned, JSON-encoded; anything but
+        # an array counts as no alerts
+        "UPDATE policy_analysis_results SET gap_count = CASE WHEN json_typeof(gap_alerts::json) = 'array' "
+        "THEN json_array_length(gap_alerts::json) ELSE 0 END WHERE gap_alerts IS NOT NULL",
+        "ALTER TABLE policy_analysis_results ALTER COLUMN gap_count DROP DEFAULT",
+        "ALTER TABLE policy_analysis_results DROP COLUMN openai_response_json, DROP COLUMN gap_alerts",
+        "ANALYZE policy_analysis_results",
+        "ANALYZE analysis_payloads",
+    ]),
+    # Never read: files expire by last_used_at (file_registry.py)
+    (9, "Drop policy_files.reference_count", [
+        "ALTER TABLE policy_files DROP COLUMN IF EXISTS reference_count",
+    ]),
+    # Emails are matched case-insensitively since migration 4; accounts that
+    # differ only by case would make a login pick one of them at random, so
+    # they have to be merged or renamed by hand before this can apply
+    (10, "Make the lower(email) index on users unique", [
+        """
+        DO $$
+        DECLARE
+            duplicates TEXT;
+        BEGIN
+            SELECT string_agg(format('%s (user ids %s)', email, ids), '; ') INTO duplicates
+            FROM (
+                SELECT lower(email) AS email, string_agg(id::text, ', ' ORDER BY id) AS ids
+                FROM users GROUP BY lower(email) HAVING count(*) > 1
+            ) case_variants;
+            IF duplicates IS NOT NULL THEN
+                RAISE EXCEPTION 'Accounts whose emails differ only by case must be merged or renamed first: %', duplicates;
+            END IF;
+        END $$
+        """,
+        "DROP INDEX IF EXISTS ix_users_email_lower",
+        "CREATE UNIQUE INDEX ix_users_email_lower ON users (lower(email))",
+    ]),
+]
+
+SCHEMA_MIGRATIONS_DDL = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    applied_at TIMESTAMP NOT NULL DEFAULT (now() at time zone 'utc')
+)
+"""
+
+
+def applied_versions(conn):
+    return {row[0] for row in conn.execute(text("SELECT version FROM schema_migrations"))}
+
+
+def pending_migrations(engine):
+    # Versions not applied yet, read without the migration lock
+    with engine.connect() as conn:
+        done = applied_versions(conn) if inspect(conn).has_table("schema_migrations") else set()
+    return [version for version, _, _ in MIGRATIONS if version not in done]
+
+
+def _record(conn, version, name):
+    conn.execute(text("INSERT INTO schema_migrations (version, name) VALUES (:version, :name)"),
+                 {"version": version, "name": name})
+
+
+def apply_migrations(engine, metadata):
+    # Returns the versions applied (or stamped on a new database)
+    with engine.begin() as conn:
+        conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+        # Index builds on large tables may outlast DB_STATEMENT_TIMEOUT_MS
+        conn.execute(text("SET LOCAL statement_timeout = 0"))
+        fresh = not inspect(conn).has_table("users")
+        conn.execute(text(SCHEMA_MIGRATIONS_DDL))
+        metadata.create_all(bind=conn)
+        done = applied_versions(conn)
+        pending = [migration for migration in MIGRATIONS if migration[0] not in done]
+        for version, name, statements in pending:
+            if fresh:
+                # create_all already built the current schema
+                _record(conn, version, name)
+                continue
+            logger.info(f"Applying migration {version}: {name}")
+            for statement in statements:
+                conn.execute(text(statement))
+            _record(conn, version, name)
+        if pending and fresh:
+            logger.info(f"New database: stamped migrations {pending[0][0]}-{pending[-1][0]}")
+        return [version for version, _, _ in pending]
+
+
+def main():
+    from models import engine, Base
+
+    parser = argparse.ArgumentParser(description="Apply pending schema migrations")
+    parser.add_argument("--status", action="store_true", help="list migrations without applying them")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    if args.status:
+        with engine.connect() as conn:
+            done = applied_versions(conn) if inspect(conn).has_table("schema_migrations") else set()
+        for version, name, _ in MIGRATIONS:
+            print(f"{version:>4}  {'applied' if version in done else 'pending':<8} {name}")
+        return
+    applied = apply_migrations(engine, Base.metadata)
+    print(f"Applied {len(applied)} migration(s)" if applied else "Schema is up to date")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,534 @@
+import re
+import json
+import math
+import time
+import uuid
+import hashlib
+import random
+import logging
+import argparse
+import threading
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# Local stand-in for the OpenAI endpoints PoliSee uses, for load tests that
+# should not spend API credit. It serves files.create, files.list and
+# files.delete, the Uploads API for large PDFs, and responses.create with and
+# without streaming. It also serves the Batch API used by reanalyze.py.
+#
+# Point the app at it with OPENAI_BASE_URL=http://127.0.0.1:8765/v1 and any
+# OPENAI_API_KEY.
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 8765
+
+# Latencies are log-normal around the median, which matches the long right
+# tail of real model calls
+DEFAULT_CONFIG = {
+    "response_median_ms": 8000,
+    "response_sigma": 0.35,
+    "upload_median_ms": 600,
+    "upload_sigma": 0.3,
+    "error_rate": 0.0,
+    "retry_after_seconds": 2,
+    "stream_chunks": 40,
+    "file_input_tokens": 18000,
+    # Prompt caching as the provider does it: a repeated prefix of at least
+    # 1024 tokens is served from cache (in 128-token steps) for a few minutes.
+    # A fully cached input cuts response latency by cached_latency_saving.
+    "prompt_cache_ttl_seconds": 300,
+    "cached_latency_saving": 0.3,
+    # Batches finish this long after creation (the real window is up to 24h)
+    "batch_seconds": 2,
+}
+
+CANNED_PROFILE = {
+    "deductibles": {"all_perils": 1000, "wind_hail": None, "wind_hail_pct": 1, "hurricane": None,
+                    "hurricane_pct": 2, "theft": None},
+    "coverage_limits": {"a_dwelling": 350000, "b_other_structures": 35000, "c_personal_property": 175000,
+                        "d_loss_of_use": 70000, "e_personal_liability": 300000, "f_medical_payments": 5000},
+    "loss_settlement": {"dwelling": "RCV", "roof": "ACV", "personal_property": "ACV"},
+    "special_limits": {"jewelry_theft": 1500, "water_backup": None, "mold": 5000, "tree_debris_removal": 1000},
+    "exclusions": ["flood", "surface_water", "groundwater_seepage", "earth_movement", "wear_and_tear",
+                   "continuous_seepage", "sewer_backup"],
+    "endorsements": ["ordinance_or_law"],
+    "other_exclusions": [],
+    "other_endorsements": [],
+    "ambiguous_clauses": [],
+}
+
+
+def canned_analysis(scenario):
+    return {
+        "plain_summary": f"Your policy would likely cover sudden damage from {scenario.lower()} to your home and "
+                         f"belongings, after your deductible. Gradual damage and flood-related losses are excluded.",
+        "gap_alerts": ["Flood not covered", "Wear and tear excluded"],
+        "covered_items": [
+            {"item": "Dwelling repairs", "est_replacement_cost": 18000, "depreciation_pct": 0, "acv_payout": 18000},
+            {"item": "Flooring", "est_replacement_cost": 6500, "depreciation_pct": 25, "acv_payout": 4875},
+            {"item": "Furniture", "est_replacement_cost": 4200, "depreciation_pct": 40, "acv_payout": 2520},
+        ],
+        "not_covered_items": ["Damage from long-term seepage", "Mold beyond the policy sublimit"],
+        "deductible": 1000,
+        "total_out_of_pocket": 5305,
+        "recommendations": ["Consider a flood policy", "Review your water backup endorsement options"],
+    }
+
+
+def _latency(median_ms, sigma):
+    return random.lognormvariate(math.log(max(median_ms, 1) / 1000.0), sigma)
+
+
+def _input_texts(body):
+    texts, file_inputs = [], 0
+    for message in body.get("input") or []:
+        content = message.get("content")
+        if isinstance(content, str):
+            texts.append(content)
+            continue
+        for part in content or []:
+            if part.get("type") == "input_text":
+                texts.append(part.get("text", ""))
+            elif part.get("type") == "input_file":
+                file_inputs += 1
+    if body.get("instructions"):
+        texts.append(body["instructions"])
+    return texts, file_inputs
+
+
+def _prefix_tokens(body, config):
+    # Everything before the final text part counts as the reusable prefix
+    parts = []
+    for message in body.get("input") or []:
+        content = message.get("content")
+        if isinstance(content, str):
+            parts.append(("text", content))
+            continue
+        for part in content or []:
+            if part.get("type") == "input_text":
+                parts.append(("text", part.get("text", "")))
+            elif part.get("type") == "input_file":
+                parts.append(("file", part.get("file_id", "")))
+    if parts and parts[-1][0] == "text":
+        parts = parts[:-1]
+    digest = hashlib.sha256(json.dumps([body.get("prompt_cache_key"), body.get("model"), parts]).encode("utf-8"))
+    tokens = sum(len(value) // 4 if kind == "text" else config["file_input_tokens"] for kind, value in parts)
+    return digest.hexdigest(), tokens
+
+
+def cached_prefix_tokens(server, body):
+    key, tokens = _prefix_tokens(body, server.config)
+    now = time.monotonic()
+    with server.cache_lock:
+        seen_at = server.prompt_cache.get(key)
+        server.prompt_cache[key] = now
+    if tokens < 1024 or seen_at is None or now - seen_at > server.config["prompt_cache_ttl_seconds"]:
+        return 0
+    return tokens - tokens % 128
+
+
+def build_output(body, config, canned, cached_tokens=0):
+    texts, file_inputs = _input_texts(body)
+    joined = "\n".join(texts)
+    if "Extract the structured terms" in joined:
+        payload = canned.get("profile") or CANNED_PROFILE
+    else:
+        match = re.search(r"(?:following scenario:\s*|for the scenario \")([^\n\"]+)", joined)
+        scenario = match.group(1).strip() if match else "this scenario"
+        payload = canned.get("analysis") or canned_analysis(scenario)
+    output_text = json.dumps(payload)
+    input_tokens = sum(len(text) for text in texts) // 4 + file_inputs * config["file_input_tokens"]
+    usage = {
+        "input_tokens": input_tokens,
+        "input_tokens_details": {"cached_tokens": min(cached_tokens, input_tokens)},
+        "output_tokens": len(output_text) // 4,
+        "output_tokens_details": {"reasoning_tokens": 0},
+        "total_tokens": input_tokens + len(output_text) // 4,
+    }
+    return output_text, usage
+
+
+def response_object(body, response_id, item_id, output_text, usage, status="completed"):
+    return {
+        "id": response_id,
+        "object": "response",
+        "created_at": int(time.time()),
+        "status": status,
+        "model": body.get("model", "gpt-4o"),
+        "output": [{
+            "id": item_id,
+            "type": "message",
+            "role": "assistant",
+            "status": status,
+            "content": [{"type": "output_text", "text": output_text, "annotations": []}] if output_text else [],
+        }] if output_text is not None else [],
+        "parallel_tool_calls": True,
+        "tool_choice": "auto",
+        "tools": [],
+        "text": body.get("text"),
+        "usage": usage,
+        "error": None,
+        "incomplete_details": None,
+    }
+
+
+def multipart_fields(content_type, raw_body):
+    message = BytesParser(policy=HTTP).parsebytes(
+        f"Content-Type: {content_type}\r\n\r\n".encode("utf-8") + raw_body
+    )
+    fields = {}
+    if message.is_multipart():
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            if name:
+                fields[name] = (part.get_filename(), part.get_payload(decode=True))
+    return fields
+
+
+def run_batch(server, batch_id):
+    # Answers every line of the input file the way /responses would; the error
+    # rate turns into failed lines in the error file instead of 429s
+    config = server.config
+    batch = server.batches[batch_id]
+    time.sleep(config["batch_seconds"] / 2)
+    batch.update(status="in_progress", in_progress_at=int(time.time()))
+    time.sleep(config["batch_seconds"] / 2)
+    output_lines, error_lines = [], []
+    for line in server.files[batch["input_file_id"]]["content"].decode("utf-8").splitlines():
+        if not line.strip():
+            continue
+        request = json.loads(line)
+        request_id = f"req_mock{uuid.uuid4().hex[:20]}"
+        if config["error_rate"] and random.random() < config["error_rate"]:
+            error_lines.append({"id": f"batch_req_mock{uuid.uuid4().hex[:16]}", "custom_id": request["custom_id"],
+                                "response": {"status_code": 500, "request_id": request_id, "body": {
+                                    "error": {"message": "Internal error (mock)", "type": "server_error"}}},
+                                "error": None})
+            continue
+        output_text, usage = build_output(request["body"], config, server.canned)
+        output_lines.append({"id": f"batch_req_mock{uuid.uuid4().hex[:16]}", "custom_id": request["custom_id"],
+                             "response": {"status_code": 200, "request_id": request_id, "body": response_object(
+                                 request["body"], f"resp_mock{uuid.uuid4().hex[:20]}",
+                                 f"msg_mock{uuid.uuid4().hex[:20]}", output_text, usage)},
+                             "error": None})
+    for key, lines in (("output_file_id", output_lines), ("error_file_id", error_lines)):
+        if lines:
+            file_id = f"file-mock{uuid.uuid4().hex[:20]}"
+            content = "\n".join(json.dumps(line) for line in lines).encode("utf-8")
+            server.files[file_id] = {"content": content, "object": {
+                "id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()),
+                "filename": f"{batch_id}_{key}.jsonl", "purpose": "batch_output", "status": "processed",
+            }}
+            batch[key] = file_id
+    batch.update(status="completed", completed_at=int(time.time()), request_counts={
+        "total": len(output_lines) + len(error_lines), "completed": len(output_lines), "failed": len(error_lines)
+    })
+
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    server_version = "MockOpenAI/1.0"
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def _send_json(self, status, payload, headers=None):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _maybe_fail(self):
+        config = self.server.config
+        if config["error_rate"] and random.random() < config["error_rate"]:
+            self._send_json(429, {"error": {
+                "message": "Rate limit reached (mock)", "type": "requests", "code": "rate_limit_exceeded"
+            }}, {"retry-after": str(config["retry_after_seconds"])})
+            return True
+        return False
+
+    def do_POST(self):
+        raw_body = self._read_body()
+        parts = self.path.rstrip("/").split("/")
+        if len(parts) >= 3 and parts[-3] == "uploads" and parts[-1] == "parts":
+            self._add_upload_part(parts[-2], raw_body)
+        elif len(parts) >= 3 and parts[-3] == "uploads" and parts[-1] == "complete":
+            self._complete_upload(parts[-2], json.loads(raw_body or b"{}"))
+        elif self.path.rstrip("/").endswith("/uploads"):
+            self._create_upload(json.loads(raw_body or b"{}"))
+        elif self.path.rstrip("/").endswith("/files"):
+            self._create_file(raw_body)
+        elif self.path.rstrip("/").endswith("/responses"):
+            self._create_response(json.loads(raw_body or b"{}"))
+        elif self.path.rstrip("/").endswith("/batches"):
+            self._create_batch(json.loads(raw_body or b"{}"))
+        else:
+            self._not_found()
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0].rstrip("/")
+        parts = path.split("/")
+        if path.endswith("/files"):
+            self._list_files(parse_qs(urlparse(self.path).query))
+        elif path.endswith("/batches"):
+            batches = sorted(self.server.batches.values(), key=lambda batch: batch["created_at"], reverse=True)
+            self._send_json(200, {"object": "list", "data": batches, "has_more": False})
+        elif len(parts) >= 2 and parts[-2] == "batches" and parts[-1] in self.server.batches:
+            self._send_json(200, self.server.batches[parts[-1]])
+        elif len(parts) >= 3 and parts[-1] == "content" and (self.server.files.get(parts[-2]) or {}).get("content"):
+            data = self.server.files[parts[-2]]["content"]
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        else:
+            self._not_found()
+
+    def do_DELETE(self):
+        file_id = self.path.rstrip("/").rsplit("/", 1)[-1]
+        self.server.files.pop(file_id, None)
+        self._send_json(200, {"id": file_id, "object": "file", "deleted": True})
+
+    def _list_files(self, query):
+        # Cursor pagination like the real endpoint: limit, after, order
+        files = sorted((entry["object"] for entry in list(self.server.files.values())),
+                       key=lambda f: (f["created_at"], f["id"]),
+                       reverse=query.get("order", ["desc"])[0] == "desc")
+        after = query.get("after", [None])[0]
+        if after:
+            ids = [f["id"] for f in files]
+            files = files[ids.index(after) + 1:] if after in ids else []
+        limit = int(query.get("limit", [10000])[0])
+        self._send_json(200, {"object": "list", "data": files[:limit], "has_more": len(files) > limit,
+                              "first_id": files[0]["id"] if files else None,
+                              "last_id": files[:limit][-1]["id"] if files else None})
+
+    def _not_found(self):
+        self._send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+
+    def _create_file(self, raw_body):
+        config = self.server.config
+        time.sleep(_latency(config["upload_median_ms"], config["upload_sigma"]))
+        if self._maybe_fail():
+            return
+        fields = multipart_fields(self.headers.get("Content-Type", ""), raw_body)
+        filename, content = fields.get("file", ("policy.pdf", raw_body))
+        purpose = (fields.get("purpose", (None, b"assistants"))[1] or b"").decode("utf-8")
+        file_object = {
+            "id": f"file-mock{uuid.uuid4().hex[:20]}",
+            "object": "file",
+            "bytes": len(content or b""),
+            "created_at": int(time.time()),
+            "filename": filename or "upload",
+            "purpose": purpose,
+            "status": "processed",
+        }
+        # Only batch input is kept; policy PDFs are never read back
+        self.server.files[file_object["id"]] = {
+            "object": file_object, "content": content if purpose == "batch" else None
+        }
+        self._send_json(200, file_object)
+
+    def _create_upload(self, body):
+        if self._maybe_fail():
+            return
+        upload_id = f"upload_mock{uuid.uuid4().hex[:20]}"
+        now = int(time.time())
+        upload = {
+            "id": upload_id,
+            "object": "upload",
+            "bytes": body.get("bytes", 0),
+            "created_at": now,
+            "expires_at": now + 3600,
+            "filename": body.get("filename", "upload"),
+            "purpose": body.get("purpose", "assistants"),
+            "status": "pending",
+            "file": None,
+        }
+        self.server.uploads[upload_id] = {"object": upload, "parts": {}}
+        self._send_json(200, upload)
+
+    def _add_upload_part(self, upload_id, raw_body):
+        # Each part takes its share of a whole-file upload's latency
+        config = self.server.config
+        entry = self.server.uploads.get(upload_id)
+        if not entry or entry["object"]["status"] != "pending":
+            self._send_json(404, {"error": {"message": f"No pending upload {upload_id}",
+                                            "type": "invalid_request_error"}})
+            return
+        data = multipart_fields(self.headers.get("Content-Type", ""), raw_body).get("data", (None, b""))[1] or b""
+        share = len(data) / max(1, entry["object"]["bytes"])
+        time.sleep(_latency(config["upload_median_ms"], config["upload_sigma"]) * share)
+        if self._maybe_fail():
+            return
+        part_id = f"part_mock{uuid.uuid4().hex[:20]}"
+        entry["parts"][part_id] = data
+        self._send_json(200, {"id": part_id, "object": "upload.part", "created_at": int(time.time()),
+                              "upload_id": upload_id})
+
+    def _complete_upload(self, upload_id, body):
+        if self._maybe_fail():
+            return
+        entry = self.server.uploads.get(upload_id)
+        part_ids = body.get("part_ids") or []
+        if not entry or entry["object"]["status"] != "pending" or any(p not in entry["parts"] for p in part_ids):
+            self._send_json(400, {"error": {"message": f"Cannot complete upload {upload_id}",
+                                            "type": "invalid_request_error"}})
+            return
+        content = b"".join(entry["parts"][part_id] for part_id in part_ids)
+        upload = entry["object"]
+        if len(content) != upload["bytes"] or (body.get("md5") and body["md5"] != hashlib.md5(content).hexdigest()):
+            self._send_json(400, {"error": {"message": "Uploaded parts do not match the declared bytes or md5",
+                                            "type": "invalid_request_error"}})
+            return
+        file_object = {
+            "id": f"file-mock{uuid.uuid4().hex[:20]}",
+            "object": "file",
+            "bytes": len(content),
+            "created_at": int(time.time()),
+            "filename": upload["filename"],
+            "purpose": upload["purpose"],
+            "status": "processed",
+        }
+        self.server.files[file_object["id"]] = {"object": file_object, "content": None}
+        upload.update(status="completed", file=file_object)
+        entry["parts"] = {}
+        self._send_json(200, upload)
+
+    def _create_batch(self, body):
+        if self._maybe_fail():
+            return
+        if body.get("input_file_id") not in self.server.files:
+            self._send_json(400, {"error": {"message": "Unknown input_file_id", "type": "invalid_request_error"}})
+            return
+        batch_id = f"batch_mock{uuid.uuid4().hex[:20]}"
+        now = int(time.time())
+        self.server.batches[batch_id] = {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": body.get("endpoint"),
+            "input_file_id": body["input_file_id"],
+            "completion_window": body.get("completion_window", "24h"),
+            "status": "validating",
+            "output_file_id": None,
+            "error_file_id": None,
+            "created_at": now,
+            "in_progress_at": None,
+            "expires_at": now + 86400,
+            "completed_at": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+            "metadata": body.get("metadata"),
+            "errors": None,
+        }
+        threading.Thread(target=run_batch, args=(self.server, batch_id), daemon=True).start()
+        self._send_json(200, self.server.batches[batch_id])
+
+    def _create_response(self, body):
+        config = self.server.config
+        if self._maybe_fail():
+            return
+        cached_tokens = cached_prefix_tokens(self.server, body)
+        output_text, usage = build_output(body, config, self.server.canned, cached_tokens)
+        response_id = f"resp_mock{uuid.uuid4().hex[:20]}"
+        item_id = f"msg_mock{uuid.uuid4().hex[:20]}"
+        total_seconds = _latency(config["response_median_ms"], config["response_sigma"])
+        if usage["input_tokens"]:
+            cached_share = usage["input_tokens_details"]["cached_tokens"] / usage["input_tokens"]
+            total_seconds *= 1.0 - config["cached_latency_saving"] * cached_share
+        if not body.get("stream"):
+            time.sleep(total_seconds)
+            self._send_json(200, response_object(body, response_id, item_id, output_text, usage))
+            return
+
+        # Server-sent events in the Responses API shape: created, text deltas, completed
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        sequence = 0
+
+        def send_event(event_type, payload):
+            nonlocal sequence
+            payload = {"type": event_type, "sequence_number": sequence, **payload}
+            sequence += 1
+            self.wfile.write(f"event: {event_type}\ndata: {json.dumps(payload)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        # Roughly a fifth of the time is spent before the first token
+        time.sleep(total_seconds * 0.2)
+        send_event("response.created", {"response": response_object(body, response_id, item_id, None, None, "in_progress")})
+        chunks = max(1, config["stream_chunks"])
+        step = math.ceil(len(output_text) / chunks)
+        for offset in range(0, len(output_text), step):
+            time.sleep(total_seconds * 0.8 / chunks)
+            send_event("response.output_text.delta", {
+                "item_id": item_id, "output_index": 0, "content_index": 0,
+                "delta": output_text[offset:offset + step], "logprobs": [],
+            })
+        send_event("response.completed", {"response": response_object(body, response_id, item_id, output_text, usage)})
+
+
+def start_mock_server(port=DEFAULT_PORT, host="127.0.0.1", canned=None, **overrides):
+    # Runs in a daemon thread; returns the server (call .shutdown() to stop)
+    server = ThreadingHTTPServer((host, port), MockOpenAIHandler)
+    server.daemon_threads = True
+    server.config = {**DEFAULT_CONFIG, **overrides}
+    server.canned = canned or {}
+    server.prompt_cache = {}
+    server.cache_lock = threading.Lock()
+    server.files = {}
+    server.batches = {}
+    server.uploads = {}
+    threading.Thread(target=server.serve_forever, name="mock-openai", daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock OpenAI server for PoliSee load tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--response-median-ms", type=int, default=DEFAULT_CONFIG["response_median_ms"])
+    parser.add_argument("--response-sigma", type=float, default=DEFAULT_CONFIG["response_sigma"])
+    parser.add_argument("--upload-median-ms", type=int, default=DEFAULT_CONFIG["upload_median_ms"])
+    parser.add_argument("--upload-sigma", type=float, default=DEFAULT_CONFIG["upload_sigma"])
+    parser.add_argument("--error-rate", type=float, default=DEFAULT_CONFIG["error_rate"],
+                        help="share of requests answered with 429 and Retry-After")
+    parser.add_argument("--canned", help='JSON file with {"analysis": {...}, "profile": {...}} to return instead of the defaults')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    canned = None
+    if args.canned:
+        with open(args.canned) as f:
+            canned = json.load(f)
+    server = start_mock_server(
+        args.port, args.host, canned,
+        response_median_ms=args.response_median_ms, response_sigma=args.response_sigma,
+        upload_median_ms=args.upload_median_ms, upload_sigma=args.upload_sigma,
+        error_rate=args.error_rate
+    )
+    logger.info(f"Mock OpenAI listening on http://{args.host}:{args.port}/v1")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
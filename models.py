@@ -1,9 +1,15 @@
 import os
 import logging
 from datetime import datetime
-from sqlalchemy import create_engine, Column, Integer, String, Text, Numeric, DateTime, ForeignKey
+from sqlalchemy import (create_engine, func, Column, Integer, BigInteger, String, Text, Numeric, Float, Date,
+                        DateTime, LargeBinary, ForeignKey, Index)
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import sessionmaker, relationship, object_session
+
+from migrations import apply_migrations
+from partitions import ensure_partitions
+from payloads import decompress_payload
+from db_pool import engine_options, instrument_engine
 
 logger = logging.getLogger(__name__)
 
@@ -20,7 +26,9 @@ if not DATABASE_URL:
     raise ValueError("DATABASE_URL environment variable is required")
 
 try:
-    engine = create_engine(DATABASE_URL, pool_pre_ping=True)
+    # Pool size, pre-ping, recycle and statement timeout come from DB_* settings (db_pool.py)
+    engine = create_engine(DATABASE_URL, **engine_options())
+    instrument_engine(engine)
     SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
     logger.info("Database engine created successfully")
 except Exception as e:
@@ -41,23 +49,309 @@ class User(Base):
     analyses = relationship("PolicyAnalysisResult", back_populates="user")
 
 
+# Login and registration match email addresses case-insensitively; unique, so
+# an address belongs to one account whatever its case
+Index("ix_users_email_lower", func.lower(User.email), unique=True)
+
+
 class PolicyAnalysisResult(Base):
     __tablename__ = "policy_analysis_results"
     
-    id = Column(Integer, primary_key=True, index=True)
+    # Range-partitioned by month on upload_timestamp (partitions.py), which
+    # therefore joins the primary key
+    id = Column(Integer, primary_key=True, autoincrement=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
-    upload_timestamp = Column(DateTime, default=datetime.utcnow)
+    upload_timestamp = Column(DateTime, primary_key=True, default=datetime.utcnow)
     scenario = Column(Text, nullable=False)
     file_id = Column(Text, nullable=False)
-    openai_response_json = Column(Text)
     out_of_pocket_estimate = Column(Numeric)
-    gap_alerts = Column(Text)
+    gap_count = Column(Integer, nullable=False, default=0)
+    # Model and prompt that produced the result, e.g. "gpt-4o:3f9a..." or "rules:..."
+    # for policy-profile estimates; reanalyze.py refreshes rows with an old version
+    prompt_version = Column(String(64))
     
     user = relationship("User", back_populates="analyses")
+    # Full result, loaded only when a single analysis is opened or exported
+    # (storage.get_analysis, storage.iter_analyses)
+    payload = relationship(
+        "AnalysisPayload", uselist=False, cascade="all, delete-orphan",
+        primaryjoin="and_(PolicyAnalysisResult.id == foreign(AnalysisPayload.analysis_id), "
+                    "PolicyAnalysisResult.upload_timestamp == foreign(AnalysisPayload.upload_timestamp))"
+    )
+    
+    __table_args__ = {"postgresql_partition_by": "RANGE (upload_timestamp)"}
+    
+    @property
+    def openai_response_json(self):
+        return self.payload.text if self.payload is not None else None
+
+
+# History pages: one user's analyses (or everyone's), newest first, in the
+# (upload_timestamp, id) order the keyset cursor uses
+Index("ix_policy_analysis_results_user_uploaded_id", PolicyAnalysisResult.user_id,
+      PolicyAnalysisResult.upload_timestamp.desc(), PolicyAnalysisResult.id.desc())
+Index("ix_policy_analysis_results_uploaded_id", PolicyAnalysisResult.upload_timestamp.desc(),
+      PolicyAnalysisResult.id.desc())
+
+
+# Preset zlib dictionaries trained from sample responses (payloads.py); never
+# changed or deleted, since payloads keep the one they were compressed with
+class PayloadDictionary(Base):
+    __tablename__ = "payload_dictionaries"
+    
+    id = Column(Integer, primary_key=True)
+    dictionary = Column(LargeBinary, nullable=False)
+    sample_count = Column(Integer, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+# The full model response of an analysis, compressed. Partitioned on the same
+# months as policy_analysis_results, so retention archives and drops both.
+class AnalysisPayload(Base):
+    __tablename__ = "analysis_payloads"
+    
+    # The analysis's primary key; not a foreign key, which create_all could not
+    # add before migration 7 partitions policy_analysis_results
+    analysis_id = Column(Integer, primary_key=True)
+    upload_timestamp = Column(DateTime, primary_key=True)
+    # payloads.CODEC_ZLIB or CODEC_NONE
+    codec = Column(String(8), nullable=False)
+    dictionary_id = Column(Integer, ForeignKey("payload_dictionaries.id"))
+    # Uncompressed size
+    size_bytes = Column(Integer)
+    data = Column(LargeBinary, nullable=False)
+    
+    __table_args__ = {"postgresql_partition_by": "RANGE (upload_timestamp)"}
+    
+    @property
+    def text(self):
+        # A dictionary not cached yet is read on the session's own connection
+        session = object_session(self)
+        return decompress_payload(self.codec, self.dictionary_id, self.data,
+                                  session.connection() if session is not None else None)
+
+
+# Analytics rollups (rollups.py), updated in the same transaction as every
+# saved analysis: one row per UTC day and scenario. They outlive the
+# partitions archived by retention.
+class ScenarioDailyRollup(Base):
+    __tablename__ = "scenario_daily_rollups"
+    
+    day = Column(Date, primary_key=True)
+    scenario = Column(Text, primary_key=True)
+    analysis_count = Column(Integer, nullable=False, default=0)
+    # Analyses with an out-of-pocket estimate
+    oop_count = Column(Integer, nullable=False, default=0)
+    oop_sum = Column(Float, nullable=False, default=0)
+    oop_min = Column(Float)
+    oop_max = Column(Float)
+
+
+# Out-of-pocket histogram for percentiles; bucket indexes rollups.OOP_BUCKET_BOUNDS
+class ScenarioDailyOopBucket(Base):
+    __tablename__ = "scenario_daily_oop_buckets"
+    
+    day = Column(Date, primary_key=True)
+    scenario = Column(Text, primary_key=True)
+    bucket = Column(Integer, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+
+# Canonical gap alert codes; free-form alert text is classified by rollups.gap_alert_code
+class GapAlertCode(Base):
+    __tablename__ = "gap_alert_codes"
+    
+    code = Column(String(64), primary_key=True)
+    label = Column(Text, nullable=False)
+
+
+# Analyses per day and scenario that raised each gap alert code
+class ScenarioDailyGapAlert(Base):
+    __tablename__ = "scenario_daily_gap_alerts"
+    
+    day = Column(Date, primary_key=True)
+    scenario = Column(Text, primary_key=True)
+    code = Column(String(64), ForeignKey("gap_alert_codes.code"), primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+
+class PolicyFile(Base):
+    __tablename__ = "policy_files"
+    
+    # One row per distinct PDF (by SHA-256 of its bytes), shared by every user
+    id = Column(Integer, primary_key=True, index=True)
+    content_hash = Column(String(64), unique=True, nullable=False, index=True)
+    file_id = Column(Text, nullable=False)
+    size_bytes = Column(Integer)
+    uploaded_at = Column(DateTime, default=datetime.utcnow)
+    # Bumped on every reuse; the sweeper deletes the OpenAI file once this is
+    # FILE_IDLE_DAYS old and no queued job or pending re-analysis needs it
+    last_used_at = Column(DateTime, default=datetime.utcnow)
+    # Set once the OpenAI file is deleted (see file_registry.py); the row stays
+    # for the policy profile and history, and a new upload of the same
+    # document reuses it
+    deleted_at = Column(DateTime)
+
+
+class FileUpload(Base):
+    __tablename__ = "file_uploads"
+    
+    # A chunked upload through the OpenAI Uploads API (see pdf_upload.py). Parts
+    # that finished are kept in file_upload_parts, so a retry sends only the rest.
+    id = Column(Integer, primary_key=True, index=True)
+    upload_id = Column(String(64), unique=True, nullable=False)
+    content_hash = Column(String(64), nullable=False, index=True)
+    filename = Column(Text)
+    size_bytes = Column(BigInteger, nullable=False)
+    part_size = Column(Integer, nullable=False)
+    status = Column(String(16), nullable=False, default="uploading")
+    file_id = Column(Text)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False)
+
+
+class FileUploadPart(Base):
+    __tablename__ = "file_upload_parts"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    file_upload_id = Column(Integer, ForeignKey("file_uploads.id", ondelete="CASCADE"), nullable=False)
+    part_number = Column(Integer, nullable=False)
+    part_id = Column(String(64), nullable=False)
+    size_bytes = Column(Integer, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        Index("ix_file_upload_parts_upload_part", "file_upload_id", "part_number", unique=True),
+    )
+
+
+class AnalysisCacheEntry(Base):
+    __tablename__ = "analysis_cache"
+    
+    # cache_key = sha256(content_hash | scenario | model | prompt_hash), see analysis_cache.py
+    id = Column(Integer, primary_key=True, index=True)
+    cache_key = Column(String(64), unique=True, nullable=False, index=True)
+    content_hash = Column(String(64), nullable=False)
+    scenario = Column(Text, nullable=False)
+    model = Column(String(64), nullable=False)
+    prompt_hash = Column(String(64), nullable=False)
+    response_json = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+    last_accessed_at = Column(DateTime, default=datetime.utcnow, index=True)
+    hit_count = Column(Integer, nullable=False, default=0)
+
+
+class PolicyProfile(Base):
+    __tablename__ = "policy_profiles"
+    
+    # Structured terms extracted once per document, see policy_profile.py
+    id = Column(Integer, primary_key=True, index=True)
+    content_hash = Column(String(64), ForeignKey("policy_files.content_hash"), unique=True, nullable=False, index=True)
+    file_id = Column(Text, nullable=False)
+    model = Column(String(64), nullable=False)
+    prompt_hash = Column(String(64), nullable=False)
+    profile_json = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class AnalysisJob(Base):
+    __tablename__ = "analysis_jobs"
+    
+    # Queue for worker.py; status moves queued -> running -> done | failed,
+    # and failed attempts go back to queued until max_attempts
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    file_id = Column(Text, nullable=False)
+    content_hash = Column(String(64), nullable=False)
+    scenario = Column(Text, nullable=False)
+    policy_context = Column(Text)
+    status = Column(String(16), nullable=False, default="queued")
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=3)
+    run_after = Column(DateTime, default=datetime.utcnow)
+    error = Column(Text)
+    result_json = Column(Text)
+    # No foreign key: policy_analysis_results is partitioned on (id, upload_timestamp)
+    # and archived partitions are dropped
+    analysis_id = Column(Integer)
+    worker_id = Column(String(128))
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+    delivered_at = Column(DateTime)
+    
+    __table_args__ = (
+        Index("ix_analysis_jobs_status_run_after", "status", "run_after"),
+    )
+
+
+class RateLimitBucket(Base):
+    __tablename__ = "rate_limit_buckets"
+    
+    # Token buckets shared by every app replica and worker, see openai_scheduler.py.
+    # Rows are locked with SELECT ... FOR UPDATE while a request is admitted.
+    name = Column(String(64), primary_key=True)
+    tokens = Column(Float, nullable=False)
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    blocked_until = Column(DateTime)
+
+
+class ApiCallLog(Base):
+    __tablename__ = "openai_api_calls"
+    
+    # One row per completed OpenAI call with its token usage, see usage_log.py.
+    # cached_tokens is the part of input_tokens served from the provider's prompt cache.
+    id = Column(Integer, primary_key=True, index=True)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+    operation = Column(String(32), nullable=False)
+    model = Column(String(64))
+    content_hash = Column(String(64), index=True)
+    scenario = Column(Text)
+    prompt_cache_key = Column(String(64))
+    input_tokens = Column(Integer)
+    cached_tokens = Column(Integer)
+    output_tokens = Column(Integer)
+    latency_ms = Column(Integer)
+
+
+class ReanalysisBatch(Base):
+    __tablename__ = "reanalysis_batches"
+    
+    # One OpenAI Batch API job submitted by reanalyze.py
+    id = Column(Integer, primary_key=True, index=True)
+    openai_batch_id = Column(String(64), unique=True)
+    input_file_id = Column(String(64))
+    output_file_id = Column(String(64))
+    error_file_id = Column(String(64))
+    prompt_version = Column(String(64), nullable=False)
+    status = Column(String(32), nullable=False, default="preparing")
+    request_count = Column(Integer, nullable=False, default=0)
+    completed_count = Column(Integer, nullable=False, default=0)
+    failed_count = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    submitted_at = Column(DateTime)
+    finished_at = Column(DateTime)
+    applied_at = Column(DateTime)
+
+
+class ReanalysisItem(Base):
+    __tablename__ = "reanalysis_items"
+    
+    # One file_id x scenario request inside a batch; status pending -> done | failed
+    id = Column(Integer, primary_key=True, index=True)
+    batch_id = Column(Integer, ForeignKey("reanalysis_batches.id"), nullable=False, index=True)
+    file_id = Column(Text, nullable=False)
+    scenario = Column(Text, nullable=False)
+    status = Column(String(16), nullable=False, default="pending")
+    error = Column(Text)
+    updated_rows = Column(Integer)
 
 
+# Schema changes to existing tables (columns, indexes) are versioned
+# migrations in migrations.py; create_all only creates missing tables
 def init_db():
-    Base.metadata.create_all(bind=engine)
+    apply_migrations(engine, Base.metadata)
+    ensure_partitions(engine)
 
 
 def get_db():
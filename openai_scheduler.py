@@ -0,0 +1,336 @@
+import os
+import time
+import heapq
+import random
+import logging
+import itertools
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
+
+import openai
+from sqlalchemy.dialects.postgresql import insert
+
+from models import SessionLocal, RateLimitBucket
+from usage_log import record_api_call
+
+logger = logging.getLogger(__name__)
+
+# Account-wide OpenAI limits, shared by every replica and worker through the
+# rate_limit_buckets table
+OPENAI_RPM_LIMIT = int(os.getenv("OPENAI_RPM_LIMIT", 500))
+OPENAI_TPM_LIMIT = int(os.getenv("OPENAI_TPM_LIMIT", 450000))
+
+# Per-process cap on in-flight OpenAI calls; callers beyond it wait in priority order
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", 8))
+
+# Share of each bucket that background work (worker jobs, batch tools) may not
+# use, so interactive sessions still get through when the queue is busy
+OPENAI_BACKGROUND_RESERVE = float(os.getenv("OPENAI_BACKGROUND_RESERVE", 0.2))
+
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", 5))
+OPENAI_MAX_WAIT_SECONDS = int(os.getenv("OPENAI_MAX_WAIT_SECONDS", 180))
+RETRY_BASE_SECONDS = 1.0
+RETRY_MAX_SECONDS = 60.0
+
+# Token estimates charged before a call; corrected from response usage afterwards
+FILE_INPUT_TOKEN_ESTIMATE = int(os.getenv("OPENAI_FILE_TOKEN_ESTIMATE", 20000))
+OUTPUT_TOKEN_ESTIMATE = 1500
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+REQUESTS_BUCKET = "openai_requests"
+TOKENS_BUCKET = "openai_tokens"
+
+# name -> (capacity, refill per second)
+BUCKET_LIMITS = {
+    REQUESTS_BUCKET: (OPENAI_RPM_LIMIT, OPENAI_RPM_LIMIT / 60.0),
+    TOKENS_BUCKET: (OPENAI_TPM_LIMIT, OPENAI_TPM_LIMIT / 60.0),
+}
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class SchedulerTimeout(Exception):
+    pass
+
+
+class AdmissionQueue:
+    # Bounded concurrency with a priority wait list; lower priority values go
+    # first, ties in arrival order
+    def __init__(self, slots):
+        self.slots = max(1, slots)
+        self._active = 0
+        self._waiting = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+
+    def acquire(self, priority, on_wait=None, timeout=None):
+        ticket = (priority, next(self._counter))
+        deadline = time.monotonic() + timeout if timeout else None
+        with self._cond:
+            heapq.heappush(self._waiting, ticket)
+        try:
+            while True:
+                with self._cond:
+                    if self._active < self.slots and self._waiting[0] == ticket:
+                        heapq.heappop(self._waiting)
+                        self._active += 1
+                        return
+                    position = sum(1 for other in self._waiting if other < ticket) + 1
+                    self._cond.wait(0.5)
+                if on_wait:
+                    on_wait(position, None)
+                if deadline and time.monotonic() > deadline:
+                    raise SchedulerTimeout("The analysis engine is busy. Please try again in a few minutes.")
+        except BaseException:
+            with self._cond:
+                if ticket in self._waiting:
+                    self._waiting.remove(ticket)
+                    heapq.heapify(self._waiting)
+                self._cond.notify_all()
+            raise
+
+    def release(self):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {"active": self._active, "waiting": len(self._waiting), "slots": self.slots}
+
+
+_admission = AdmissionQueue(OPENAI_MAX_CONCURRENCY)
+_buckets_ready = False
+
+
+def _ensure_buckets(db):
+    global _buckets_ready
+    if _buckets_ready:
+        return
+    for name, (capacity, _) in BUCKET_LIMITS.items():
+        db.execute(insert(RateLimitBucket).values(
+            name=name, tokens=capacity, updated_at=datetime.utcnow()
+        ).on_conflict_do_nothing(index_elements=["name"]))
+    db.commit()
+    _buckets_ready = True
+
+
+def _reserve_capacity(costs, priority):
+    # Takes every cost at once or nothing; returns 0 when admitted, otherwise the
+    # seconds until the scarcest bucket can cover its cost
+    db = SessionLocal()
+    try:
+        _ensure_buckets(db)
+        buckets = db.query(RateLimitBucket).filter(
+            RateLimitBucket.name.in_(list(costs))
+        ).order_by(RateLimitBucket.name).with_for_update().all()
+        now = datetime.utcnow()
+        wait = 0.0
+        for bucket in buckets:
+            capacity, refill_rate = BUCKET_LIMITS[bucket.name]
+            elapsed = max(0.0, (now - bucket.updated_at).total_seconds())
+            bucket.tokens = min(capacity, bucket.tokens + elapsed * refill_rate)
+            bucket.updated_at = now
+            if bucket.blocked_until and bucket.blocked_until > now:
+                wait = max(wait, (bucket.blocked_until - now).total_seconds())
+                continue
+            reserve = capacity * OPENAI_BACKGROUND_RESERVE if priority > PRIORITY_INTERACTIVE else 0.0
+            # A request larger than the whole bucket runs once the bucket is full
+            needed = min(costs[bucket.name], capacity - reserve)
+            available = bucket.tokens - reserve
+            if available < needed:
+                wait = max(wait, (needed - available) / refill_rate)
+        if wait == 0.0:
+            for bucket in buckets:
+                bucket.tokens -= costs[bucket.name]
+        db.commit()
+        return wait
+    except Exception as e:
+        # Fail open: a database hiccup should not stop analyses
+        db.rollback()
+        logger.warning(f"Shared rate limiter unavailable, continuing without it: {e}")
+        return 0.0
+    finally:
+        db.close()
+
+
+def _adjust_tokens(delta):
+    # Positive delta returns tokens to the bucket (estimate was too high)
+    if not delta:
+        return
+    db = SessionLocal()
+    try:
+        capacity, _ = BUCKET_LIMITS[TOKENS_BUCKET]
+        bucket = db.query(RateLimitBucket).filter(RateLimitBucket.name == TOKENS_BUCKET).with_for_update().first()
+        if bucket:
+            bucket.tokens = min(capacity, bucket.tokens + delta)
+            db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.warning(f"Failed to adjust shared token bucket: {e}")
+    finally:
+        db.close()
+
+
+def _block_requests(seconds):
+    # A 429 means the account is over its limit everywhere, so every replica pauses
+    db = SessionLocal()
+    try:
+        blocked_until = datetime.utcnow() + timedelta(seconds=seconds)
+        db.query(RateLimitBucket).filter(
+            RateLimitBucket.name == REQUESTS_BUCKET,
+            (RateLimitBucket.blocked_until.is_(None)) | (RateLimitBucket.blocked_until < blocked_until)
+        ).update({RateLimitBucket.blocked_until: blocked_until}, synchronize_session=False)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.warning(f"Failed to record rate limit block: {e}")
+    finally:
+        db.close()
+
+
+def retry_after_seconds(error):
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000.0
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if not retry_after:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+        return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(error):
+    if isinstance(error, openai.RateLimitError):
+        # Out of credit is not going to clear up by waiting
+        return getattr(error, "code", None) != "insufficient_quota"
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS_CODES
+    return False
+
+
+def backoff_seconds(attempt, retry_after=None):
+    # Full jitter, but never earlier than the server asked for
+    delay = random.uniform(0, min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * (2 ** attempt)))
+    if retry_after is not None:
+        delay = max(delay, retry_after + random.uniform(0, 1))
+    return delay
+
+
+def estimate_request_tokens(messages):
+    # About four characters per token for text; files get a flat estimate
+    tokens = OUTPUT_TOKEN_ESTIMATE
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            tokens += len(content) // 4
+            continue
+        for part in content or []:
+            if part.get("type") == "input_text":
+                tokens += len(part.get("text", "")) // 4
+            elif part.get("type") == "input_file":
+                tokens += FILE_INPUT_TOKEN_ESTIMATE
+    return tokens
+
+
+class ScheduledRequest:
+    def __init__(self, priority, estimated_tokens, on_wait, deadline, call_log=None):
+        self.priority = priority
+        self.estimated_tokens = estimated_tokens
+        self.on_wait = on_wait
+        self.deadline = deadline
+        self.call_log = call_log
+        self._charged_tokens = 0
+        self._attempt_started = None
+
+    def _wait(self, seconds):
+        if time.monotonic() + seconds > self.deadline:
+            raise SchedulerTimeout("The analysis engine is busy. Please try again in a few minutes.")
+        if self.on_wait:
+            self.on_wait(0, seconds)
+        time.sleep(seconds)
+
+    def _admit(self):
+        costs = {REQUESTS_BUCKET: 1, TOKENS_BUCKET: self.estimated_tokens}
+        while True:
+            wait = _reserve_capacity(costs, self.priority)
+            if wait <= 0:
+                self._charged_tokens += self.estimated_tokens
+                return
+            self._wait(min(wait, 5.0))
+
+    def call(self, fn, *args, before_attempt=None, **kwargs):
+        attempt = 0
+        while True:
+            self._admit()
+            if before_attempt:
+                before_attempt()
+            self._attempt_started = time.monotonic()
+            try:
+                response = fn(*args, **kwargs)
+            except Exception as e:
+                # The failed attempt used no tokens
+                _adjust_tokens(self.estimated_tokens)
+                self._charged_tokens -= self.estimated_tokens
+                if attempt >= OPENAI_MAX_RETRIES or not is_retryable(e):
+                    raise
+                retry_after = retry_after_seconds(e)
+                if isinstance(e, openai.RateLimitError):
+                    _block_requests(retry_after if retry_after is not None else backoff_seconds(attempt))
+                delay = backoff_seconds(attempt, retry_after)
+                logger.warning(f"OpenAI call failed ({type(e).__name__}), retry {attempt + 1} in {delay:.1f}s: {e}")
+                attempt += 1
+                self._wait(delay)
+                continue
+            usage = getattr(response, "usage", None)
+            if usage is not None:
+                self.record_usage(usage)
+            return response
+
+    def record_usage(self, usage):
+        total_tokens = getattr(usage, "total_tokens", None)
+        if not isinstance(total_tokens, int):
+            return
+        _adjust_tokens(self._charged_tokens - total_tokens)
+        self._charged_tokens = total_tokens
+        if self.call_log and self._attempt_started is not None:
+            # For streams this is called on completion, so latency covers the whole response
+            latency_ms = (time.monotonic() - self._attempt_started) * 1000
+            record_api_call(usage=usage, latency_ms=latency_ms, **self.call_log)
+
+
+# Wrap every OpenAI call: holds a per-process concurrency slot for the whole
+# block (including streaming), charges the shared buckets before each attempt
+# and retries transient failures. on_wait(position, seconds) reports either a
+# place in the local queue or a rate-limit/backoff delay. call_log holds the
+# usage_log.record_api_call labels (operation, model, content_hash, ...).
+@contextmanager
+def openai_request(priority=PRIORITY_INTERACTIVE, estimated_tokens=0, on_wait=None, call_log=None):
+    deadline = time.monotonic() + OPENAI_MAX_WAIT_SECONDS
+    _admission.acquire(priority, on_wait, timeout=OPENAI_MAX_WAIT_SECONDS)
+    try:
+        yield ScheduledRequest(priority, estimated_tokens, on_wait, deadline, call_log)
+    finally:
+        _admission.release()
+
+
+def admission_stats():
+    return _admission.stats()
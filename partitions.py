@@ -0,0 +1,295 @@
+import os
+import re
+import time
+import logging
+import argparse
+from datetime import date, datetime
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy import text, Integer, BigInteger, Numeric, Float, DateTime, LargeBinary
+
+# Monthly range partitions of policy_analysis_results, and of the payloads
+# stored beside it in analysis_payloads, on upload_timestamp; and retention:
+# months older than ANALYSIS_RETENTION_MONTHS are exported, with their
+# payloads decompressed, to compressed Parquet files in ANALYSIS_ARCHIVE_DIR,
+# then both partitions are detached and dropped.
+# Table, index, vacuum and backup sizes then follow the retention window
+# rather than lifetime usage, and history pages stay index range scans over a
+# bounded number of partitions.
+#
+# init_db() creates the partitions for last month through a few months ahead;
+# rows outside them (clock skew, replayed spills for archived months) land in
+# the default partition. Run the archive job from cron, e.g. daily:
+#
+#   python partitions.py --status
+#   python partitions.py --dry-run
+
+logger = logging.getLogger(__name__)
+
+PARTITIONED_TABLE = "policy_analysis_results"
+# Partitioned on the same months; its partitions go with the analyses'
+PAYLOAD_TABLE = "analysis_payloads"
+PARTITIONED_TABLES = (PARTITIONED_TABLE, PAYLOAD_TABLE)
+PARTITION_NAME = re.compile(rf"^(?:{'|'.join(PARTITIONED_TABLES)})_y(\d{{4}})m(\d{{2}})$")
+
+# Months of partitions created ahead of the current one
+ANALYSIS_PARTITION_MONTHS_AHEAD = int(os.getenv("ANALYSIS_PARTITION_MONTHS_AHEAD", 3))
+# Whole months of analyses kept in Postgres besides the current one; 0 keeps everything
+ANALYSIS_RETENTION_MONTHS = int(os.getenv("ANALYSIS_RETENTION_MONTHS", 0))
+ANALYSIS_ARCHIVE_DIR = os.getenv("ANALYSIS_ARCHIVE_DIR", "analysis-archive")
+ANALYSIS_ARCHIVE_COMPRESSION = os.getenv("ANALYSIS_ARCHIVE_COMPRESSION", "zstd")
+# Rows fetched from the server-side cursor, and written as one Parquet row group
+ANALYSIS_ARCHIVE_BATCH_ROWS = int(os.getenv("ANALYSIS_ARCHIVE_BATCH_ROWS", 10000))
+
+# pg_advisory_xact_lock key held for partition DDL
+PARTITION_LOCK_KEY = 7340214
+# pg_try_advisory_xact_lock key: one archive run at a time
+ARCHIVE_LOCK_KEY = 7340215
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month, table=PARTITIONED_TABLE):
+    return f"{table}_y{month:%Y}m{month:%m}"
+
+
+def default_partition(table=PARTITIONED_TABLE):
+    return f"{table}_default"
+
+
+def partition_month(name):
+    match = PARTITION_NAME.match(name)
+    return date(int(match.group(1)), int(match.group(2)), 1) if match else None
+
+
+def list_partitions(conn, table=PARTITIONED_TABLE):
+    # Returns the names of the attached partitions
+    return conn.execute(text("""
+        SELECT child.relname FROM pg_inherits
+        JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.relname = :table
+        ORDER BY child.relname
+    """), {"table": table}).scalars().all()
+
+
+def _create_partition(conn, month, table=PARTITIONED_TABLE):
+    name = partition_name(month, table)
+    default = default_partition(table)
+    start, end = month, add_months(month, 1)
+    bounds = f"FROM ('{start}') TO ('{end}')"
+    stray = conn.execute(text(f"""
+        SELECT count(*) FROM {default} WHERE upload_timestamp >= :start AND upload_timestamp < :end
+    """), {"start": start, "end": end}).scalar()
+    if not stray:
+        conn.execute(text(f"CREATE TABLE {name} PARTITION OF {table} FOR VALUES {bounds}"))
+        return
+    # Postgres will not create a partition whose rows sit in the default one;
+    # move them into a plain table and attach that instead
+    logger.info(f"Moving {stray} rows from {default} into new partition {name}")
+    conn.execute(text(f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"))
+    conn.execute(text(f"""
+        WITH moved AS (
+            DELETE FROM {default} WHERE upload_timestamp >= :start AND upload_timestamp < :end
+            RETURNING *
+        )
+        INSERT INTO {name} SELECT * FROM moved
+    """), {"start": start, "end": end})
+    conn.execute(text(f"ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES {bounds}"))
+
+
+def ensure_partitions(engine, months_ahead=ANALYSIS_PARTITION_MONTHS_AHEAD, today=None):
+    # Creates the default partitions and monthly ones from last month through
+    # months_ahead; returns the names created
+    this_month = (today or datetime.utcnow().date()).replace(day=1)
+    with engine.begin() as conn:
+        conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": PARTITION_LOCK_KEY})
+        created = []
+        for table in PARTITIONED_TABLES:
+            existing = set(list_partitions(conn, table))
+            if default_partition(table) not in existing:
+                conn.execute(text(f"CREATE TABLE {default_partition(table)} PARTITION OF {table} DEFAULT"))
+                created.append(default_partition(table))
+            for offset in range(-1, months_ahead + 1):
+                month = add_months(this_month, offset)
+                if partition_name(month, table) not in existing:
+                    _create_partition(conn, month, table)
+                    created.append(partition_name(month, table))
+    if created:
+        logger.info(f"Created partitions: {', '.join(created)}")
+    return created
+
+
+def partitions_due(conn, retention_months, today=None):
+    # Attached monthly analysis partitions older than the retention window, oldest first
+    if retention_months <= 0:
+        return []
+    cutoff = add_months((today or datetime.utcnow().date()).replace(day=1), -retention_months)
+    return [name for name in list_partitions(conn)
+            if partition_month(name) is not None and partition_month(name) < cutoff]
+
+
+def _arrow_type(column):
+    if isinstance(column.type, (Integer, BigInteger)):
+        return pa.int64()
+    if isinstance(column.type, DateTime):
+        return pa.timestamp("us")
+    if isinstance(column.type, (Numeric, Float)):
+        return pa.float64()
+    if isinstance(column.type, LargeBinary):
+        return pa.binary()
+    return pa.string()
+
+
+def _arrow_batch(rows, schema):
+    arrays = []
+    for index, field in enumerate(schema):
+        values = [row[index] for row in rows]
+        if pa.types.is_floating(field.type):
+            values = [float(value) if value is not None else None for value in values]
+        arrays.append(pa.array(values, type=field.type))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def export_partition(engine, table, name, archive_dir):
+    # Streams one analysis partition, with its payloads decompressed into an
+    # openai_response_json column, into archive_dir/<name>.parquet through a
+    # server-side cursor, one row group per batch; returns (path, rows)
+    from payloads import decompress_payload
+
+    columns = list(table.columns)
+    schema = pa.schema([pa.field(column.name, _arrow_type(column)) for column in columns]
+                       + [pa.field("openai_response_json", pa.string())])
+    payloads = partition_name(partition_month(name), PAYLOAD_TABLE)
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, f"{name}.parquet")
+    tmp_path = f"{path}.tmp"
+    rows_written = 0
+    with engine.connect() as conn:
+        if payloads in list_partitions(conn, PAYLOAD_TABLE):
+            payload_columns = "payload.codec, payload.dictionary_id, payload.data"
+            payload_join = (f"LEFT JOIN {payloads} payload ON payload.analysis_id = analysis.id "
+                            f"AND payload.upload_timestamp = analysis.upload_timestamp")
+        else:
+            payload_columns, payload_join = "NULL, NULL, NULL", ""
+        result = conn.execution_options(yield_per=ANALYSIS_ARCHIVE_BATCH_ROWS).execute(text(
+            f"SELECT {', '.join(f'analysis.{column.name}' for column in columns)}, {payload_columns} "
+            f"FROM {name} analysis {payload_join} ORDER BY analysis.id"
+        ))
+        with pq.ParquetWriter(tmp_path, schema, compression=ANALYSIS_ARCHIVE_COMPRESSION) as writer:
+            for rows in result.partitions():
+                rows = [(*row[:len(columns)], decompress_payload(*row[len(columns):], conn) if row[len(columns)] else None)
+                        for row in rows]
+                writer.write_table(_arrow_batch(rows, schema))
+                rows_written += len(rows)
+        conn.rollback()
+    with open(tmp_path, "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    if pq.read_metadata(path).num_rows != rows_written:
+        raise RuntimeError(f"{path} does not hold the {rows_written} rows exported")
+    return path, rows_written
+
+
+def drop_partition(engine, name, expected_rows):
+    # Detaches and drops an exported partition and its payloads, unless rows
+    # changed since the export
+    payloads = partition_name(partition_month(name), PAYLOAD_TABLE)
+    with engine.begin() as conn:
+        conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": PARTITION_LOCK_KEY})
+        if payloads in list_partitions(conn, PAYLOAD_TABLE):
+            conn.execute(text(f"ALTER TABLE {PAYLOAD_TABLE} DETACH PARTITION {payloads}"))
+            conn.execute(text(f"DROP TABLE {payloads}"))
+        conn.execute(text(f"ALTER TABLE {PARTITIONED_TABLE} DETACH PARTITION {name}"))
+        rows = conn.execute(text(f"SELECT count(*) FROM {name}")).scalar()
+        if rows != expected_rows:
+            raise RuntimeError(f"{name} has {rows} rows, {expected_rows} were archived; export it again")
+        conn.execute(text(f"DROP TABLE {name}"))
+
+
+def archive_partitions(engine, table, retention_months=ANALYSIS_RETENTION_MONTHS,
+                       archive_dir=ANALYSIS_ARCHIVE_DIR, dry_run=False):
+    # Returns [(partition, rows, archive path or error)], or None when another
+    # process is archiving
+    # Held until this transaction ends, so the lock and its release are on one
+    # server connection, also behind PgBouncer's transaction pooling. The
+    # transaction holds nothing else: the partitions are dropped on other
+    # connections.
+    with engine.begin() as lock_conn:
+        if not lock_conn.execute(text("SELECT pg_try_advisory_xact_lock(:key)"), {"key": ARCHIVE_LOCK_KEY}).scalar():
+            return None
+        with engine.connect() as conn:
+            due = partitions_due(conn, retention_months)
+        if dry_run:
+            return [(name, None, "due") for name in due]
+        results = []
+        for name in due:
+            started = time.monotonic()
+            try:
+                path, rows = export_partition(engine, table, name, archive_dir)
+                drop_partition(engine, name, rows)
+            except Exception as e:
+                logger.error(f"Archiving {name} failed, partition kept: {e}")
+                results.append((name, None, str(e)))
+                continue
+            logger.info(f"Archived {rows:,} rows of {name} to {path} in {time.monotonic() - started:.1f}s")
+            results.append((name, rows, path))
+        return results
+
+
+def partition_status(engine, retention_months=ANALYSIS_RETENTION_MONTHS):
+    # Returns [(partition, estimated rows, total bytes, due for archive)] for
+    # both tables
+    with engine.connect() as conn:
+        due_months = {partition_month(name) for name in partitions_due(conn, retention_months)}
+        rows = conn.execute(text("""
+            SELECT child.relname, child.reltuples::bigint, pg_total_relation_size(child.oid)
+            FROM pg_inherits
+            JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+            JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+            WHERE parent.relname IN (:analyses, :payloads)
+            ORDER BY child.relname
+        """), {"analyses": PARTITIONED_TABLE, "payloads": PAYLOAD_TABLE}).all()
+    return [(name, max(0, estimate), size, partition_month(name) in due_months) for name, estimate, size in rows]
+
+
+def main():
+    from models import engine, init_db, PolicyAnalysisResult
+
+    parser = argparse.ArgumentParser(description="Create upcoming analysis partitions and archive expired ones")
+    parser.add_argument("--status", action="store_true", help="list partitions without changing anything")
+    parser.add_argument("--dry-run", action="store_true", help="list the partitions that would be archived")
+    parser.add_argument("--retention-months", type=int, default=ANALYSIS_RETENTION_MONTHS,
+                        help="months kept besides the current one; 0 keeps everything")
+    parser.add_argument("--archive-dir", default=ANALYSIS_ARCHIVE_DIR)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    if args.status:
+        for name, estimate, size, due in partition_status(engine, args.retention_months):
+            print(f"{name:<40} ~{estimate:>10,} rows {size / 1024 / 1024:>9.1f} MB{'  archive due' if due else ''}")
+        return
+    init_db()
+    results = archive_partitions(engine, PolicyAnalysisResult.__table__, args.retention_months,
+                                 args.archive_dir, args.dry_run)
+    if results is None:
+        raise SystemExit("Another process is archiving")
+    if not results:
+        print("Nothing to archive" if args.retention_months > 0 else "Retention disabled (ANALYSIS_RETENTION_MONTHS=0)")
+    failed = False
+    for name, rows, outcome in results:
+        print(f"{name:<40} {'' if rows is None else f'{rows:,} rows':>14}  {outcome}")
+        failed = failed or (rows is None and not args.dry_run)
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+import os
+import re
+import zlib
+import time
+import logging
+import argparse
+import threading
+from collections import Counter
+
+from sqlalchemy import text
+
+# Full model responses live in analysis_payloads, zlib-compressed with a
+# preset dictionary trained from sample responses, instead of inline on
+# policy_analysis_results. A response is 1-4 KB of JSON repeating the same
+# keys and phrasing; most stay under Postgres's ~2 KB TOAST threshold, so
+# before this they were stored inline and uncompressed, in every row the
+# history list and index scans read. A payload is decompressed only when one
+# analysis is opened, exported or archived.
+#
+# Until a dictionary is trained, payloads use plain zlib. Train one once
+# there are a few hundred analyses, and again after the prompt changes;
+# earlier payloads keep the dictionary they were written with:
+#
+#   python payloads.py --status
+#   python payloads.py --train
+#   python payloads.py --recompress    # rewrite payloads onto the newest dictionary
+
+logger = logging.getLogger(__name__)
+
+PAYLOAD_COMPRESSION_LEVEL = int(os.getenv("PAYLOAD_COMPRESSION_LEVEL", 6))
+# zlib only looks back 32 KB, so a larger dictionary is never used
+PAYLOAD_DICTIONARY_BYTES = min(32768, int(os.getenv("PAYLOAD_DICTIONARY_BYTES", 32768)))
+# Newest payloads read to train a dictionary
+PAYLOAD_TRAIN_SAMPLES = int(os.getenv("PAYLOAD_TRAIN_SAMPLES", 2000))
+# How often a process checks for a newer dictionary
+PAYLOAD_DICTIONARY_REFRESH_SECONDS = float(os.getenv("PAYLOAD_DICTIONARY_REFRESH_SECONDS", 300))
+PAYLOAD_RECOMPRESS_BATCH = int(os.getenv("PAYLOAD_RECOMPRESS_BATCH", 1000))
+
+# analysis_payloads.codec: zlib (with dictionary_id's preset dictionary, if
+# any), or none for payloads copied uncompressed by migration 8
+CODEC_ZLIB = "zlib"
+CODEC_NONE = "none"
+
+# JSON keys with their punctuation, string values, and runs of words: the
+# substrings responses have in common
+SEGMENT = re.compile(r'"\w+": [\[{"]?|"[^"\\]{4,200}"|(?:[\w$%.,\'-]+ ){2,8}[\w$%.,\'-]+')
+
+_lock = threading.Lock()
+_dictionaries = {}
+_current = {"id": None, "checked": 0.0}
+
+
+def _engine():
+    from models import engine
+    return engine
+
+
+def _scalar(conn, sql, params=None):
+    # Runs on the caller's connection when it has one: checking out a second
+    # connection while holding the first can starve the pool when every
+    # connection is held by a writer waiting for another
+    if conn is not None:
+        return conn.execute(text(sql), params or {}).scalar()
+    with _engine().connect() as own:
+        return own.execute(text(sql), params or {}).scalar()
+
+
+def load_dictionary(dictionary_id, conn=None):
+    # Dictionaries never change once saved, so each is read once per process
+    dictionary = _dictionaries.get(dictionary_id)
+    if dictionary is None:
+        dictionary = _scalar(conn, "SELECT dictionary FROM payload_dictionaries WHERE id = :id", {"id": dictionary_id})
+        if dictionary is None:
+            raise ValueError(f"Unknown payload dictionary {dictionary_id}")
+        _dictionaries[dictionary_id] = dictionary = bytes(dictionary)
+    return dictionary
+
+
+def current_dictionary_id(conn=None):
+    # Newest dictionary, re-checked every PAYLOAD_DICTIONARY_REFRESH_SECONDS
+    with _lock:
+        if time.monotonic() - _current["checked"] < PAYLOAD_DICTIONARY_REFRESH_SECONDS:
+            return _current["id"]
+    dictionary_id = _scalar(conn, "SELECT max(id) FROM payload_dictionaries")
+    with _lock:
+        _current.update(id=dictionary_id, checked=time.monotonic())
+    return dictionary_id
+
+
+def compress_payload(payload_text, dictionary_id=False, conn=None):
+    # analysis_payloads column values for a response; dictionary_id defaults
+    # to the newest dictionary (None: plain zlib). Callers inside a
+    # transaction pass its connection.
+    if dictionary_id is False:
+        dictionary_id = current_dictionary_id(conn)
+    raw = payload_text.encode("utf-8")
+    if dictionary_id is None:
+        compressor = zlib.compressobj(PAYLOAD_COMPRESSION_LEVEL)
+    else:
+        compressor = zlib.compressobj(PAYLOAD_COMPRESSION_LEVEL, zdict=load_dictionary(dictionary_id, conn))
+    return {"codec": CODEC_ZLIB, "dictionary_id": dictionary_id, "size_bytes": len(raw),
+            "data": compressor.compress(raw) + compressor.flush()}
+
+
+def decompress_payload(codec, dictionary_id, data, conn=None):
+    data = bytes(data)
+    if codec == CODEC_NONE:
+        return data.decode("utf-8")
+    if codec != CODEC_ZLIB:
+        raise ValueError(f"Unknown payload codec {codec!r}")
+    if dictionary_id is None:
+        return zlib.decompress(data).decode("utf-8")
+    decompressor = zlib.decompressobj(zdict=load_dictionary(dictionary_id, conn))
+    return (decompressor.decompress(data) + decompressor.flush()).decode("utf-8")
+
+
+def train_dictionary(samples, size=PAYLOAD_DICTIONARY_BYTES):
+    # Substrings found in many samples, weighted by the bytes they would save,
+    # best last: zlib encodes matches near the end of the dictionary cheapest
+    counts = Counter()
+    for sample in samples:
+        counts.update(set(SEGMENT.findall(sample)))
+    min_count = max(2, len(samples) // 100)
+    ranked = sorted(((count * len(segment), segment) for segment, count in counts.items()
+                     if count >= min_count and len(segment) >= 4), reverse=True)
+    chosen, total = [], 0
+    for _, segment in ranked:
+        encoded = segment.encode("utf-8")
+        if total + len(encoded) > size:
+            continue
+        chosen.append(encoded)
+        total += len(encoded)
+    return b"".join(reversed(chosen))
+
+
+def sample_payloads(conn, limit=PAYLOAD_TRAIN_SAMPLES):
+    rows = conn.execute(text("""
+        SELECT codec, dictionary_id, data FROM analysis_payloads ORDER BY upload_timestamp DESC LIMIT :limit
+    """), {"limit": limit}).all()
+    return [decompress_payload(*row, conn=conn) for row in rows]
+
+
+def compressed_size(samples, dictionary=None):
+    total = 0
+    for sample in samples:
+        compressor = zlib.compressobj(PAYLOAD_COMPRESSION_LEVEL, **({"zdict": dictionary} if dictionary else {}))
+        total += len(compressor.compress(sample.encode("utf-8")) + compressor.flush())
+    return total
+
+
+def save_trained_dictionary(samples_limit=PAYLOAD_TRAIN_SAMPLES):
+    # Trains on the newest payloads, keeping one in ten aside to measure it;
+    # returns (dictionary id, {bytes: raw, zlib, current dictionary, new dictionary}),
+    # or (None, error)
+    engine = _engine()
+    with engine.connect() as conn:
+        samples = sample_payloads(conn, samples_limit)
+    if len(samples) < 20:
+        return None, f"Only {len(samples)} stored payloads; analyze more policies before training"
+    held_out, training = samples[::10], [sample for index, sample in enumerate(samples) if index % 10]
+    dictionary = train_dictionary(training)
+    current_id = current_dictionary_id()
+    sizes = {
+        "raw": sum(len(sample.encode("utf-8")) for sample in held_out),
+        "zlib": compressed_size(held_out),
+        "current": compressed_size(held_out, load_dictionary(current_id)) if current_id else None,
+        "trained": compressed_size(held_out, dictionary),
+    }
+    with engine.begin() as conn:
+        dictionary_id = conn.execute(text("""
+            INSERT INTO payload_dictionaries (dictionary, sample_count, created_at)
+            VALUES (:dictionary, :samples, now() at time zone 'utc') RETURNING id
+        """), {"dictionary": dictionary, "samples": len(training)}).scalar_one()
+    _dictionaries[dictionary_id] = dictionary
+    with _lock:
+        _current.update(id=dictionary_id, checked=time.monotonic())
+    return dictionary_id, sizes
+
+
+def recompress_payloads(batch_size=PAYLOAD_RECOMPRESS_BATCH):
+    # Rewrites payloads stored uncompressed or with an older dictionary onto
+    # the newest one, a batch per transaction; returns the payloads rewritten
+    engine = _engine()
+    with _lock:
+        _current["checked"] = 0.0
+    dictionary_id = current_dictionary_id()
+    update = text("""
+        UPDATE analysis_payloads SET codec = :codec, dictionary_id = :dictionary_id, size_bytes = :size_bytes, data = :data
+        WHERE analysis_id = :analysis_id AND upload_timestamp = :upload_timestamp
+    """)
+    rewritten = 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(text("""
+                SELECT analysis_id, upload_timestamp, codec, dictionary_id, data FROM analysis_payloads
+                WHERE NOT (codec = :codec AND dictionary_id IS NOT DISTINCT FROM :dictionary_id)
+                LIMIT :limit FOR UPDATE SKIP LOCKED
+            """), {"codec": CODEC_ZLIB, "dictionary_id": dictionary_id, "limit": batch_size}).all()
+            if not rows:
+                return rewritten
+            conn.execute(update, [{
+                "analysis_id": analysis_id, "upload_timestamp": uploaded_at,
+                **compress_payload(decompress_payload(codec, old_dictionary_id, data, conn), dictionary_id, conn)
+            } for analysis_id, uploaded_at, codec, old_dictionary_id, data in rows])
+        rewritten += len(rows)
+        logger.info(f"Recompressed {rewritten:,} payloads")
+
+
+def payload_status():
+    # [(codec, dictionary id, payloads, raw bytes, stored bytes)]
+    with _engine().connect() as conn:
+        return conn.execute(text("""
+            SELECT codec, dictionary_id, count(*), coalesce(sum(size_bytes), 0), coalesce(sum(length(data)), 0)
+            FROM analysis_payloads GROUP BY codec, dictionary_id ORDER BY codec, dictionary_id NULLS FIRST
+        """)).all()
+
+
+def main():
+    from models import init_db
+
+    parser = argparse.ArgumentParser(description="Train payload compression dictionaries and recompress stored payloads")
+    parser.add_argument("--status", action="store_true", help="show payload counts and compression ratios")
+    parser.add_argument("--train", action="store_true", help="train a dictionary from the newest payloads")
+    parser.add_argument("--recompress", action="store_true", help="rewrite payloads onto the newest dictionary")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    init_db()
+    if args.train:
+        dictionary_id, sizes = save_trained_dictionary()
+        if dictionary_id is None:
+            raise SystemExit(sizes)
+        current = f", current dictionary {sizes['current']:,}" if sizes["current"] is not None else ""
+        print(f"Saved dictionary {dictionary_id}. Held-out sample: {sizes['raw']:,} bytes raw, "
+              f"zlib {sizes['zlib']:,}{current}, trained {sizes['trained']:,}")
+    if args.recompress:
+        print(f"Recompressed {recompress_payloads():,} payloads")
+    if args.status or not (args.train or args.recompress):
+        for codec, dictionary_id, count, raw, stored in payload_status():
+            ratio = f"{raw / stored:.1f}x" if stored else "-"
+            print(f"{codec:<5} dictionary {dictionary_id or '-':>4}  {count:>10,} payloads  "
+                  f"{raw / 1024 / 1024:>9.1f} MB raw  {stored / 1024 / 1024:>9.1f} MB stored  {ratio}")
+
+
+if __name__ == "__main__":
+    main()
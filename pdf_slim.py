@@ -0,0 +1,126 @@
+import os
+import time
+import hashlib
+import logging
+import tempfile
+from contextlib import contextmanager
+
+from pypdf import PdfReader, PdfWriter
+
+from pdf_upload import SpooledPDF, UPLOAD_SPOOL_DIR, SPOOL_CHUNK_SIZE
+
+# Shrinks a spooled policy PDF before it is uploaded. The model reads the text
+# layer and a rendering of each page, so embedded images far larger than that
+# rendering, duplicated objects and pages without any text (cover art,
+# marketing inserts) only add upload time and input tokens. Fonts are kept:
+# without them the text layer cannot be extracted. Scanned documents (no text
+# layer at all) keep every page and their images, only downsampled.
+
+logger = logging.getLogger(__name__)
+
+PDF_SLIM_ENABLED = os.getenv("PDF_SLIM_ENABLED", "1") == "1"
+# downsample: shrink oversized images; strip: remove images from documents
+# whose every page has text; keep: leave images alone
+PDF_SLIM_IMAGES = os.getenv("PDF_SLIM_IMAGES", "downsample")
+PDF_SLIM_IMAGE_MAX_PX = int(os.getenv("PDF_SLIM_IMAGE_MAX_PX", 1600))
+PDF_SLIM_JPEG_QUALITY = int(os.getenv("PDF_SLIM_JPEG_QUALITY", 75))
+
+
+def _downsample_images(page):
+    resized = 0
+    for image_file in page.images:
+        try:
+            image = image_file.image
+            if max(image.size) <= PDF_SLIM_IMAGE_MAX_PX:
+                continue
+            image = image.copy()
+            image.thumbnail((PDF_SLIM_IMAGE_MAX_PX, PDF_SLIM_IMAGE_MAX_PX))
+            if image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+            image_file.replace(image, quality=PDF_SLIM_JPEG_QUALITY)
+            resized += 1
+        except Exception as e:
+            # Masks, unusual color spaces and filters pypdf cannot decode stay as they are
+            logger.debug(f"Skipped image {image_file.name}: {e}")
+    return resized
+
+
+def _write_slimmed(spooled, out):
+    # Returns the report fields for the rewritten document written to out
+    reader = PdfReader(spooled.path)
+    if reader.is_encrypted:
+        raise ValueError("encrypted PDF")
+    has_text = [bool((page.extract_text() or "").strip()) for page in reader.pages]
+    scanned = not any(has_text)
+
+    writer = PdfWriter()
+    for page, text in zip(reader.pages, has_text):
+        if text or scanned:
+            writer.add_page(page)
+
+    images_resized = images_removed = 0
+    if PDF_SLIM_IMAGES == "strip" and not scanned:
+        images_removed = sum(len(page.images) for page in writer.pages)
+        writer.remove_images()
+    elif PDF_SLIM_IMAGES != "keep":
+        images_resized = sum(_downsample_images(page) for page in writer.pages)
+
+    for page in writer.pages:
+        page.compress_content_streams()
+    writer.compress_identical_objects(remove_identicals=True, remove_orphans=True)
+    writer.write(out)
+    return {
+        "original_pages": len(reader.pages),
+        "slimmed_pages": len(writer.pages),
+        "scanned": scanned,
+        "images_resized": images_resized,
+        "images_removed": images_removed,
+    }
+
+
+def _file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(SPOOL_CHUNK_SIZE), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+# Yields (spooled PDF to upload, report); report is None when slimming is
+# disabled. The slimmed copy keeps the original content_hash, which identifies
+# the document everywhere else; when slimming fails or does not make the file
+# smaller, the original is yielded.
+@contextmanager
+def slim_pdf(spooled):
+    if not PDF_SLIM_ENABLED:
+        yield spooled, None
+        return
+
+    report = {"original_bytes": spooled.size, "slimmed_bytes": spooled.size, "original_pages": None,
+              "slimmed_pages": None, "slimmed": False, "seconds": 0.0, "error": None}
+    started = time.monotonic()
+    out = tempfile.NamedTemporaryFile(prefix="policy-slim-", suffix=".pdf", dir=UPLOAD_SPOOL_DIR, delete=False)
+    try:
+        try:
+            with out:
+                report.update(_write_slimmed(spooled, out))
+            size = os.path.getsize(out.name)
+        except Exception as e:
+            logger.warning(f"PDF slimming failed for {spooled.content_hash[:12]}, uploading the original: {e}")
+            report["error"] = str(e)
+            size = None
+        report["seconds"] = time.monotonic() - started
+
+        if size is None or size >= spooled.size:
+            report["slimmed_pages"] = report["original_pages"]
+            yield spooled, report
+            return
+        report.update(slimmed_bytes=size, slimmed=True)
+        logger.info(f"Slimmed policy {spooled.content_hash[:12]} from {spooled.size:,} to {size:,} bytes, "
+                    f"{report['original_pages']} to {report['slimmed_pages']} pages in {report['seconds']:.1f}s")
+        yield SpooledPDF(out.name, spooled.name, size, spooled.content_hash, _file_md5(out.name)), report
+    finally:
+        try:
+            os.unlink(out.name)
+        except OSError:
+            pass
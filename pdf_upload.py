@@ -0,0 +1,264 @@
+import os
+import math
+import hashlib
+import logging
+import tempfile
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import IntegrityError
+
+from models import SessionLocal, FileUpload, FileUploadPart
+from openai_scheduler import openai_request
+
+# Policy PDFs on their way to OpenAI. The browser upload is copied to a temp
+# file in chunks (hashed on the way), and text extraction and the upload read
+# from that file instead of holding more copies of the bytes. Large files go
+# through the Uploads API in parts sent in parallel; each part is retried on
+# its own by openai_scheduler, and finished parts are recorded so a failed
+# upload resumes where it stopped when the same document is uploaded again.
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+# Files at least this large use the chunked Uploads API; smaller ones a single request
+UPLOAD_MULTIPART_MIN_BYTES = int(float(os.getenv("UPLOAD_MULTIPART_MIN_MB", 8)) * MB)
+UPLOAD_PART_SIZE = int(float(os.getenv("UPLOAD_PART_SIZE_MB", 4)) * MB)
+UPLOAD_PARALLEL_PARTS = int(os.getenv("UPLOAD_PARALLEL_PARTS", 4))
+# Temp directory for spooled uploads (default: the system temp dir)
+UPLOAD_SPOOL_DIR = os.getenv("UPLOAD_SPOOL_DIR") or None
+
+SPOOL_CHUNK_SIZE = 1 * MB
+UPLOAD_PURPOSE = "assistants"
+# OpenAI uploads expire an hour after creation; don't resume one about to lapse
+UPLOAD_RESUME_MARGIN = timedelta(minutes=5)
+# Upload bookkeeping rows are kept this long after they expire or complete
+UPLOAD_ROW_RETENTION = timedelta(days=1)
+
+
+class SpooledPDF:
+    def __init__(self, path, name, size, content_hash, md5):
+        self.path = path
+        self.name = name
+        self.size = size
+        self.content_hash = content_hash
+        self.md5 = md5
+
+    def open(self):
+        return open(self.path, "rb")
+
+
+@contextmanager
+def spool_pdf(source, name):
+    # source is any binary file object (Streamlit's UploadedFile, BytesIO);
+    # the temp file is removed when the block exits
+    sha256, md5, size = hashlib.sha256(), hashlib.md5(), 0
+    source.seek(0)
+    spool = tempfile.NamedTemporaryFile(prefix="policy-", suffix=".pdf", dir=UPLOAD_SPOOL_DIR, delete=False)
+    try:
+        with spool:
+            while True:
+                chunk = source.read(SPOOL_CHUNK_SIZE)
+                if not chunk:
+                    break
+                spool.write(chunk)
+                sha256.update(chunk)
+                md5.update(chunk)
+                size += len(chunk)
+        yield SpooledPDF(spool.name, name, size, sha256.hexdigest(), md5.hexdigest())
+    finally:
+        try:
+            os.unlink(spool.name)
+        except OSError:
+            pass
+
+
+def upload_pdf_to_openai(client, spooled, on_wait=None):
+    try:
+        with spooled.open() as f, openai_request(on_wait=on_wait) as request:
+            response = request.call(
+                client.files.create,
+                file=(spooled.name, f, "application/pdf"),
+                purpose=UPLOAD_PURPOSE,
+                before_attempt=lambda: f.seek(0)
+            )
+        return response.id, None
+    except Exception as e:
+        return None, str(e)
+
+
+def _resumable_upload(spooled):
+    # Returns (FileUpload, {part_number: (part_id, size)}) or (None, {})
+    db = SessionLocal()
+    try:
+        upload = db.query(FileUpload).filter(
+            FileUpload.content_hash == spooled.content_hash,
+            FileUpload.status == "uploading",
+            FileUpload.size_bytes == spooled.size,
+            FileUpload.part_size == UPLOAD_PART_SIZE,
+            FileUpload.expires_at > datetime.utcnow() + UPLOAD_RESUME_MARGIN
+        ).order_by(FileUpload.created_at.desc()).first()
+        if not upload:
+            return None, {}
+        parts = db.query(FileUploadPart).filter(FileUploadPart.file_upload_id == upload.id).all()
+        db.expunge(upload)
+        return upload, {part.part_number: (part.part_id, part.size_bytes) for part in parts}
+    finally:
+        db.close()
+
+
+def _create_upload(client, spooled, on_wait):
+    with openai_request(on_wait=on_wait) as request:
+        response = request.call(
+            client.uploads.create,
+            bytes=spooled.size,
+            filename=spooled.name,
+            mime_type="application/pdf",
+            purpose=UPLOAD_PURPOSE
+        )
+    db = SessionLocal()
+    try:
+        upload = FileUpload(
+            upload_id=response.id,
+            content_hash=spooled.content_hash,
+            filename=spooled.name,
+            size_bytes=spooled.size,
+            part_size=UPLOAD_PART_SIZE,
+            expires_at=datetime.utcfromtimestamp(response.expires_at)
+        )
+        db.add(upload)
+        db.commit()
+        db.refresh(upload)
+        db.expunge(upload)
+        return upload
+    finally:
+        db.close()
+
+
+def _upload_part(client, upload, path, part_number):
+    # Returns (part_id, size, error). Runs in a pool thread, so it never calls
+    # back into the UI.
+    with open(path, "rb") as f:
+        f.seek(part_number * upload.part_size)
+        data = f.read(upload.part_size)
+    try:
+        with openai_request() as request:
+            part = request.call(client.uploads.parts.create, upload.upload_id, data=data)
+    except Exception as e:
+        return None, len(data), str(e)
+
+    db = SessionLocal()
+    try:
+        db.add(FileUploadPart(file_upload_id=upload.id, part_number=part_number, part_id=part.id,
+                              size_bytes=len(data)))
+        db.commit()
+    except IntegrityError:
+        # Another session resuming the same upload sent this part too; either copy works
+        db.rollback()
+    except Exception as e:
+        db.rollback()
+        logger.warning(f"Failed to record part {part_number} of {upload.upload_id}: {e}")
+    finally:
+        db.close()
+    return part.id, len(data), None
+
+
+def _finish_upload(upload_id, status, file_id=None):
+    db = SessionLocal()
+    try:
+        db.query(FileUpload).filter(FileUpload.id == upload_id).update(
+            {FileUpload.status: status, FileUpload.file_id: file_id}, synchronize_session=False
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+# on_progress(bytes_sent, total_bytes) is called from the calling thread
+def upload_pdf_multipart(client, spooled, on_wait=None, on_progress=None):
+    try:
+        upload, done = _resumable_upload(spooled)
+        if upload:
+            logger.info(f"Resuming upload {upload.upload_id}: {len(done)} parts already sent")
+        else:
+            upload = _create_upload(client, spooled, on_wait)
+    except Exception as e:
+        return None, str(e)
+
+    part_count = max(1, math.ceil(spooled.size / upload.part_size))
+    sent = sum(size for _, size in done.values())
+    if on_progress:
+        on_progress(sent, spooled.size)
+
+    remaining = [number for number in range(part_count) if number not in done]
+    errors = []
+    if remaining:
+        workers = max(1, min(UPLOAD_PARALLEL_PARTS, len(remaining)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="upload-part") as executor:
+            futures = {executor.submit(_upload_part, client, upload, spooled.path, number): number
+                       for number in remaining}
+            # A failed part does not cancel the others; whatever finishes is
+            # recorded and skipped on the next attempt
+            for future in as_completed(futures):
+                part_id, size, error = future.result()
+                if error:
+                    errors.append(error)
+                    continue
+                done[futures[future]] = (part_id, size)
+                sent += size
+                if on_progress:
+                    on_progress(sent, spooled.size)
+    if errors:
+        return None, (f"Upload interrupted after {len(done)} of {part_count} parts; "
+                      f"upload again to resume. {errors[0]}")
+
+    try:
+        with openai_request(on_wait=on_wait) as request:
+            completed = request.call(
+                client.uploads.complete,
+                upload.upload_id,
+                part_ids=[done[number][0] for number in range(part_count)],
+                md5=spooled.md5
+            )
+    except Exception as e:
+        # Lapsed or already completed by another session; start over next time
+        _finish_upload(upload.id, "failed")
+        return None, str(e)
+    _finish_upload(upload.id, "completed", completed.file.id)
+    return completed.file.id, None
+
+
+def upload_policy_pdf(client, spooled, on_wait=None, on_progress=None):
+    # Returns (file_id, error)
+    if spooled.size >= UPLOAD_MULTIPART_MIN_BYTES:
+        return upload_pdf_multipart(client, spooled, on_wait, on_progress)
+    if on_progress:
+        on_progress(0, spooled.size)
+    file_id, error = upload_pdf_to_openai(client, spooled, on_wait)
+    if on_progress and not error:
+        on_progress(spooled.size, spooled.size)
+    return file_id, error
+
+
+def purge_finished_uploads():
+    # Drops bookkeeping for uploads that completed or expired a while ago
+    cutoff = datetime.utcnow() - UPLOAD_ROW_RETENTION
+    db = SessionLocal()
+    try:
+        stale_ids = [upload_id for (upload_id,) in db.query(FileUpload.id).filter(
+            (FileUpload.expires_at < cutoff) | ((FileUpload.status != "uploading") & (FileUpload.created_at < cutoff))
+        )]
+        if stale_ids:
+            db.query(FileUploadPart).filter(FileUploadPart.file_upload_id.in_(stale_ids)).delete(
+                synchronize_session=False
+            )
+            db.query(FileUpload).filter(FileUpload.id.in_(stale_ids)).delete(synchronize_session=False)
+            db.commit()
+        return len(stale_ids)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
@@ -0,0 +1,142 @@
+import json
+import logging
+from datetime import datetime
+
+from sqlalchemy.exc import IntegrityError
+
+from models import SessionLocal, PolicyProfile, PolicyFile
+from analysis_cache import hash_prompt
+from openai_scheduler import openai_request, estimate_request_tokens
+
+logger = logging.getLogger(__name__)
+
+PROFILE_MODEL = "gpt-4o"
+
+# Longer extracted text is sent as the PDF file instead
+PROFILE_TEXT_MAX_CHARS = 240000
+
+# Canonical codes let the rules engine in policy_rules.py match exclusions and
+# endorsements without parsing carrier-specific wording
+EXCLUSION_CODES = [
+    "flood", "surface_water", "groundwater_seepage", "sewer_backup", "earth_movement",
+    "wear_and_tear", "mold", "continuous_seepage", "freezing_unoccupied", "cosmetic_hail_damage",
+    "windstorm_hail", "named_storm", "power_surge", "theft_unoccupied", "tree_removal_limited",
+]
+
+ENDORSEMENT_CODES = [
+    "water_backup", "equipment_breakdown", "service_line", "ordinance_or_law",
+    "scheduled_personal_property", "replacement_cost_contents", "roof_acv",
+    "extended_replacement_cost", "flood", "mold_limited",
+]
+
+PROFILE_SYSTEM_PROMPT = f"""You are an expert homeowners insurance policy reader for PoliSee Clarity.
+Extract the policy's structured terms from the uploaded policy. Do not estimate losses.
+
+Output ONLY valid JSON with these exact keys (use null when the policy does not say):
+- deductibles: object {{all_perils: number, wind_hail: number, wind_hail_pct: number, hurricane: number, hurricane_pct: number, theft: number}}; percentage deductibles are percent of Coverage A (e.g. 2 for 2%)
+- coverage_limits: object {{a_dwelling: number, b_other_structures: number, c_personal_property: number, d_loss_of_use: number, e_personal_liability: number, f_medical_payments: number}}
+- loss_settlement: object {{dwelling: "RCV" or "ACV", roof: "RCV" or "ACV", personal_property: "RCV" or "ACV"}}
+- special_limits: object {{jewelry_theft: number, water_backup: number, mold: number, tree_debris_removal: number}}
+- exclusions: array of codes from {json.dumps(EXCLUSION_CODES)} that the policy excludes
+- endorsements: array of codes from {json.dumps(ENDORSEMENT_CODES)} that the policy includes
+- other_exclusions: array of strings for named exclusions that fit no code
+- other_endorsements: array of strings for endorsements that fit no code
+- ambiguous_clauses: array of objects [{{topic: string, text: string}}] for wording you cannot classify with confidence; topic is one of "water", "wind_hail", "flood", "tree", "power_surge", "hurricane", "fire", "theft", "settlement", "deductible"
+
+Be conservative: only list an exclusion or endorsement when the policy wording supports it."""
+
+PROFILE_PROMPT_HASH = hash_prompt(PROFILE_SYSTEM_PROMPT)
+
+
+def extract_policy_profile(client, file_id, policy_text=None, content_hash=None):
+    # Extracted text when available (cheaper than the file input), else the PDF itself
+    if policy_text and len(policy_text) <= PROFILE_TEXT_MAX_CHARS:
+        policy_input = {"type": "input_text", "text": policy_text}
+    else:
+        policy_input = {"type": "input_file", "file_id": file_id}
+    messages = [
+        {"role": "system", "content": PROFILE_SYSTEM_PROMPT},
+        {
+            "role": "user",
+            "content": [
+                policy_input,
+                {"type": "input_text", "text": "Extract the structured terms of the homeowners insurance policy above."}
+            ]
+        }
+    ]
+    try:
+        call_log = {"operation": "profile", "model": PROFILE_MODEL, "content_hash": content_hash}
+        with openai_request(estimated_tokens=estimate_request_tokens(messages), call_log=call_log) as request:
+            response = request.call(
+                client.responses.create,
+                model=PROFILE_MODEL,
+                input=messages,
+                text={"format": {"type": "json_object"}}
+            )
+        return json.loads(response.output_text), None
+    except json.JSONDecodeError as e:
+        return None, f"Failed to parse policy profile: {str(e)}"
+    except Exception as e:
+        return None, str(e)
+
+
+def get_policy_profile(content_hash):
+    db = SessionLocal()
+    try:
+        profile = db.query(PolicyProfile).filter(
+            PolicyProfile.content_hash == content_hash,
+            PolicyProfile.prompt_hash == PROFILE_PROMPT_HASH
+        ).first()
+        return json.loads(profile.profile_json) if profile else None
+    except Exception as e:
+        logger.warning(f"Policy profile lookup failed for {content_hash[:12]}: {e}")
+        return None
+    finally:
+        db.close()
+
+
+def save_policy_profile(content_hash, file_id, profile):
+    db = SessionLocal()
+    try:
+        # Profiles reference policy_files; without the row (its registration
+        # failed) the insert could only fail, so skip it and extract again next time
+        if not db.query(PolicyFile.content_hash).filter(PolicyFile.content_hash == content_hash).first():
+            logger.warning(f"Not saving policy profile for {content_hash[:12]}: document is not registered in policy_files")
+            return
+        existing = db.query(PolicyProfile).filter(PolicyProfile.content_hash == content_hash).first()
+        if existing:
+            # Extracted with an older prompt; replace it
+            existing.file_id = file_id
+            existing.model = PROFILE_MODEL
+            existing.prompt_hash = PROFILE_PROMPT_HASH
+            existing.profile_json = json.dumps(profile)
+            existing.created_at = datetime.utcnow()
+        else:
+            db.add(PolicyProfile(
+                content_hash=content_hash,
+                file_id=file_id,
+                model=PROFILE_MODEL,
+                prompt_hash=PROFILE_PROMPT_HASH,
+                profile_json=json.dumps(profile)
+            ))
+        db.commit()
+    except IntegrityError:
+        # Another session extracted the same document first
+        db.rollback()
+    except Exception as e:
+        db.rollback()
+        logger.warning(f"Failed to save policy profile for {content_hash[:12]}: {e}")
+    finally:
+        db.close()
+
+
+def get_or_extract_policy_profile(client, content_hash, file_id, policy_text=None):
+    profile = get_policy_profile(content_hash)
+    if profile is not None:
+        return profile, None
+    profile, error = extract_policy_profile(client, file_id, policy_text, content_hash)
+    if error:
+        return None, error
+    save_policy_profile(content_hash, file_id, profile)
+    logger.info(f"Extracted policy profile for {content_hash[:12]}")
+    return profile, None
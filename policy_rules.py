@@ -0,0 +1,314 @@
+from analysis_result import AnalysisResult, CoveredItem
+
+# Typical loss for each scenario, evaluated against a policy profile (see
+# policy_profile.py). Each item lists the coverage it falls under, the
+# exclusion codes that remove it, the endorsement that restores or is required
+# for it, and the special limit that caps it.
+#   default_excluded: excluded under standard homeowners forms even when the
+#   profile does not name the exclusion
+SCENARIO_LOSSES = {
+    "Burst Pipe / Interior Water Leak": {
+        "peril": "all_perils",
+        "topics": ["water"],
+        "items": [
+            {"item": "Emergency water extraction and drying", "cost": 3500, "depreciation_pct": 0, "coverage": "dwelling"},
+            {"item": "Drywall, insulation and flooring repair", "cost": 12000, "depreciation_pct": 15, "coverage": "dwelling"},
+            {"item": "Damaged furniture and belongings", "cost": 4000, "depreciation_pct": 30, "coverage": "personal_property"},
+            {"item": "Mold remediation", "cost": 3000, "depreciation_pct": 0, "coverage": "dwelling",
+             "excluded_if": ["mold"], "override": "mold_limited", "special_limit": "mold"},
+            {"item": "Repair of the failed pipe itself", "cost": 400, "depreciation_pct": 0, "coverage": "dwelling",
+             "excluded_if": ["wear_and_tear"], "default_excluded": True},
+        ],
+    },
+    "Roof Hail Damage": {
+        "peril": "wind_hail",
+        "topics": ["wind_hail"],
+        "items": [
+            {"item": "Roof replacement", "cost": 18000, "depreciation_pct": 40, "coverage": "roof",
+             "excluded_if": ["windstorm_hail"]},
+            {"item": "Gutters and downspouts", "cost": 1500, "depreciation_pct": 30, "coverage": "dwelling",
+             "excluded_if": ["windstorm_hail"]},
+            {"item": "Cosmetic dents to metal roofing and siding", "cost": 2500, "depreciation_pct": 0, "coverage": "dwelling",
+             "excluded_if": ["cosmetic_hail_damage", "windstorm_hail"]},
+        ],
+    },
+    "Basement Flood (Groundwater Seepage)": {
+        "peril": "all_perils",
+        "topics": ["water", "flood"],
+        "items": [
+            {"item": "Finished basement walls and flooring", "cost": 15000, "depreciation_pct": 15, "coverage": "dwelling",
+             "excluded_if": ["groundwater_seepage", "flood", "surface_water", "continuous_seepage"],
+             "default_excluded": True, "override": "flood"},
+            {"item": "Basement contents", "cost": 5000, "depreciation_pct": 40, "coverage": "personal_property",
+             "excluded_if": ["groundwater_seepage", "flood", "surface_water"],
+             "default_excluded": True, "override": "flood"},
+            {"item": "Water backed up through the sump or drains", "cost": 6000, "depreciation_pct": 0, "coverage": "dwelling",
+             "excluded_if": ["sewer_backup"], "default_excluded": True, "override": "water_backup",
+             "special_limit": "water_backup"},
+        ],
+    },
+    "Fence Wind Damage": {
+        "peril": "wind_hail",
+        "topics": ["wind_hail"],
+        "items": [
+            {"item": "Fence panel and post replacement", "cost": 4500, "depreciation_pct": 35, "coverage": "other_structures",
+             "excluded_if": ["windstorm_hail"]},
+            {"item": "Debris cleanup", "cost": 500, "depreciation_pct": 0, "coverage": "other_structures",
+             "excluded_if": ["windstorm_hail"]},
+        ],
+    },
+    "Tree Damage to Dwelling": {
+        "peril": "wind_hail",
+        "topics": ["tree", "wind_hail"],
+        "items": [
+            {"item": "Roof and structural repair", "cost": 12000, "depreciation_pct": 20, "coverage": "dwelling"},
+            {"item": "Tree removal from the dwelling", "cost": 1500, "depreciation_pct": 0, "coverage": "dwelling",
+             "special_limit": "tree_debris_removal"},
+            {"item": "Damaged belongings", "cost": 1500, "depreciation_pct": 30, "coverage": "personal_property"},
+            {"item": "Replacing the fallen yard tree", "cost": 800, "depreciation_pct": 0, "coverage": "other_structures",
+             "excluded_if": ["tree_removal_limited"], "default_excluded": True},
+        ],
+    },
+    "Appliance Power Surge": {
+        "peril": "all_perils",
+        "topics": ["power_surge"],
+        "items": [
+            {"item": "Refrigerator and kitchen appliances", "cost": 3500, "depreciation_pct": 40, "coverage": "personal_property",
+             "excluded_if": ["power_surge"], "override": "equipment_breakdown"},
+            {"item": "TV and home electronics", "cost": 2500, "depreciation_pct": 45, "coverage": "personal_property",
+             "excluded_if": ["power_surge"], "override": "equipment_breakdown"},
+            {"item": "HVAC control board", "cost": 1800, "depreciation_pct": 30, "coverage": "dwelling",
+             "excluded_if": ["power_surge"], "override": "equipment_breakdown"},
+        ],
+    },
+    "Hurricane": {
+        "peril": "hurricane",
+        "topics": ["hurricane", "wind_hail", "flood"],
+        "items": [
+            {"item": "Roof repair", "cost": 20000, "depreciation_pct": 35, "coverage": "roof",
+             "excluded_if": ["windstorm_hail", "named_storm"]},
+            {"item": "Interior damage from wind-driven rain", "cost": 12000, "depreciation_pct": 15, "coverage": "dwelling",
+             "excluded_if": ["windstorm_hail", "named_storm"]},
+            {"item": "Damaged belongings", "cost": 8000, "depreciation_pct": 35, "coverage": "personal_property",
+             "excluded_if": ["windstorm_hail", "named_storm"]},
+            {"item": "Additional living expenses", "cost": 6000, "depreciation_pct": 0, "coverage": "loss_of_use",
+             "excluded_if": ["named_storm"]},
+            {"item": "Storm surge flooding", "cost": 25000, "depreciation_pct": 10, "coverage": "dwelling",
+             "excluded_if": ["flood", "surface_water"], "default_excluded": True, "override": "flood"},
+        ],
+    },
+    "Fire": {
+        "peril": "all_perils",
+        "topics": ["fire"],
+        "items": [
+            {"item": "Structural repair", "cost": 60000, "depreciation_pct": 20, "coverage": "dwelling"},
+            {"item": "Smoke and soot cleaning", "cost": 5000, "depreciation_pct": 0, "coverage": "dwelling"},
+            {"item": "Personal property", "cost": 25000, "depreciation_pct": 40, "coverage": "personal_property"},
+            {"item": "Additional living expenses", "cost": 12000, "depreciation_pct": 0, "coverage": "loss_of_use"},
+        ],
+    },
+    "Theft": {
+        "peril": "theft",
+        "topics": ["theft"],
+        "items": [
+            {"item": "Laptops, TV and electronics", "cost": 3500, "depreciation_pct": 35, "coverage": "personal_property"},
+            {"item": "Jewelry", "cost": 4000, "depreciation_pct": 0, "coverage": "personal_property",
+             "special_limit": "jewelry_theft", "lifts_limit": "scheduled_personal_property"},
+            {"item": "Door and lock repair", "cost": 600, "depreciation_pct": 0, "coverage": "dwelling"},
+        ],
+    },
+}
+
+# Typical HO-3 special limits, used when the profile does not state one
+DEFAULT_SPECIAL_LIMITS = {
+    "jewelry_theft": 1500,
+    "water_backup": 5000,
+    "mold": 5000,
+    "tree_debris_removal": 1000,
+}
+
+COVERAGE_LIMIT_KEYS = {
+    "dwelling": "a_dwelling",
+    "roof": "a_dwelling",
+    "other_structures": "b_other_structures",
+    "personal_property": "c_personal_property",
+    "loss_of_use": "d_loss_of_use",
+}
+
+# Topics whose ambiguous clauses matter to every scenario
+GENERAL_TOPICS = ["settlement", "deductible"]
+
+EXCLUSION_GAPS = {
+    "flood": ("Flood and storm surge are not covered", "Consider an NFIP or private flood policy."),
+    "groundwater_seepage": ("Groundwater seepage is excluded", "Keep your sump pump maintained and consider a battery backup."),
+    "surface_water": ("Surface water is excluded", "Consider an NFIP or private flood policy."),
+    "continuous_seepage": ("Long-term leaks and seepage are excluded", "Fix slow leaks promptly; gradual damage is not covered."),
+    "sewer_backup": ("Water backup through drains is not covered", "Ask your agent about a water back-up endorsement."),
+    "mold": ("Mold remediation is excluded", "Dry water damage within 48 hours to prevent mold."),
+    "wear_and_tear": ("The failed part itself is not covered (wear and tear)", "Budget for plumbing and appliance maintenance."),
+    "cosmetic_hail_damage": ("Cosmetic hail damage is excluded", "Ask whether a cosmetic damage exclusion can be removed."),
+    "windstorm_hail": ("Windstorm and hail are excluded", "Check whether a separate wind policy is available in your area."),
+    "named_storm": ("Named storm damage is excluded", "Check whether a separate wind or hurricane policy is available."),
+    "power_surge": ("Power surge damage is excluded", "Ask about an equipment breakdown endorsement and use surge protectors."),
+    "tree_removal_limited": ("Trees and landscaping are not covered for windstorm", "Keep trees near the home trimmed."),
+}
+
+
+def resolve_deductible(profile, peril):
+    # Returns (amount, label, ambiguity); percentage deductibles apply to Coverage A
+    deductibles = profile.get("deductibles") or {}
+    dwelling_limit = (profile.get("coverage_limits") or {}).get("a_dwelling")
+
+    lookups = {
+        "hurricane": ["hurricane", "wind_hail", "all_perils"],
+        "wind_hail": ["wind_hail", "all_perils"],
+        "theft": ["theft", "all_perils"],
+        "all_perils": ["all_perils"],
+    }[peril]
+    for key in lookups:
+        amount = deductibles.get(key)
+        if isinstance(amount, (int, float)):
+            return float(amount), f"{key.replace('_', '/')} deductible", None
+        pct = deductibles.get(f"{key}_pct")
+        if isinstance(pct, (int, float)):
+            if not isinstance(dwelling_limit, (int, float)):
+                return None, None, f"{key} percentage deductible without a Coverage A limit"
+            return float(pct) / 100 * dwelling_limit, f"{pct:g}% {key.replace('_', '/')} deductible", None
+    return None, None, "deductible not found in policy"
+
+
+def resolve_settlement(profile, coverage):
+    settlement = profile.get("loss_settlement") or {}
+    endorsements = profile.get("endorsements") or []
+    if coverage == "roof":
+        if "roof_acv" in endorsements:
+            return "ACV"
+        return settlement.get("roof") or settlement.get("dwelling")
+    if coverage == "personal_property":
+        if "replacement_cost_contents" in endorsements:
+            return "RCV"
+        return settlement.get("personal_property")
+    if coverage == "loss_of_use":
+        return "RCV"
+    return settlement.get("dwelling")
+
+
+def _item_exclusion(item, exclusions, endorsements):
+    # Returns the exclusion code that removes the item, or None when it is covered
+    override = item.get("override")
+    if override and override in endorsements:
+        return None
+    for code in item.get("excluded_if", []):
+        if code in exclusions:
+            return code
+    if item.get("default_excluded"):
+        return (item.get("excluded_if") or ["not_covered"])[0]
+    return None
+
+
+def evaluate_scenario(profile, scenario):
+    # Returns (AnalysisResult, review_reasons), the same model an AI analysis produces;
+    # a non-empty review_reasons means the profile could not settle the scenario
+    spec = SCENARIO_LOSSES.get(scenario)
+    if not spec:
+        return None, [f"no rules for scenario {scenario}"]
+
+    exclusions = set(profile.get("exclusions") or [])
+    endorsements = set(profile.get("endorsements") or [])
+    special_limits = profile.get("special_limits") or {}
+    coverage_limits = profile.get("coverage_limits") or {}
+
+    review_reasons = []
+    topics = set(spec["topics"] + GENERAL_TOPICS)
+    for clause in profile.get("ambiguous_clauses") or []:
+        if isinstance(clause, dict) and clause.get("topic") in topics:
+            review_reasons.append(f"ambiguous {clause['topic']} wording: {clause.get('text', '')[:120]}")
+
+    deductible, deductible_label, deductible_issue = resolve_deductible(profile, spec["peril"])
+    if deductible_issue:
+        review_reasons.append(deductible_issue)
+
+    covered_items, not_covered_items = [], []
+    gap_alerts, recommendations = [], []
+    payout_by_coverage = {}
+    total_loss = 0.0
+
+    for item in spec["items"]:
+        total_loss += item["cost"]
+        excluded_by = _item_exclusion(item, exclusions, endorsements)
+        if excluded_by:
+            gap, recommendation = EXCLUSION_GAPS.get(excluded_by, (f"{item['item']} is not covered", None))
+            not_covered_items.append(f"{item['item']} (est. ${item['cost']:,.0f}) - {gap.lower()}")
+            if gap not in gap_alerts:
+                gap_alerts.append(gap)
+            if recommendation and recommendation not in recommendations:
+                recommendations.append(recommendation)
+            continue
+
+        settlement = resolve_settlement(profile, item["coverage"])
+        if settlement not in ("ACV", "RCV"):
+            review_reasons.append(f"loss settlement for {item['coverage']} not found in policy")
+            settlement = "ACV"
+        depreciation_pct = item["depreciation_pct"] if settlement == "ACV" else 0
+        payout = item["cost"] * (1 - depreciation_pct / 100)
+
+        special_key = item.get("special_limit")
+        if special_key and item.get("lifts_limit") not in endorsements:
+            limit = special_limits.get(special_key)
+            if not isinstance(limit, (int, float)):
+                limit = DEFAULT_SPECIAL_LIMITS[special_key]
+            if payout > limit:
+                payout = float(limit)
+                gap_alerts.append(f"{item['item']} limited to ${limit:,.0f}")
+
+        if settlement == "ACV" and item["depreciation_pct"] and item["coverage"] == "roof" \
+                and "Roof is paid at actual cash value (depreciated)" not in gap_alerts:
+            gap_alerts.append("Roof is paid at actual cash value (depreciated)")
+            recommendations.append("Ask your agent about replacement cost coverage for your roof.")
+
+        limit_key = COVERAGE_LIMIT_KEYS[item["coverage"]]
+        payout_by_coverage[limit_key] = payout_by_coverage.get(limit_key, 0) + payout
+        covered_items.append(CoveredItem(
+            item=item["item"],
+            est_replacement_cost=float(item["cost"]),
+            depreciation_pct=float(depreciation_pct),
+            acv_payout=round(payout, 2),
+        ))
+
+    covered_total = 0.0
+    for limit_key, payout in payout_by_coverage.items():
+        limit = coverage_limits.get(limit_key)
+        if isinstance(limit, (int, float)) and payout > limit:
+            coverage_name = limit_key.split('_', 1)[1].replace('_', ' ')
+            gap_alerts.append(f"Loss exceeds the {coverage_name} limit of ${limit:,.0f}")
+            payout = limit
+        covered_total += payout
+
+    deductible_amount = deductible or 0.0
+    insurer_pays = max(0.0, covered_total - deductible_amount)
+    out_of_pocket = total_loss - insurer_pays
+
+    if deductible and deductible_label and "%" in deductible_label:
+        gap_alerts.append(f"Your {deductible_label} is ${deductible:,.0f}")
+        recommendations.append("Keep an emergency fund that covers your percentage deductible.")
+    if not recommendations:
+        recommendations.append("Review your coverage limits with your agent once a year.")
+
+    plain_summary = (
+        f"For a typical {scenario.lower()} loss of about ${total_loss:,.0f}, your policy would pay roughly "
+        f"${insurer_pays:,.0f} after a ${deductible_amount:,.0f} deductible, leaving about ${out_of_pocket:,.0f} "
+        f"for you to cover."
+    )
+    if gap_alerts:
+        plain_summary += f" The biggest gap: {gap_alerts[0].lower()}."
+
+    result = AnalysisResult(
+        plain_summary=plain_summary,
+        gap_alerts=gap_alerts,
+        covered_items=covered_items,
+        not_covered_items=not_covered_items,
+        deductible=round(deductible_amount, 2),
+        total_out_of_pocket=round(out_of_pocket, 2),
+        recommendations=recommendations,
+    )
+    return result, review_reasons
@@ -0,0 +1,211 @@
+import io
+import re
+import json
+import hashlib
+import logging
+
+try:
+    from pypdf import PdfReader
+except ImportError:
+    # Without pypdf every analysis uses the full-file path
+    PdfReader = None
+
+logger = logging.getLogger(__name__)
+
+# Below this much extracted text the PDF is most likely scanned images, so the
+# model gets the whole file instead of excerpts
+MIN_POLICY_TEXT_CHARS = 1500
+
+# Headings are matched at the start of short lines only, so body text that merely
+# mentions "Coverage A" or "exclusions" does not start a new section. Lines with
+# amounts ("Coverage A - Dwelling $350,000") are declarations entries, not headings.
+SECTION_HEADINGS = [
+    ("declarations", r"(homeowners?\s+)?(policy\s+)?declarations?\b"),
+    ("definitions", r"definitions\b"),
+    ("coverage_a", r"coverage\s+a\b"),
+    ("coverage_b", r"coverage\s+b\b"),
+    ("coverage_c", r"coverage\s+c\b"),
+    ("coverage_d", r"coverage\s+d\b"),
+    ("coverage_e", r"coverage\s+e\b"),
+    ("coverage_f", r"coverage\s+f\b"),
+    ("perils_insured", r"(section\s+i\s*[-–—:]?\s*)?perils\s+insured\s+against\b"),
+    ("exclusions", r"(section\s+i+\s*[-–—:]?\s*)?exclusions?\b"),
+    ("conditions", r"(section\s+i+\s*[-–—:]?\s*)?(general\s+)?conditions\b"),
+    ("endorsements", r"([\w&,/-]+\s+){0,6}endorsements?\b"),
+]
+MAX_HEADING_LENGTH = 70
+# Patterns that allow words before their keyword ("Water Back-Up and Sump
+# Discharge Endorsement") would also match sentences ("This endorsement
+# changes the policy"), so their lines must look like headings as well: every
+# word capitalized apart from short connecting words, and no closing
+# sentence punctuation
+HEADING_SHAPED_SECTIONS = {"endorsements"}
+MINOR_HEADING_WORDS = {"a", "an", "and", "or", "of", "the", "for", "to", "in", "on", "with", "by"}
+
+_HEADING_PATTERNS = [(name, re.compile(pattern, re.IGNORECASE)) for name, pattern in SECTION_HEADINGS]
+_AMOUNT_PATTERN = re.compile(r"\$|\d{3,}")
+_WORD_PATTERN = re.compile(r"[^\W\d_][\w'’-]*")
+
+# Sent for every scenario: the cover pages and declarations carry the
+# deductibles and Coverage A-F limits
+ALWAYS_INCLUDED_SECTIONS = ["general", "declarations"]
+
+SCENARIO_SECTIONS = {
+    "Burst Pipe / Interior Water Leak": {
+        "sections": ["coverage_a", "coverage_c", "perils_insured", "exclusions"],
+        "keywords": ["water", "discharge", "overflow", "plumbing", "freez", "leak", "seepage", "mold", "fungi"],
+    },
+    "Roof Hail Damage": {
+        "sections": ["coverage_a", "perils_insured", "endorsements"],
+        "keywords": ["hail", "windstorm", "roof", "cosmetic", "actual cash value", "depreciation", "wear and tear"],
+    },
+    "Basement Flood (Groundwater Seepage)": {
+        "sections": ["coverage_a", "exclusions", "endorsements"],
+        "keywords": ["flood", "surface water", "groundwater", "ground water", "seepage", "sump", "back up", "backup", "sewer"],
+    },
+    "Fence Wind Damage": {
+        "sections": ["coverage_b", "perils_insured"],
+        "keywords": ["windstorm", "wind", "fence", "other structures", "wear and tear"],
+    },
+    "Tree Damage to Dwelling": {
+        "sections": ["coverage_a", "perils_insured"],
+        "keywords": ["tree", "falling object", "debris removal", "shrubs", "windstorm"],
+    },
+    "Appliance Power Surge": {
+        "sections": ["coverage_c", "perils_insured", "endorsements"],
+        "keywords": ["electrical current", "power surge", "surge", "appliance", "equipment breakdown", "mechanical breakdown"],
+    },
+    "Hurricane": {
+        "sections": ["coverage_a", "coverage_b", "coverage_c", "coverage_d", "exclusions", "endorsements"],
+        "keywords": ["hurricane", "named storm", "windstorm", "flood", "storm surge", "percentage deductible", "additional living expense"],
+    },
+    "Fire": {
+        "sections": ["coverage_a", "coverage_c", "coverage_d", "perils_insured"],
+        "keywords": ["fire", "lightning", "smoke", "additional living expense", "replacement cost", "vacancy"],
+    },
+    "Theft": {
+        "sections": ["coverage_c", "perils_insured", "endorsements"],
+        "keywords": ["theft", "burglary", "special limits", "jewelry", "scheduled", "unoccupied", "mysterious disappearance"],
+    },
+}
+
+# Bump when _match_heading or split_policy_sections change which lines start
+# a section; the settings they read are hashed below
+HEADING_RULES_VERSION = 2
+
+# Part of the analysis cache key for excerpt-based analyses, so editing the
+# headings, how they are recognized or the section map invalidates results
+# built from the old selection
+SECTION_MAP_HASH = hashlib.sha256(json.dumps(
+    [HEADING_RULES_VERSION, SECTION_HEADINGS, MAX_HEADING_LENGTH, sorted(HEADING_SHAPED_SECTIONS),
+     sorted(MINOR_HEADING_WORDS), _AMOUNT_PATTERN.pattern, _WORD_PATTERN.pattern,
+     ALWAYS_INCLUDED_SECTIONS, SCENARIO_SECTIONS], sort_keys=True
+).encode("utf-8")).hexdigest()
+
+
+# pdf_source is the PDF bytes or a file path (a spooled upload is read from disk)
+def extract_page_texts(pdf_source):
+    if PdfReader is None:
+        logger.info("pypdf not installed; skipping local policy text extraction")
+        return []
+    try:
+        reader = PdfReader(io.BytesIO(pdf_source) if isinstance(pdf_source, bytes) else pdf_source)
+        return [page.extract_text() or "" for page in reader.pages]
+    except Exception as e:
+        logger.warning(f"Policy text extraction failed: {e}")
+        return []
+
+
+def _is_heading_shaped(line):
+    if line[-1] in ".,;?!":
+        return False
+    return all(word[0].isupper() or word.lower() in MINOR_HEADING_WORDS for word in _WORD_PATTERN.findall(line))
+
+
+def _match_heading(line):
+    if not line or len(line) > MAX_HEADING_LENGTH or _AMOUNT_PATTERN.search(line):
+        return None
+    for name, pattern in _HEADING_PATTERNS:
+        if pattern.match(line) and (name not in HEADING_SHAPED_SECTIONS or _is_heading_shaped(line)):
+            return name
+    return None
+
+
+def split_policy_sections(page_texts):
+    # Returns {section name: text}; text before the first heading is kept as "general"
+    sections = {}
+    current = "general"
+    for page_text in page_texts:
+        for raw_line in page_text.splitlines():
+            line = raw_line.strip()
+            heading = _match_heading(line)
+            if heading:
+                current = heading
+            sections.setdefault(current, []).append(line)
+    return {name: "\n".join(lines).strip() for name, lines in sections.items() if any(lines)}
+
+
+def ingest_policy_pdf(pdf_source):
+    page_texts = extract_page_texts(pdf_source)
+    total_chars = sum(len(text) for text in page_texts)
+    if total_chars < MIN_POLICY_TEXT_CHARS:
+        return None
+    sections = split_policy_sections(page_texts)
+    logger.info(f"Extracted {total_chars} chars from {len(page_texts)} pages into sections: {sorted(sections)}")
+    return {
+        "page_count": len(page_texts),
+        "text_chars": total_chars,
+        "sections": sections,
+    }
+
+
+def full_policy_text(sections):
+    return "\n\n".join(sections.values()) if sections else None
+
+
+def _keyword_passages(text, keywords, context_lines=3):
+    lines = text.splitlines()
+    keep = set()
+    for idx, line in enumerate(lines):
+        lowered = line.lower()
+        if any(keyword in lowered for keyword in keywords):
+            keep.update(range(max(0, idx - context_lines), min(len(lines), idx + context_lines + 1)))
+
+    passages, current = [], []
+    for idx in range(len(lines)):
+        if idx in keep:
+            current.append(lines[idx])
+        elif current:
+            passages.append("\n".join(current))
+            current = []
+    if current:
+        passages.append("\n".join(current))
+    return passages
+
+
+def select_scenario_context(sections, scenario, max_chars):
+    # Whole mapped sections first, then keyword passages from every other section.
+    # Returns None when too little was found or the excerpt exceeds max_chars,
+    # so the caller falls back to sending the whole file.
+    selection = SCENARIO_SECTIONS.get(scenario)
+    if not sections or not selection:
+        return None
+
+    included = ALWAYS_INCLUDED_SECTIONS + selection["sections"]
+    parts = []
+    for name in included:
+        if name in sections:
+            parts.append(f"[{name.replace('_', ' ').upper()}]\n{sections[name]}")
+
+    keywords = [keyword.lower() for keyword in selection["keywords"]]
+    for name, text in sections.items():
+        if name in included:
+            continue
+        passages = _keyword_passages(text, keywords)
+        if passages:
+            parts.append(f"[{name.replace('_', ' ').upper()} - RELEVANT PASSAGES]\n" + "\n...\n".join(passages))
+
+    context = "\n\n".join(parts)
+    if len(context) < MIN_POLICY_TEXT_CHARS or len(context) > max_chars:
+        return None
+    return context
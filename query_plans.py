@@ -0,0 +1,150 @@
+import time
+import logging
+import argparse
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from sqlalchemy.dialects import postgresql
+
+from models import init_db, engine
+from storage import user_by_email_query, user_analyses_query, history_query
+
+# Checks that the login and history queries (first and deep keyset pages) are
+# served by their indexes once the tables are large. Seeds synthetic users and
+# analyses, refreshes the planner statistics and EXPLAINs the queries
+# storage.py actually runs, all inside one transaction that is rolled back,
+# so the database is left as it was. Exits non-zero when a query would scan
+# its whole table.
+#
+#   python query_plans.py --rows 1000000
+
+logger = logging.getLogger(__name__)
+
+# (name, builds the query from a session and the seeded sample, table, index that must serve it)
+CHECKS = [
+    ("login", lambda db, sample: user_by_email_query(db, sample["email"]).limit(1),
+     "users", "ix_users_email_lower"),
+    ("history", lambda db, sample: user_analyses_query(db, sample["user_id"]),
+     "policy_analysis_results", "ix_policy_analysis_results_user_uploaded_id"),
+    ("history page 6", lambda db, sample: user_analyses_query(db, sample["user_id"], before=sample["user_cursor"],
+                                                              scenario="Fire"),
+     "policy_analysis_results", "ix_policy_analysis_results_user_uploaded_id"),
+    ("recent deep page", lambda db, sample: history_query(db, before=sample["recent_cursor"]),
+     "policy_analysis_results", "ix_policy_analysis_results_uploaded_id"),
+]
+
+
+def seed(conn, rows, users):
+    # Returns a sample user from the middle of the seeded range
+    first_id = conn.execute(text("""
+        INSERT INTO users (email, password_hash, created_at)
+        SELECT 'plancheck+' || g || '@example.com', 'x', now() at time zone 'utc'
+        FROM generate_series(1, :users) g
+        RETURNING id
+    """), {"users": users}).scalars().all()[0]
+    conn.execute(text("""
+        INSERT INTO policy_analysis_results (user_id, upload_timestamp, scenario, file_id, gap_count)
+        SELECT :first_id + (g % :users), now() at time zone 'utc' - g * interval '1 second', 'Fire', 'file-plancheck', 0
+        FROM generate_series(1, :rows) g
+    """), {"first_id": first_id, "users": users, "rows": rows})
+    conn.execute(text("ANALYZE users"))
+    conn.execute(text("ANALYZE policy_analysis_results"))
+    middle = users // 2
+    user_id = first_id + middle - 1
+    # Cursors a few pages into one user's history and deep into everyone's
+    user_cursor = conn.execute(text("""
+        SELECT upload_timestamp, id FROM policy_analysis_results WHERE user_id = :user_id
+        ORDER BY upload_timestamp DESC, id DESC OFFSET 50 LIMIT 1
+    """), {"user_id": user_id}).one()
+    recent_cursor = conn.execute(text("""
+        SELECT upload_timestamp, id FROM policy_analysis_results
+        ORDER BY upload_timestamp DESC, id DESC OFFSET :offset LIMIT 1
+    """), {"offset": rows // 2}).one()
+    # Mixed case: the login query has to match it case-insensitively
+    return {"user_id": user_id, "email": f"PlanCheck+{middle}@Example.com",
+            "user_cursor": tuple(user_cursor), "recent_cursor": tuple(recent_cursor)}
+
+
+def plan_nodes(plan):
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from plan_nodes(child)
+
+
+def partition_root(conn, relation):
+    # The partitioned table or index a partition (or partition index) belongs to
+    return conn.execute(text("SELECT coalesce(pg_partition_root(CAST(:relation AS regclass))::text, :relation)"),
+                        {"relation": relation}).scalar()
+
+
+def summarize(entries):
+    # Collapses the per-partition repeats of a node, e.g. "14 x Index Scan using ..."
+    collapsed = []
+    for entry in entries:
+        if collapsed and collapsed[-1][0] == entry:
+            collapsed[-1][1] += 1
+        else:
+            collapsed.append([entry, 1])
+    return " -> ".join(entry if count == 1 else f"{count} x {entry}" for entry, count in collapsed)
+
+
+def explain(conn, query):
+    sql = query.statement.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True})
+    return conn.execute(text(f"EXPLAIN (FORMAT JSON) {sql}")).scalar()[0]["Plan"]
+
+
+def check_plans(rows, users):
+    # Returns [(name, ok, plan summary)]
+    results = []
+    with engine.connect() as conn:
+        transaction = conn.begin()
+        try:
+            started = time.monotonic()
+            conn.execute(text("SET LOCAL statement_timeout = 0"))
+            sample = seed(conn, rows, users)
+            logger.info(f"Seeded {rows:,} analyses for {users:,} users in {time.monotonic() - started:.1f}s")
+            db = Session(bind=conn)
+            for name, build, table, index in CHECKS:
+                nodes = list(plan_nodes(explain(conn, build(db, sample))))
+                # Scans of a partitioned table name its partitions and their indexes
+                for node in nodes:
+                    for key in ("Relation Name", "Index Name"):
+                        if node.get(key):
+                            node[key] = partition_root(conn, node[key])
+                seq_scan = any(node["Node Type"] == "Seq Scan" and node.get("Relation Name") == table
+                               for node in nodes)
+                uses_index = any(node.get("Index Name") == index for node in nodes)
+                # A keyset cursor applied as a filter after the scan would make
+                # deep pages read every row before them
+                cursor_filtered = any("ROW(" in (node.get("Filter") or "") for node in nodes)
+                summary = summarize(
+                    node["Node Type"] + (f" using {node['Index Name']}" if node.get("Index Name") else "")
+                    for node in nodes
+                )
+                results.append((name, uses_index and not seq_scan and not cursor_filtered, summary))
+        finally:
+            transaction.rollback()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that login and history queries use their indexes")
+    parser.add_argument("--rows", type=int, default=1_000_000, help="synthetic analysis rows")
+    parser.add_argument("--users", type=int, default=10_000, help="synthetic users the rows are spread over")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    init_db()
+    failed = False
+    for name, ok, summary in check_plans(args.rows, args.users):
+        print(f"{name:<17} {'ok' if ok else 'FAIL':<5} {summary}")
+        failed = failed or not ok
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
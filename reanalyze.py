@@ -0,0 +1,378 @@
+import os
+import json
+import logging
+import argparse
+import time
+from datetime import datetime
+
+from sqlalchemy import or_, and_, exists, func, tuple_
+
+from models import (init_db, SessionLocal, PolicyAnalysisResult, AnalysisPayload, PolicyFile, ReanalysisBatch,
+                    ReanalysisItem)
+from analysis import (get_openai_client, build_analysis_request, analysis_prompt_version, parse_analysis_output,
+                      ANALYSIS_MODEL, ANALYSIS_PROMPT_HASH)
+from storage import analysis_columns, summary_columns
+from payloads import compress_payload
+from rollups import rebuild_rollups
+from analysis_cache import store_cached_analysis
+from openai_scheduler import openai_request, PRIORITY_BACKGROUND
+
+# Offline re-analysis of stored results through the OpenAI Batch API, for when
+# the analysis prompt or model changes. Every step is recorded in
+# reanalysis_batches / reanalysis_items, so an interrupted run picks up where it
+# stopped and failed requests are retried by the next submit.
+#
+#   python reanalyze.py status
+#   python reanalyze.py run --limit 20000
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger("reanalyze")
+
+BATCH_MAX_REQUESTS = int(os.getenv("REANALYSIS_BATCH_MAX_REQUESTS", 5000))
+BATCH_POLL_SECONDS = int(os.getenv("REANALYSIS_POLL_SECONDS", 60))
+APPLY_CHUNK_SIZE = 200
+
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+def current_versions():
+    # Results from either prompt layout are current; the batch itself always
+    # sends the whole file, since policy text is not kept after upload
+    return {analysis_prompt_version(None), analysis_prompt_version("excerpt")}
+
+
+def stale_filter():
+    # Profile (rules) estimates are not produced by the analysis prompt, so they
+    # are never re-analyzed; pairs already in an unapplied batch are skipped, and
+    # so are files the sweeper has deleted (file_registry.py)
+    in_flight = exists().where(and_(
+        ReanalysisItem.file_id == PolicyAnalysisResult.file_id,
+        ReanalysisItem.scenario == PolicyAnalysisResult.scenario,
+        ReanalysisItem.status == "pending"
+    ))
+    file_deleted = exists().where(and_(
+        PolicyFile.file_id == PolicyAnalysisResult.file_id,
+        PolicyFile.deleted_at.isnot(None)
+    ))
+    return and_(
+        or_(
+            PolicyAnalysisResult.prompt_version.is_(None),
+            and_(
+                PolicyAnalysisResult.prompt_version.notin_(list(current_versions())),
+                ~PolicyAnalysisResult.prompt_version.like("rules:%")
+            )
+        ),
+        ~in_flight,
+        ~file_deleted
+    )
+
+
+def stale_pairs(db, limit=None):
+    query = db.query(PolicyAnalysisResult.file_id, PolicyAnalysisResult.scenario).filter(
+        stale_filter()
+    ).group_by(PolicyAnalysisResult.file_id, PolicyAnalysisResult.scenario).order_by(
+        func.max(PolicyAnalysisResult.upload_timestamp).desc()
+    )
+    if limit:
+        query = query.limit(limit)
+    return query.all()
+
+
+def content_hashes_for(db, file_ids):
+    rows = db.query(PolicyFile.file_id, PolicyFile.content_hash).filter(PolicyFile.file_id.in_(list(file_ids))).all()
+    return {file_id: content_hash for file_id, content_hash in rows}
+
+
+def build_batch_lines(items, content_hashes):
+    lines = []
+    for item in items:
+        lines.append(json.dumps({
+            "custom_id": f"item-{item.id}",
+            "method": "POST",
+            "url": "/v1/responses",
+            "body": build_analysis_request(item.file_id, item.scenario, content_hash=content_hashes.get(item.file_id)),
+        }))
+    return "\n".join(lines).encode("utf-8")
+
+
+def call_openai(fn, *args, **kwargs):
+    with openai_request(PRIORITY_BACKGROUND) as request:
+        return request.call(fn, *args, **kwargs)
+
+
+def fail_batch(db, batch, error):
+    batch.status = "failed"
+    batch.finished_at = datetime.utcnow()
+    batch.applied_at = datetime.utcnow()
+    db.query(ReanalysisItem).filter(
+        ReanalysisItem.batch_id == batch.id, ReanalysisItem.status == "pending"
+    ).update({ReanalysisItem.status: "failed", ReanalysisItem.error: error}, synchronize_session=False)
+    db.commit()
+
+
+def submit_batch(client, limit=None):
+    db = SessionLocal()
+    try:
+        pairs = stale_pairs(db, min(limit or BATCH_MAX_REQUESTS, BATCH_MAX_REQUESTS))
+        if not pairs:
+            return None, None
+        batch = ReanalysisBatch(prompt_version=analysis_prompt_version(None), request_count=len(pairs))
+        db.add(batch)
+        db.flush()
+        items = [ReanalysisItem(batch_id=batch.id, file_id=file_id, scenario=scenario) for file_id, scenario in pairs]
+        db.add_all(items)
+        # Recorded before anything is sent, so a crash here is recovered on the next run
+        db.commit()
+
+        payload = build_batch_lines(items, content_hashes_for(db, {item.file_id for item in items}))
+        try:
+            input_file = call_openai(client.files.create, file=(f"reanalysis-{batch.id}.jsonl", payload), purpose="batch")
+            batch.input_file_id = input_file.id
+            db.commit()
+            openai_batch = call_openai(
+                client.batches.create,
+                input_file_id=input_file.id,
+                endpoint="/v1/responses",
+                completion_window="24h",
+                metadata={"reanalysis_batch_id": str(batch.id), "prompt_version": batch.prompt_version}
+            )
+        except Exception as e:
+            fail_batch(db, batch, f"Submit failed: {e}")
+            return batch.id, str(e)
+
+        batch.openai_batch_id = openai_batch.id
+        batch.status = openai_batch.status
+        batch.submitted_at = datetime.utcnow()
+        db.commit()
+        logger.info(f"Submitted batch {batch.id} ({openai_batch.id}) with {len(items)} requests")
+        return batch.id, None
+    finally:
+        db.close()
+
+
+def recover_unsubmitted_batches(client):
+    # A run that stopped between recording a batch and saving its OpenAI id may
+    # still have created it; find it by metadata instead of paying twice
+    db = SessionLocal()
+    try:
+        orphans = db.query(ReanalysisBatch).filter(
+            ReanalysisBatch.openai_batch_id.is_(None), ReanalysisBatch.applied_at.is_(None)
+        ).all()
+        if not orphans:
+            return
+        by_local_id = {}
+        for openai_batch in call_openai(client.batches.list, limit=100).data:
+            local_id = (openai_batch.metadata or {}).get("reanalysis_batch_id")
+            if local_id:
+                by_local_id[local_id] = openai_batch
+        for batch in orphans:
+            openai_batch = by_local_id.get(str(batch.id))
+            if openai_batch:
+                batch.openai_batch_id = openai_batch.id
+                batch.input_file_id = openai_batch.input_file_id
+                batch.status = openai_batch.status
+                batch.submitted_at = datetime.utcnow()
+                db.commit()
+                logger.info(f"Recovered batch {batch.id} as {openai_batch.id}")
+            else:
+                fail_batch(db, batch, "Never submitted")
+                logger.info(f"Released batch {batch.id}; it was never submitted")
+    finally:
+        db.close()
+
+
+def refresh_batch(client, db, batch):
+    openai_batch = call_openai(client.batches.retrieve, batch.openai_batch_id)
+    batch.status = openai_batch.status
+    counts = openai_batch.request_counts
+    if counts:
+        batch.completed_count = counts.completed
+        batch.failed_count = counts.failed
+    batch.output_file_id = openai_batch.output_file_id
+    batch.error_file_id = openai_batch.error_file_id
+    if batch.status in TERMINAL_STATUSES and not batch.finished_at:
+        batch.finished_at = datetime.utcnow()
+    db.commit()
+
+
+def download_lines(client, file_id):
+    if not file_id:
+        return []
+    content = call_openai(client.files.content, file_id)
+    return [json.loads(line) for line in content.text.splitlines() if line.strip()]
+
+
+def response_output_text(body):
+    parts = []
+    for output in body.get("output") or []:
+        if output.get("type") != "message":
+            continue
+        for content in output.get("content") or []:
+            if content.get("type") == "output_text":
+                parts.append(content.get("text", ""))
+    return "".join(parts)
+
+
+def parse_batch_line(line):
+    # Returns (result, error) for one output or error file line
+    if line.get("error"):
+        return None, line["error"].get("message") or json.dumps(line["error"])
+    response = line.get("response") or {}
+    if response.get("status_code") != 200:
+        body_error = (response.get("body") or {}).get("error") or {}
+        return None, body_error.get("message") or f"HTTP {response.get('status_code')}"
+    # Invalid results are not repaired here; the pair stays stale and the next
+    # submit asks again
+    return parse_analysis_output(response_output_text(response.get("body") or {}))
+
+
+def apply_results(db, batch, lines):
+    items = {f"item-{item.id}": item for item in db.query(ReanalysisItem).filter(
+        ReanalysisItem.batch_id == batch.id, ReanalysisItem.status == "pending"
+    )}
+    content_hashes = content_hashes_for(db, {item.file_id for item in items.values()})
+    current = current_versions()
+    # Oldest analysis rewritten, for refreshing the analytics rollups
+    oldest = None
+    for index, line in enumerate(lines, 1):
+        item = items.pop(line.get("custom_id"), None)
+        if item is None:
+            continue
+        result, error = parse_batch_line(line)
+        if error:
+            item.status = "failed"
+            item.error = error
+        else:
+            columns = analysis_columns(result)
+            summary = summary_columns(columns)
+            stale_rows = db.query(PolicyAnalysisResult).filter(
+                PolicyAnalysisResult.file_id == item.file_id,
+                PolicyAnalysisResult.scenario == item.scenario,
+                or_(PolicyAnalysisResult.prompt_version.is_(None),
+                    and_(PolicyAnalysisResult.prompt_version.notin_(list(current)),
+                         ~PolicyAnalysisResult.prompt_version.like("rules:%")))
+            )
+            first_saved = stale_rows.with_entities(func.min(PolicyAnalysisResult.upload_timestamp)).scalar()
+            if first_saved is not None and (oldest is None or first_saved < oldest):
+                oldest = first_saved
+            # Payloads first: the summary update takes the rows out of stale_rows
+            db.query(AnalysisPayload).filter(
+                tuple_(AnalysisPayload.analysis_id, AnalysisPayload.upload_timestamp).in_(
+                    stale_rows.with_entities(PolicyAnalysisResult.id, PolicyAnalysisResult.upload_timestamp)
+                )
+            ).update(compress_payload(columns["openai_response_json"], conn=db.connection()), synchronize_session=False)
+            item.updated_rows = stale_rows.update({**summary, "prompt_version": batch.prompt_version},
+                                                  synchronize_session=False)
+            item.status = "done"
+            content_hash = content_hashes.get(item.file_id)
+            if content_hash:
+                store_cached_analysis(content_hash, item.scenario, ANALYSIS_MODEL, ANALYSIS_PROMPT_HASH, result.to_dict())
+        if index % APPLY_CHUNK_SIZE == 0:
+            db.commit()
+    db.commit()
+    return items, oldest
+
+
+def apply_batch(client, db, batch):
+    # Items are marked as they are applied, so re-running after an interruption
+    # only touches what is left
+    lines = download_lines(client, batch.output_file_id) + download_lines(client, batch.error_file_id)
+    missing, oldest = apply_results(db, batch, lines)
+    for item in missing.values():
+        item.status = "failed"
+        item.error = f"No result (batch {batch.status})"
+    batch.applied_at = datetime.utcnow()
+    db.commit()
+    # Rewritten results change the out-of-pocket and gap alert rollups of their days
+    if oldest is not None:
+        rebuild_rollups(oldest.date())
+    done = db.query(ReanalysisItem).filter(ReanalysisItem.batch_id == batch.id, ReanalysisItem.status == "done").count()
+    logger.info(f"Applied batch {batch.id}: {done}/{batch.request_count} requests succeeded")
+
+
+def poll_batches(client):
+    # Returns the number of batches still running
+    db = SessionLocal()
+    try:
+        open_batches = db.query(ReanalysisBatch).filter(
+            ReanalysisBatch.openai_batch_id.isnot(None), ReanalysisBatch.applied_at.is_(None)
+        ).all()
+        running = 0
+        for batch in open_batches:
+            try:
+                refresh_batch(client, db, batch)
+                if batch.status in TERMINAL_STATUSES:
+                    apply_batch(client, db, batch)
+                else:
+                    running += 1
+                    logger.info(f"Batch {batch.id} ({batch.openai_batch_id}) is {batch.status}: "
+                                f"{batch.completed_count}/{batch.request_count} done")
+            except Exception as e:
+                db.rollback()
+                running += 1
+                logger.error(f"Failed to update batch {batch.id}: {e}")
+        return running
+    finally:
+        db.close()
+
+
+def print_status():
+    db = SessionLocal()
+    try:
+        stale_rows = db.query(func.count(PolicyAnalysisResult.id)).filter(stale_filter()).scalar()
+        print(f"Current prompt version: {analysis_prompt_version(None)}")
+        print(f"Stale analyses: {stale_rows} rows in {len(stale_pairs(db))} file/scenario pairs")
+        for batch in db.query(ReanalysisBatch).order_by(ReanalysisBatch.id.desc()).limit(20):
+            failed = db.query(ReanalysisItem).filter(
+                ReanalysisItem.batch_id == batch.id, ReanalysisItem.status == "failed"
+            ).count()
+            print(f"  batch {batch.id} {batch.openai_batch_id or '-'} {batch.status} "
+                  f"{batch.request_count} requests, {failed} failed, "
+                  f"{'applied' if batch.applied_at else 'not applied'}")
+    finally:
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-analyze stored policy analyses with the OpenAI Batch API")
+    parser.add_argument("command", choices=["status", "submit", "poll", "run"],
+                        help="run = submit every stale pair, then poll until all batches are applied")
+    parser.add_argument("--limit", type=int, help="at most this many file/scenario pairs to submit")
+    parser.add_argument("--wait", action="store_true", help="poll: keep polling until every batch is applied")
+    args = parser.parse_args()
+
+    init_db()
+    if args.command == "status":
+        print_status()
+        return
+    client = get_openai_client()
+    if not client:
+        raise SystemExit("OPENAI_API_KEY environment variable is required")
+    recover_unsubmitted_batches(client)
+
+    if args.command in ("submit", "run"):
+        remaining = args.limit
+        while remaining is None or remaining > 0:
+            batch_id, error = submit_batch(client, remaining)
+            if batch_id is None:
+                break
+            if error:
+                raise SystemExit(f"Batch {batch_id} could not be submitted: {error}")
+            if remaining is not None:
+                db = SessionLocal()
+                try:
+                    remaining -= db.get(ReanalysisBatch, batch_id).request_count
+                finally:
+                    db.close()
+
+    if args.command == "poll" or args.command == "run":
+        while poll_batches(client) and (args.wait or args.command == "run"):
+            time.sleep(BATCH_POLL_SECONDS)
+    print_status()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,320 @@
+import re
+import json
+import time
+import bisect
+import logging
+import argparse
+from collections import Counter
+from datetime import datetime, date
+
+from sqlalchemy import text, func, select, and_
+from sqlalchemy.dialects.postgresql import insert
+
+from models import (init_db, engine, SessionLocal, PolicyAnalysisResult, AnalysisPayload, ScenarioDailyRollup,
+                    ScenarioDailyOopBucket, GapAlertCode, ScenarioDailyGapAlert)
+from payloads import decompress_payload
+
+# Per-day, per-scenario analytics maintained incrementally: every insert into
+# policy_analysis_results (storage.save_analysis, the write-behind writer,
+# worker jobs) adds its rows to the rollups in the same transaction, so the
+# admin analytics page reads a few rows per day instead of scanning and
+# parsing stored results. Code that rewrites or deletes stored analyses
+# rebuilds the days it touched (reanalyze.py, load_test.py cleanup); to
+# backfill rows saved before rollups existed, or after editing rows by hand:
+#
+#   python rollups.py --rebuild
+#   python rollups.py --rebuild --since 2026-01-01
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the out-of-pocket histogram buckets; bucket i holds values
+# below OOP_BUCKET_BOUNDS[i], the last one everything above. Changing them
+# requires a --rebuild.
+OOP_BUCKET_BOUNDS = [
+    250, 500, 750, 1000, 1500, 2000, 2500, 3000, 4000, 5000, 6000, 7500, 10000, 12500, 15000,
+    20000, 25000, 30000, 40000, 50000, 75000, 100000, 150000, 250000,
+]
+
+# (code, label, pattern) in priority order: an alert gets the first code whose
+# pattern matches it. Codes follow policy_profile.EXCLUSION_CODES where one applies.
+GAP_ALERT_CODES = [
+    ("percentage_deductible", "Percentage deductible", r"\d\s*%.*deductible|percentage deductible"),
+    ("deductible", "Deductible", r"deductible"),
+    ("flood", "Flood and storm surge", r"flood|storm surge"),
+    ("surface_water", "Surface water", r"surface water"),
+    ("groundwater_seepage", "Groundwater seepage", r"ground\s?water"),
+    ("sewer_backup", "Water backup through drains", r"back\s?-?\s?up|sewer|sump|drain"),
+    ("continuous_seepage", "Long-term leaks and seepage", r"seepage|long[- ]term|gradual|repeated leak|slow leak"),
+    ("mold", "Mold", r"mou?ld|fung"),
+    ("wear_and_tear", "Wear and tear", r"wear and tear|deteriorat|maintenance|failed part"),
+    ("cosmetic_hail_damage", "Cosmetic hail damage", r"cosmetic"),
+    ("tree_removal_limited", "Trees, landscaping and debris removal", r"\btrees?\b|landscap|debris"),
+    ("named_storm", "Named storm and hurricane", r"named storm|hurricane"),
+    ("windstorm_hail", "Windstorm and hail", r"wind|hail"),
+    ("power_surge", "Power surge", r"surge|electrical"),
+    ("earth_movement", "Earth movement", r"earth movement|earthquake|sinkhole|settling"),
+    ("freezing_unoccupied", "Freezing while unoccupied", r"freez"),
+    ("theft_unoccupied", "Theft while vacant", r"vacan|unoccupied"),
+    ("roof_acv", "Roof paid at actual cash value", r"actual cash value|\bacv\b|depreciat"),
+    ("special_limit", "Special limit on an item", r"limited to|sub-?limit|special limit"),
+    ("coverage_limit", "Loss exceeds a coverage limit", r"exceed|\blimit"),
+    ("other", "Other", r""),
+]
+
+_GAP_ALERT_PATTERNS = [(code, re.compile(pattern, re.IGNORECASE)) for code, _, pattern in GAP_ALERT_CODES]
+GAP_ALERT_LABELS = {code: label for code, label, _ in GAP_ALERT_CODES}
+
+# pg_advisory_xact_lock key: one rebuild at a time
+REBUILD_LOCK_KEY = 7340216
+
+
+def gap_alert_code(alert):
+    for code, pattern in _GAP_ALERT_PATTERNS:
+        if pattern.search(alert):
+            return code
+    return "other"
+
+
+def _day(timestamp):
+    # Spilled rows (analysis_writer.py) carry their timestamp as text
+    if isinstance(timestamp, str):
+        timestamp = datetime.fromisoformat(timestamp)
+    return timestamp.date()
+
+
+def aggregate(rows, totals=None):
+    # Adds rows (mappings with upload_timestamp, scenario, out_of_pocket_estimate
+    # and gap_alerts, a list or its JSON) to totals, keyed by (day, scenario)
+    totals = {} if totals is None else totals
+    for row in rows:
+        key = (_day(row["upload_timestamp"]), row["scenario"])
+        total = totals.get(key)
+        if total is None:
+            total = totals[key] = {"count": 0, "oop_count": 0, "oop_sum": 0.0, "oop_min": None, "oop_max": None,
+                                   "buckets": Counter(), "gaps": Counter()}
+        total["count"] += 1
+        oop = row["out_of_pocket_estimate"]
+        if oop is not None:
+            oop = float(oop)
+            total["oop_count"] += 1
+            total["oop_sum"] += oop
+            total["oop_min"] = oop if total["oop_min"] is None else min(total["oop_min"], oop)
+            total["oop_max"] = oop if total["oop_max"] is None else max(total["oop_max"], oop)
+            total["buckets"][bisect.bisect_right(OOP_BUCKET_BOUNDS, oop)] += 1
+        # An analysis counts once per code, however many of its alerts map to it
+        alerts = row["gap_alerts"] or []
+        if isinstance(alerts, str):
+            alerts = json.loads(alerts)
+        total["gaps"].update({gap_alert_code(alert) for alert in alerts if isinstance(alert, str)})
+    return totals
+
+
+def apply_totals(conn, totals):
+    # Upserts aggregated totals; keys are written in sorted order so concurrent
+    # transactions lock rollup rows in the same order
+    if not totals:
+        return
+    keys = sorted(totals)
+    rollup = insert(ScenarioDailyRollup)
+    conn.execute(rollup.on_conflict_do_update(
+        index_elements=[ScenarioDailyRollup.day, ScenarioDailyRollup.scenario],
+        set_={
+            "analysis_count": ScenarioDailyRollup.analysis_count + rollup.excluded.analysis_count,
+            "oop_count": ScenarioDailyRollup.oop_count + rollup.excluded.oop_count,
+            "oop_sum": ScenarioDailyRollup.oop_sum + rollup.excluded.oop_sum,
+            "oop_min": func.least(ScenarioDailyRollup.oop_min, rollup.excluded.oop_min),
+            "oop_max": func.greatest(ScenarioDailyRollup.oop_max, rollup.excluded.oop_max),
+        }
+    ), [{"day": day, "scenario": scenario, "analysis_count": totals[(day, scenario)]["count"],
+         "oop_count": totals[(day, scenario)]["oop_count"], "oop_sum": totals[(day, scenario)]["oop_sum"],
+         "oop_min": totals[(day, scenario)]["oop_min"], "oop_max": totals[(day, scenario)]["oop_max"]}
+        for day, scenario in keys])
+
+    buckets = [{"day": day, "scenario": scenario, "bucket": bucket, "count": count}
+               for day, scenario in keys for bucket, count in sorted(totals[(day, scenario)]["buckets"].items())]
+    if buckets:
+        bucket_insert = insert(ScenarioDailyOopBucket)
+        conn.execute(bucket_insert.on_conflict_do_update(
+            index_elements=[ScenarioDailyOopBucket.day, ScenarioDailyOopBucket.scenario, ScenarioDailyOopBucket.bucket],
+            set_={"count": ScenarioDailyOopBucket.count + bucket_insert.excluded.count}
+        ), buckets)
+
+    gaps = [{"day": day, "scenario": scenario, "code": code, "count": count}
+            for day, scenario in keys for code, count in sorted(totals[(day, scenario)]["gaps"].items())]
+    if gaps:
+        codes = sorted({gap["code"] for gap in gaps})
+        conn.execute(insert(GapAlertCode).on_conflict_do_nothing(),
+                     [{"code": code, "label": GAP_ALERT_LABELS[code]} for code in codes])
+        gap_insert = insert(ScenarioDailyGapAlert)
+        conn.execute(gap_insert.on_conflict_do_update(
+            index_elements=[ScenarioDailyGapAlert.day, ScenarioDailyGapAlert.scenario, ScenarioDailyGapAlert.code],
+            set_={"count": ScenarioDailyGapAlert.count + gap_insert.excluded.count}
+        ), gaps)
+
+
+def record_analyses(conn, rows):
+    # Called by every writer of policy_analysis_results, inside its transaction
+    apply_totals(conn, aggregate(rows))
+
+
+
+def rebuild_rollups(since=None, chunk_size=5000):
+    # Recomputes the rollups from the stored analyses for days from since (a
+    # date; default: the oldest stored analysis) on. Days before it, including
+    # those whose partitions were archived, are left as they are. Returns the
+    # analyses read.
+    with engine.begin() as conn:
+        conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": REBUILD_LOCK_KEY})
+        if since is None:
+            oldest = conn.execute(func.min(PolicyAnalysisResult.upload_timestamp).select()).scalar()
+            if oldest is None:
+                return 0
+            since = oldest.date()
+        for table in (ScenarioDailyRollup, ScenarioDailyOopBucket, ScenarioDailyGapAlert):
+            conn.execute(table.__table__.delete().where(table.day >= since))
+        # Gap alert text is only in the compressed payload, read for the
+        # analyses that have any
+        result = conn.execute(
+            select(PolicyAnalysisResult.upload_timestamp, PolicyAnalysisResult.scenario,
+                   PolicyAnalysisResult.out_of_pocket_estimate, AnalysisPayload.codec,
+                   AnalysisPayload.dictionary_id, AnalysisPayload.data)
+            .outerjoin(AnalysisPayload, and_(AnalysisPayload.analysis_id == PolicyAnalysisResult.id,
+                                             AnalysisPayload.upload_timestamp == PolicyAnalysisResult.upload_timestamp,
+                                             PolicyAnalysisResult.gap_count > 0))
+            .where(PolicyAnalysisResult.upload_timestamp >= since)
+            .execution_options(yield_per=chunk_size)
+        )
+        totals, read = {}, 0
+        for rows in result.partitions():
+            aggregate(({
+                "upload_timestamp": uploaded_at, "scenario": scenario, "out_of_pocket_estimate": oop,
+                "gap_alerts": json.loads(decompress_payload(codec, dictionary_id, data, conn)).get("gap_alerts") if codec else None,
+            } for uploaded_at, scenario, oop, codec, dictionary_id, data in rows), totals)
+            read += len(rows)
+        apply_totals(conn, totals)
+    return read
+
+
+def percentile(buckets, share, low=None, high=None):
+    # Approximate percentile from {bucket: count}, interpolated linearly inside
+    # the bucket and clamped to the observed min/max
+    total = sum(buckets.values())
+    if not total:
+        return None
+    target = share * total
+    seen = 0
+    for bucket in sorted(buckets):
+        count = buckets[bucket]
+        if seen + count >= target:
+            lower = OOP_BUCKET_BOUNDS[bucket - 1] if bucket > 0 else (low if low is not None else 0.0)
+            upper = OOP_BUCKET_BOUNDS[bucket] if bucket < len(OOP_BUCKET_BOUNDS) else (high if high is not None else lower)
+            value = lower + (upper - lower) * ((target - seen) / count)
+            if low is not None:
+                value = max(value, low)
+            if high is not None:
+                value = min(value, high)
+            return value
+        seen += count
+    return high
+
+
+def scenario_summary(since, until):
+    # Per-scenario totals for days in [since, until]: count, mean, min, max,
+    # p50 and p90 out-of-pocket, sorted by analyses
+    db = SessionLocal()
+    try:
+        rows = db.query(
+            ScenarioDailyRollup.scenario,
+            func.sum(ScenarioDailyRollup.analysis_count),
+            func.sum(ScenarioDailyRollup.oop_count),
+            func.sum(ScenarioDailyRollup.oop_sum),
+            func.min(ScenarioDailyRollup.oop_min),
+            func.max(ScenarioDailyRollup.oop_max),
+        ).filter(ScenarioDailyRollup.day.between(since, until)).group_by(ScenarioDailyRollup.scenario).all()
+        bucket_rows = db.query(
+            ScenarioDailyOopBucket.scenario, ScenarioDailyOopBucket.bucket, func.sum(ScenarioDailyOopBucket.count)
+        ).filter(ScenarioDailyOopBucket.day.between(since, until)).group_by(
+            ScenarioDailyOopBucket.scenario, ScenarioDailyOopBucket.bucket
+        ).all()
+    finally:
+        db.close()
+    buckets = {}
+    for scenario, bucket, count in bucket_rows:
+        buckets.setdefault(scenario, {})[bucket] = int(count)
+    summary = []
+    for scenario, count, oop_count, oop_sum, oop_min, oop_max in rows:
+        scenario_buckets = buckets.get(scenario, {})
+        summary.append({
+            "scenario": scenario,
+            "analyses": int(count),
+            "oop_count": int(oop_count),
+            "oop_mean": oop_sum / oop_count if oop_count else None,
+            "oop_min": oop_min,
+            "oop_p50": percentile(scenario_buckets, 0.5, oop_min, oop_max),
+            "oop_p90": percentile(scenario_buckets, 0.9, oop_min, oop_max),
+            "oop_max": oop_max,
+            "buckets": scenario_buckets,
+        })
+    return sorted(summary, key=lambda row: -row["analyses"])
+
+
+def overall_percentiles(summary, shares=(0.5, 0.9)):
+    # Percentiles across every scenario in a scenario_summary
+    buckets = Counter()
+    for row in summary:
+        buckets.update(row["buckets"])
+    lows = [row["oop_min"] for row in summary if row["oop_min"] is not None]
+    highs = [row["oop_max"] for row in summary if row["oop_max"] is not None]
+    return [percentile(buckets, share, min(lows) if lows else None, max(highs) if highs else None)
+            for share in shares]
+
+
+def daily_counts(since, until):
+    # [(day, scenario, analyses)] for days in [since, until]
+    db = SessionLocal()
+    try:
+        return db.query(ScenarioDailyRollup.day, ScenarioDailyRollup.scenario, ScenarioDailyRollup.analysis_count
+                        ).filter(ScenarioDailyRollup.day.between(since, until)).order_by(ScenarioDailyRollup.day).all()
+    finally:
+        db.close()
+
+
+def gap_alert_counts(since, until):
+    # [(scenario, code, label, analyses with the alert)] for days in [since, until]
+    db = SessionLocal()
+    try:
+        return db.query(
+            ScenarioDailyGapAlert.scenario, GapAlertCode.code, GapAlertCode.label, func.sum(ScenarioDailyGapAlert.count)
+        ).join(GapAlertCode, GapAlertCode.code == ScenarioDailyGapAlert.code).filter(
+            ScenarioDailyGapAlert.day.between(since, until)
+        ).group_by(ScenarioDailyGapAlert.scenario, GapAlertCode.code, GapAlertCode.label).all()
+    finally:
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild or print the scenario analytics rollups")
+    parser.add_argument("--rebuild", action="store_true", help="recompute rollups from stored analyses")
+    parser.add_argument("--since", type=date.fromisoformat, help="first day to rebuild or summarize (YYYY-MM-DD)")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    init_db()
+    if args.rebuild:
+        started = time.monotonic()
+        read = rebuild_rollups(args.since)
+        print(f"Rebuilt rollups from {read:,} analyses in {time.monotonic() - started:.1f}s")
+        return
+    since = args.since or date(1970, 1, 1)
+    for row in scenario_summary(since, datetime.utcnow().date()):
+        mean = f"${row['oop_mean']:,.0f}" if row["oop_mean"] is not None else "-"
+        p50 = f"${row['oop_p50']:,.0f}" if row["oop_p50"] is not None else "-"
+        p90 = f"${row['oop_p90']:,.0f}" if row["oop_p90"] is not None else "-"
+        print(f"{row['scenario']:<40} {row['analyses']:>8,}  mean {mean:>9}  p50 {p50:>9}  p90 {p90:>9}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+import re
+import csv
+import json
+import bcrypt
+from sqlalchemy import func, tuple_, insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import load_only, joinedload
+
+from models import SessionLocal, User, PolicyAnalysisResult, AnalysisPayload
+from analysis_result import load_analysis_result
+from rollups import record_analyses
+from payloads import compress_payload
+
+# Account and analysis-history queries shared by app.py and the command-line
+# tools (load_test.py), kept free of Streamlit
+
+
+def validate_email(email):
+    pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
+    return re.match(pattern, email) is not None
+
+def hash_password(password):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+
+def verify_password(password, password_hash):
+    return bcrypt.checkpw(password.encode('utf-8'), password_hash.encode('utf-8'))
+
+# Emails are stored lower-cased; accounts registered before that are still
+# found whatever the case. Served by the unique ix_users_email_lower;
+# query_plans.py checks the plan
+def normalize_email(email):
+    return email.strip().lower()
+
+def user_by_email_query(db, email):
+    return db.query(User).filter(func.lower(User.email) == normalize_email(email))
+
+def register_user(email, password):
+    db = SessionLocal()
+    try:
+        existing_user = user_by_email_query(db, email).first()
+        if existing_user:
+            return None, "An account with this email already exists."
+        
+        new_user = User(
+            email=normalize_email(email),
+            password_hash=hash_password(password)
+        )
+        db.add(new_user)
+        db.commit()
+        db.refresh(new_user)
+        return new_user, None
+    except IntegrityError:
+        # Registered concurrently with the same address
+        db.rollback()
+        return None, "An account with this email already exists."
+    except Exception as e:
+        db.rollback()
+        return None, f"Registration failed: {str(e)}"
+    finally:
+        db.close()
+
+def authenticate_user(email, password):
+    db = SessionLocal()
+    try:
+        user = user_by_email_query(db, email).first()
+        if user and verify_password(password, user.password_hash):
+            return user, None
+        return None, "Invalid email or password."
+    finally:
+        db.close()
+
+# Columns the history list reads; the JSON payload is fetched per analysis
+# by get_analysis when one is opened
+HISTORY_COLUMNS = (
+    PolicyAnalysisResult.id,
+    PolicyAnalysisResult.upload_timestamp,
+    PolicyAnalysisResult.scenario,
+    PolicyAnalysisResult.file_id,
+    PolicyAnalysisResult.out_of_pocket_estimate,
+    PolicyAnalysisResult.gap_count,
+)
+
+# Values saved for an AnalysisResult: the summary columns the history list
+# reads inline on PolicyAnalysisResult, the full response (compressed into
+# analysis_payloads) and the gap alerts (counted by the analytics rollups)
+def analysis_columns(result):
+    return {
+        "out_of_pocket_estimate": result.total_out_of_pocket,
+        "gap_count": len(result.gap_alerts),
+        "openai_response_json": result.to_json(),
+        "gap_alerts": json.dumps(result.gap_alerts) if result.gap_alerts else None,
+    }
+
+# Keys of analysis_columns that are not PolicyAnalysisResult columns
+PAYLOAD_KEYS = ("openai_response_json", "gap_alerts")
+
+def summary_columns(row):
+    summary = {key: value for key, value in row.items() if key not in PAYLOAD_KEYS}
+    # Rows spilled by analysis_writer.py before gap_count existed
+    if "gap_count" not in summary:
+        summary["gap_count"] = len(json.loads(row["gap_alerts"])) if row.get("gap_alerts") else 0
+    return summary
+
+# A PolicyAnalysisResult for the ORM, with its compressed payload; conn is the
+# connection of the session it is added to
+def build_analysis(conn, columns, **fields):
+    analysis = PolicyAnalysisResult(**fields, **summary_columns(columns))
+    analysis.payload = AnalysisPayload(**compress_payload(columns["openai_response_json"], conn=conn))
+    return analysis
+
+# Bulk insert of rows (analysis_columns plus user_id, scenario, file_id,
+# prompt_version and upload_timestamp) and their payloads on a Core connection
+def insert_analyses(conn, rows):
+    keys = conn.execute(
+        insert(PolicyAnalysisResult).returning(PolicyAnalysisResult.id, PolicyAnalysisResult.upload_timestamp,
+                                               sort_by_parameter_order=True),
+        [summary_columns(row) for row in rows]
+    ).all()
+    conn.execute(insert(AnalysisPayload), [
+        {"analysis_id": analysis_id, "upload_timestamp": uploaded_at, **compress_payload(row["openai_response_json"], conn=conn)}
+        for (analysis_id, uploaded_at), row in zip(keys, rows)
+    ])
+
+def save_analysis(user_id, scenario, file_id, result, prompt_version=None):
+    db = SessionLocal()
+    try:
+        columns = analysis_columns(result)
+        analysis = build_analysis(
+            db.connection(),
+            columns,
+            user_id=user_id,
+            scenario=scenario,
+            file_id=file_id,
+            prompt_version=prompt_version
+        )
+        db.add(analysis)
+        db.flush()
+        record_analyses(db.connection(), [{**columns, "scenario": scenario, "upload_timestamp": analysis.upload_timestamp}])
+        db.commit()
+        return analysis.id, None
+    except Exception as e:
+        db.rollback()
+        return None, f"Failed to save analysis: {str(e)}"
+    finally:
+        db.close()
+
+# Keyset pagination: pages are ordered by (upload_timestamp, id), newest first,
+# and the next page starts below the cursor of the last row shown, so page N
+# is one index range scan like page 1. Filters: scenario, since/until datetimes.
+def history_query(db, user_id=None, limit=10, before=None, scenario=None, since=None, until=None):
+    query = db.query(PolicyAnalysisResult).options(load_only(*HISTORY_COLUMNS))
+    if user_id is not None:
+        query = query.filter(PolicyAnalysisResult.user_id == user_id)
+    if scenario:
+        query = query.filter(PolicyAnalysisResult.scenario == scenario)
+    if since:
+        query = query.filter(PolicyAnalysisResult.upload_timestamp >= since)
+    if until:
+        query = query.filter(PolicyAnalysisResult.upload_timestamp < until)
+    if before:
+        query = query.filter(tuple_(PolicyAnalysisResult.upload_timestamp, PolicyAnalysisResult.id) < tuple_(*before))
+    query = query.order_by(PolicyAnalysisResult.upload_timestamp.desc(), PolicyAnalysisResult.id.desc())
+    return query.limit(limit) if limit else query
+
+# Cursor for the page after rows
+def page_cursor(rows):
+    return (rows[-1].upload_timestamp, rows[-1].id) if rows else None
+
+# Served by ix_policy_analysis_results_uploaded_id
+def get_recent_analyses(limit=10, before=None, **filters):
+    db = SessionLocal()
+    try:
+        analyses = history_query(db, None, limit, before, **filters).all()
+        return analyses
+    finally:
+        db.close()
+
+# Served by ix_policy_analysis_results_user_uploaded_id; query_plans.py checks the plan
+def user_analyses_query(db, user_id, limit=10, before=None, **filters):
+    return history_query(db, user_id, limit, before, **filters)
+
+def get_user_analyses(user_id, limit=10, before=None, **filters):
+    db = SessionLocal()
+    try:
+        analyses = user_analyses_query(db, user_id, limit, before, **filters).all()
+        return analyses
+    finally:
+        db.close()
+
+# Streams analyses with their payload (all users when user_id is None) through
+# a server-side cursor, chunk_size rows at a time, for exports of any size
+def iter_analyses(user_id=None, chunk_size=500, **filters):
+    db = SessionLocal()
+    try:
+        query = history_query(db, user_id, None, **filters).options(
+            joinedload(PolicyAnalysisResult.payload)
+        ).yield_per(chunk_size)
+        for analysis in query:
+            yield analysis
+    finally:
+        db.close()
+
+EXPORT_COLUMNS = ["date", "scenario", "out_of_pocket", "deductible", "gap_alerts", "summary", "recommendations"]
+
+# Writes analyses as CSV to a text file object, one chunk at a time; returns the row count
+def write_analyses_csv(out, user_id=None, **filters):
+    writer = csv.writer(out)
+    writer.writerow(EXPORT_COLUMNS)
+    count = 0
+    for analysis in iter_analyses(user_id, **filters):
+        result = load_analysis_result(analysis.openai_response_json)
+        writer.writerow([
+            analysis.upload_timestamp.strftime("%Y-%m-%d %H:%M") if analysis.upload_timestamp else "",
+            analysis.scenario,
+            result.total_out_of_pocket if result.total_out_of_pocket is not None else "",
+            result.deductible if result.deductible is not None else "",
+            "; ".join(result.gap_alerts),
+            result.plain_summary,
+            "; ".join(result.recommendations),
+        ])
+        count += 1
+    return count
+
+# One saved analysis with its payload (primary-key lookup), or None when it
+# does not exist or belongs to another user. uploaded_at, when known (history
+# rows have it), limits the lookup to that month's partition.
+def get_analysis(user_id, analysis_id, uploaded_at=None):
+    db = SessionLocal()
+    try:
+        query = db.query(PolicyAnalysisResult).options(joinedload(PolicyAnalysisResult.payload)).filter(
+            PolicyAnalysisResult.id == analysis_id,
+            PolicyAnalysisResult.user_id == user_id
+        )
+        if uploaded_at is not None:
+            query = query.filter(PolicyAnalysisResult.upload_timestamp == uploaded_at)
+        return query.first()
+    finally:
+        db.close()
@@ -0,0 +1,111 @@
+import logging
+import argparse
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, case
+
+from models import SessionLocal, ApiCallLog
+
+logger = logging.getLogger(__name__)
+
+
+def _usage_value(usage, name):
+    value = getattr(usage, name, None)
+    return value if isinstance(value, int) else None
+
+
+def record_api_call(operation, usage, latency_ms, model=None, content_hash=None, scenario=None,
+                    prompt_cache_key=None):
+    details = getattr(usage, "input_tokens_details", None)
+    db = SessionLocal()
+    try:
+        db.add(ApiCallLog(
+            operation=operation,
+            model=model,
+            content_hash=content_hash,
+            scenario=scenario,
+            prompt_cache_key=prompt_cache_key,
+            input_tokens=_usage_value(usage, "input_tokens"),
+            cached_tokens=_usage_value(details, "cached_tokens") or 0,
+            output_tokens=_usage_value(usage, "output_tokens"),
+            latency_ms=int(latency_ms)
+        ))
+        db.commit()
+    except Exception as e:
+        # Accounting must never fail the analysis it describes
+        db.rollback()
+        logger.warning(f"Failed to record {operation} usage: {e}")
+    finally:
+        db.close()
+
+
+def prompt_cache_summary(since=None, content_hashes=None, operations=None):
+    # Calls that hit the prompt cache against those that did not. Latency is
+    # compared per 1k input tokens so long and short prompts can be mixed.
+    db = SessionLocal()
+    try:
+        hit = ApiCallLog.cached_tokens > 0
+        query = db.query(
+            func.count(ApiCallLog.id),
+            func.coalesce(func.sum(ApiCallLog.input_tokens), 0),
+            func.coalesce(func.sum(ApiCallLog.cached_tokens), 0),
+            func.count(case((hit, 1))),
+            func.avg(case((hit, ApiCallLog.latency_ms))),
+            func.avg(case((~hit, ApiCallLog.latency_ms))),
+            func.avg(case((hit, ApiCallLog.latency_ms * 1000.0 / func.nullif(ApiCallLog.input_tokens, 0)))),
+            func.avg(case((~hit, ApiCallLog.latency_ms * 1000.0 / func.nullif(ApiCallLog.input_tokens, 0)))),
+            func.coalesce(func.sum(case((hit, ApiCallLog.input_tokens))), 0),
+        )
+        if since is not None:
+            query = query.filter(ApiCallLog.created_at >= since)
+        if content_hashes is not None:
+            query = query.filter(ApiCallLog.content_hash.in_(list(content_hashes)))
+        if operations is not None:
+            query = query.filter(ApiCallLog.operation.in_(list(operations)))
+        (calls, input_tokens, cached_tokens, hit_calls, hit_latency, miss_latency,
+         hit_ms_per_1k, miss_ms_per_1k, hit_input_tokens) = query.one()
+    finally:
+        db.close()
+
+    latency_saved_ms = None
+    if hit_ms_per_1k is not None and miss_ms_per_1k is not None:
+        # What the cache-hit calls would have taken at the cache-miss rate
+        latency_saved_ms = (float(miss_ms_per_1k) - float(hit_ms_per_1k)) * int(hit_input_tokens) / 1000.0
+    return {
+        "calls": calls,
+        "input_tokens": int(input_tokens),
+        "cached_tokens": int(cached_tokens),
+        "cached_token_share": int(cached_tokens) / int(input_tokens) if input_tokens else None,
+        "cache_hit_calls": hit_calls,
+        "avg_latency_ms_hit": float(hit_latency) if hit_latency is not None else None,
+        "avg_latency_ms_miss": float(miss_latency) if miss_latency is not None else None,
+        "latency_saved_ms": latency_saved_ms,
+    }
+
+
+def format_cache_summary(summary):
+    if not summary["calls"]:
+        return "No OpenAI calls recorded."
+    text = (f"{summary['calls']} calls, {summary['cache_hit_calls']} with prompt-cache hits; "
+            f"{summary['cached_tokens']:,} of {summary['input_tokens']:,} input tokens cached "
+            f"({(summary['cached_token_share'] or 0):.0%})")
+    if summary["avg_latency_ms_hit"] is not None and summary["avg_latency_ms_miss"] is not None:
+        text += (f"; avg latency {summary['avg_latency_ms_hit'] / 1000:.1f}s with a cache hit vs "
+                 f"{summary['avg_latency_ms_miss'] / 1000:.1f}s without")
+    if summary["latency_saved_ms"] is not None:
+        text += f"; about {summary['latency_saved_ms'] / 1000:.0f}s saved"
+    return text
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prompt-cache hit ratio and latency from recorded OpenAI calls")
+    parser.add_argument("--hours", type=float, default=24.0, help="look back this many hours")
+    parser.add_argument("--operation", action="append", help="only these operations (repeatable)")
+    args = parser.parse_args()
+
+    since = datetime.utcnow() - timedelta(hours=args.hours)
+    print(format_cache_summary(prompt_cache_summary(since=since, operations=args.operation)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+import os
+import time
+import signal
+import socket
+import logging
+import argparse
+import threading
+
+from models import init_db
+from analysis import get_openai_client, analyze_policy_cached, analysis_prompt_version
+from jobs import claim_next_job, complete_job, fail_job, requeue_stale_jobs
+from file_registry import start_file_sweeper
+from openai_scheduler import PRIORITY_BACKGROUND
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(threadName)s - %(message)s'
+)
+logger = logging.getLogger("worker")
+
+# Analyses one worker process runs at once; start more processes to scale further
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", 4))
+WORKER_POLL_SECONDS = float(os.getenv("WORKER_POLL_SECONDS", 1.0))
+STALE_CHECK_SECONDS = 60
+
+
+def run_job(client, job, worker_id):
+    logger.info(f"Running job {job['id']} (attempt {job['attempts']}): {job['scenario']}")
+    started = time.monotonic()
+    try:
+        result, cached, error = analyze_policy_cached(
+            client, job['file_id'], job['content_hash'], job['scenario'],
+            policy_context=job['policy_context'], priority=PRIORITY_BACKGROUND
+        )
+    except Exception as e:
+        result, cached, error = None, False, str(e)
+    if error:
+        fail_job(job['id'], worker_id, error)
+        return
+    if complete_job(job['id'], worker_id, result, analysis_prompt_version(job['policy_context'])):
+        logger.info(f"Finished job {job['id']} in {time.monotonic() - started:.1f}s{' (cached)' if cached else ''}")
+
+
+def worker_loop(client, worker_id, poll_seconds, stop_event):
+    while not stop_event.is_set():
+        try:
+            job = claim_next_job(worker_id)
+        except Exception as e:
+            logger.error(f"Failed to claim a job: {e}")
+            job = None
+        if job is None:
+            stop_event.wait(poll_seconds)
+            continue
+        try:
+            run_job(client, job, worker_id)
+        except Exception:
+            # Recording the outcome failed (database unreachable); the job is
+            # requeued once it goes stale, and this thread keeps working
+            logger.exception(f"Job {job['id']} failed outside the analysis")
+            stop_event.wait(poll_seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run queued PoliSee policy analyses")
+    parser.add_argument("--concurrency", type=int, default=WORKER_CONCURRENCY,
+                        help="analyses to run at once (default: $WORKER_CONCURRENCY or 4)")
+    parser.add_argument("--poll-interval", type=float, default=WORKER_POLL_SECONDS,
+                        help="seconds to wait when the queue is empty")
+    args = parser.parse_args()
+
+    init_db()
+    client = get_openai_client()
+    if not client:
+        raise SystemExit("OPENAI_API_KEY environment variable is required")
+
+    stop_event = threading.Event()
+
+    def request_stop(signum, frame):
+        # Finish the analyses already running, then exit; unclaimed jobs stay queued
+        logger.info(f"Received signal {signum}, stopping after current jobs")
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    host = f"{socket.gethostname()}:{os.getpid()}"
+    threads = []
+    for idx in range(max(1, args.concurrency)):
+        thread = threading.Thread(
+            target=worker_loop,
+            args=(client, f"{host}:{idx}", args.poll_interval, stop_event),
+            name=f"worker-{idx}"
+        )
+        thread.start()
+        threads.append(thread)
+    logger.info(f"Worker {host} started with {len(threads)} threads")
+    start_file_sweeper(client, stop_event=stop_event)
+
+    while not stop_event.is_set():
+        try:
+            requeue_stale_jobs()
+        except Exception as e:
+            logger.error(f"Stale job check failed: {e}")
+        stop_event.wait(STALE_CHECK_SECONDS)
+
+    for thread in threads:
+        thread.join()
+    logger.info(f"Worker {host} stopped")
+
+
+if __name__ == "__main__":
+    main()